@@ -1,6 +1,7 @@
 """Functions for plotting clustering results e.g. UMAPs colored by clusters."""
 
 import numpy as np
+import pandas as pd
 import scanpy as sc
 import matplotlib.pyplot as plt
 import warnings
@@ -9,6 +10,7 @@ from beartype import beartype
 from beartype.typing import Literal, Tuple, Optional, Any
 
 import sctoolbox.utils as utils
+import sctoolbox.tools as tools
 from sctoolbox.plotting.general import _save_figure
 import sctoolbox.utils.decorator as deco
 from sctoolbox._settings import settings
@@ -23,17 +25,21 @@ def search_clustering_parameters(adata: sc.AnnData,
                                  embedding: str = "X_umap",
                                  ncols: int = 3,
                                  verbose: bool = True,
+                                 threads: int = 1,
                                  save: Optional[str] = None,
                                  **kwargs: Any) -> np.ndarray:
     """
     Plot a grid of different resolution parameters for clustering.
 
+    The clusterings are computed with :func:`sctoolbox.tools.clustering.sweep_clustering` and added to adata.obs.
+
     Parameters
     ----------
     adata : sc.AnnData
         Annotated data matrix object.
     method : str, default: "leiden"
-        Clustering method to use. Can be one of 'leiden' or 'louvain'.
+        Clustering method to use. Can be one of 'leiden' or 'louvain'. Louvain uses the multilevel algorithm of igraph
+        (not scanpy.tl.louvain), see `tools.clustering.sweep_clustering`.
     resolution_range : Tuple[float | int, float | int, float | int], default: (0.1, 1, 0.1)
         Range of 'resolution' parameter values to test. Must be a tuple in the form (min, max, step).
     embedding : str, default: "X_umap".
@@ -42,6 +48,8 @@ def search_clustering_parameters(adata: sc.AnnData,
         Number of columns in the grid.
     verbose : bool, default: True
         Print progress to console.
+    threads : int, default: 1
+        Number of processes to run the clusterings in parallel.
     save : Optional[str], default None
         Path to save figure.
     **kwargs : Any
@@ -78,19 +86,16 @@ def search_clustering_parameters(adata: sc.AnnData,
         if embedding not in adata.obsm:
             raise KeyError(f"The embedding '{embedding}' was not found in adata.obsm. Please adjust this parameter.")
 
-    # Check that method is valid
-    if method == "leiden":
-        # set future defaults to omit warning
-        def cl_function(*args, **kwargs):
-            sc.tl.leiden(*args, **kwargs, flavor="igraph", n_iterations=2)
-    elif method == "louvain":
-        cl_function = sc.tl.louvain
-
     # Setup parameters to loop over
     res_min, res_max, res_step = resolution_range
     resolutions = np.arange(res_min, res_max, res_step)
     resolutions = np.around(resolutions, 2)
 
+    # Run all clusterings on the same graph
+    sweep_key = f"{method}_search"
+    stats = tools.clustering.sweep_clustering(adata, method=method, resolutions=resolutions.tolist(), threads=threads, key_added=sweep_key)
+    labels = adata.obsm.pop(sweep_key)
+
     # Figure with given number of cols
     ncols = min(ncols, len(resolutions))  # number of resolutions caps number of columns
     nrows = int(np.ceil(len(resolutions) / ncols))
@@ -105,11 +110,12 @@ def search_clustering_parameters(adata: sc.AnnData,
         if verbose is True:
             logger.info(f"Plotting umap for resolution={res} ({i+1} / {len(resolutions)})")
 
-        # Run clustering
-        key_added = method + "_" + str(round(res, 2))
-        cl_function(adata, resolution=res, key_added=key_added)
+        # Add clustering to obs
+        key_added = stats.index[i]
+        codes = labels[key_added].to_numpy()
+        adata.obs[key_added] = pd.Categorical(codes.astype(str), categories=np.unique(codes).astype(str))
         adata.obs[key_added] = utils.tables.rename_categories(adata.obs[key_added])  # rename to start at 1
-        n_clusters = adata.obs[key_added].nunique()
+        n_clusters = stats["n_clusters"].iloc[i]
 
         # Plot embedding
         title = f"Resolution: {res} (clusters: {n_clusters})\ncolumn name: {key_added}"
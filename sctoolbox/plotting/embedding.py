@@ -1,6 +1,5 @@
 """Funtions of different single cell embeddings e.g. UMAP, PCA, tSNE."""
 
-import multiprocessing as mp
 import warnings
 import scanpy as sc
 import numpy as np
@@ -978,7 +977,7 @@ def _search_dim_red_parameters(adata: sc.AnnData,
         if r[3] > r[2] - r[1]:
             raise ValueError(f"'step' of '{r[0]}' is larger than 'max' - 'min'. Please adjust.")
 
-        return np.around(np.arange(r[1], r[2], r[3]), 2)
+        return np.around(np.arange(r[1], r[2], r[3]), 2).tolist()
 
     # remove data to save memory
     adata = utils.adata.get_minimal_adata(adata)
@@ -992,53 +991,47 @@ def _search_dim_red_parameters(adata: sc.AnnData,
         range_1 = ["perplexity_range"] + list(perplexity_range)
         range_2 = ["learning_rate_range"] + list(learning_rate_range)
 
-    # Get tool and plotting function
-    tool_func = getattr(sc.tl, method)
-
     # Setup loop parameter
     loop_params = list()
     for r in [range_1, range_2]:
         loop_params.append(get_loop_params(r))
 
-    # Should the functions be run in parallel?
-    run_parallel = False
-    if threads > 1 and method == "umap":
-        run_parallel = True
-
     # Calculate umap/tsne for each combination of spread/dist
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=numba_errors.NumbaDeprecationWarning)  # numba warning for 0.59.0 (only for UMAP)
         warnings.filterwarnings("ignore", category=UserWarning, message="In previous versions of scanpy, calling tsne with n_jobs > 1 would use MulticoreTSNE.")
 
-        if run_parallel:
-            pool = mp.Pool(threads)
+        if method == "umap":
+            # The graph and initial positions are shared by all combinations; only embeddings are returned
+            graph, init, _ = tools.embedding._umap_setup(adata, **kwargs)
         else:
             pbar = utils.multiprocessing.get_pbar(len(loop_params[0]) * len(loop_params[1]), f"Computing {method.upper()}s")
 
         # Setup jobs
         jobs = {}
+        tasks = []
         for i, r2_param in enumerate(loop_params[1]):  # rows
             for j, r1_param in enumerate(loop_params[0]):  # columns
                 kwds = {range_1[0].rsplit('_', 1)[0]: r1_param,
-                        range_2[0].rsplit('_', 1)[0]: r2_param,
-                        "copy": True}
+                        range_2[0].rsplit('_', 1)[0]: r2_param}
                 if method == "tsne":
                     kwds["n_jobs"] = threads
                 kwds |= kwargs  # gives the option to overwrite e.g. n_jobs if given in kwargs
 
                 logger.debug(f"Running '{method}' with kwds: {kwds}")
 
-                if run_parallel:
-                    job = pool.apply_async(tool_func, args=(adata, ), kwds=kwds)
+                if method == "umap":
+                    params = tools.embedding._umap_setup(adata, **(kwds | {"init_pos": init}))[2]
+                    tasks.append(((i, j), (graph, init, params)))
                 else:
-                    job = tool_func(adata, **kwds)  # run the tool function one by one; returns an anndata object
+                    jobs[(i, j)] = sc.tl.tsne(adata, copy=True, **kwds).obsm["X_tsne"]  # run the tool function one by one
                     pbar.update(1)
-                jobs[(i, j)] = job
 
-        if run_parallel:
-            pool.close()
-            utils.multiprocessing.monitor_jobs(jobs, f"Computing {method.upper()}s")
-            pool.join()
+        if method == "umap":
+            results = tools.embedding._umap_jobs([task for _, task in tasks], threads=threads, description=f"Computing {method.upper()}s")
+            for (key, _), (embedding, runtime) in zip(tasks, results):
+                jobs[key] = embedding
+                logger.debug(f"UMAP {key} finished in {runtime:.1f}s")
 
     # Figure with rows=spread, cols=dist
     fig, axes = plt.subplots(len(loop_params[1]), len(loop_params[0]),
@@ -1050,11 +1043,8 @@ def _search_dim_red_parameters(adata: sc.AnnData,
     for i, r2_param in enumerate(loop_params[1]):  # rows
         for j, r1_param in enumerate(loop_params[0]):  # columns
 
-            if run_parallel:
-                jobs[(i, j)] = jobs[(i, j)].get()
-
             # Add precalculated UMAP to adata
-            adata.obsm[f"X_{method}"] = jobs[(i, j)].obsm[f"X_{method}"]
+            adata.obsm[f"X_{method}"] = jobs[(i, j)]
 
             logger.debug(f"Plotting {method} for row={r2_param} and col={r1_param} ({i*len(loop_params[0])+j+1}/{len(loop_params[0])*len(loop_params[1])})")
 
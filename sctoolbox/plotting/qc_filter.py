@@ -9,6 +9,7 @@ import functools  # for partial functions
 import glob
 import scanpy as sc
 import warnings
+from scipy.ndimage import gaussian_filter1d
 
 import upsetplot
 import seaborn as sns
@@ -17,12 +18,14 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 
 import sctoolbox.utils as utils
+import sctoolbox.tools as tools
 from sctoolbox.plotting.general import _save_figure
 import sctoolbox.utils.decorator as deco
 
 # type hint imports
 from beartype.typing import Tuple, Dict, Optional, Literal, Callable, Iterable, Any  # , Union, List
 from beartype import beartype
+import numpy.typing as npt
 
 from sctoolbox._settings import settings
 logger = settings.logger
@@ -588,8 +591,8 @@ def _toggle_linkage(checkbox: ipywidgets.widgets.Checkbox | traitlets.utils.bunc
                 linkage.unlink()
 
 
-def _update_thresholds(slider, fig, min_line, min_shade, max_line, max_shade):
-    """Update the locations of thresholds in plot."""
+def _update_thresholds(slider, fig, min_line, min_shade, max_line, max_shade, summary=None, label=None):
+    """Update the locations of thresholds in plot and the cached number of retained values."""
 
     tmin, tmax = slider["new"]  # threshold values from slider
 
@@ -609,6 +612,12 @@ def _update_thresholds(slider, fig, min_line, min_shade, max_line, max_shade):
     x, y = max_shade.get_xy()
     max_shade.set_height(tmax - y)
 
+    # Update the number of values within thresholds from the sorted values of the summary
+    if summary is not None:
+        summary["retained"] = _count_retained(summary["values"], tmin, tmax)
+        if label is not None:
+            label.value = f"{summary['retained']} / {len(summary['values'])} retained"
+
     # Draw figure after update
     fig.canvas.draw_idle()
 
@@ -616,6 +625,139 @@ def _update_thresholds(slider, fig, min_line, min_shade, max_line, max_shade):
     # sctoolbox.utilities.save_figure(save)
 
 
+def _with_labels(slider_list: list, label_list: list) -> list:
+    """
+    Place each label with retained counts next to its slider.
+
+    Parameters
+    ----------
+    slider_list : list
+        List of sliders.
+    label_list : list
+        List of labels with the same length as slider_list. If empty, the sliders are returned unchanged.
+
+    Returns
+    -------
+    list
+        List of ipywidgets.HBox objects with a slider and its label (or the sliders if there are no labels).
+    """
+
+    if len(label_list) == 0:
+        return slider_list
+
+    return [ipywidgets.HBox([slider, label]) for slider, label in zip(slider_list, label_list)]
+
+
+@beartype
+def _count_retained(values: npt.NDArray, tmin: int | float, tmax: int | float) -> int:
+    """
+    Count the values within [tmin, tmax] using binary search on sorted values.
+
+    Parameters
+    ----------
+    values : npt.NDArray
+        Sorted 1D array of values.
+    tmin : int | float
+        Lower threshold (inclusive).
+    tmax : int | float
+        Upper threshold (inclusive).
+
+    Returns
+    -------
+    int
+        Number of values within the thresholds.
+    """
+
+    return int(max(np.searchsorted(values, tmax, side="right") - np.searchsorted(values, tmin, side="left"), 0))
+
+
+@beartype
+def _violin_summary(values: npt.ArrayLike,
+                    bins: int = 200,
+                    method: Literal["smoothed", "histogram"] = "smoothed") -> dict[str, Any]:
+    """
+    Summarize values to a binned density and exact quantiles for drawing a violin.
+
+    Parameters
+    ----------
+    values : npt.ArrayLike
+        Values to summarize. NaN values are ignored.
+    bins : int, default 200
+        Number of bins between the minimum and maximum value.
+    method : Literal["smoothed", "histogram"], default "smoothed"
+        Either smooth the histogram with a gaussian kernel (Scott's bandwidth) or use the histogram as it is.
+        The smoothed histogram approximates a kernel density estimate on the bins, but is cut at the data range.
+
+    Returns
+    -------
+    dict[str, Any]
+        Dictionary with the sorted values ("values"), bin centers ("grid"), density scaled to a maximum of 1 ("density")
+        and the minimum, quartiles and maximum ("quantiles").
+    """
+
+    values = np.asarray(values, dtype=float)
+    values = np.sort(values[~np.isnan(values)])
+
+    summary = {"values": values, "grid": np.array([]), "density": np.array([]), "quantiles": np.full(5, np.nan), "retained": len(values)}
+    if len(values) == 0:
+        return summary
+
+    vmin, vmax = values[0], values[-1]
+    if vmin == vmax:  # all values are equal; no density to show
+        summary["quantiles"] = np.full(5, vmin)
+        return summary
+
+    # Histogram from the sorted values
+    edges = np.linspace(vmin, vmax, bins + 1)
+    counts = np.diff(np.searchsorted(values, edges[1:], side="right"), prepend=0).astype(float)
+
+    if method == "smoothed":
+        bandwidth = values.std() * len(values) ** (-1 / 5)
+        sigma = bandwidth / (edges[1] - edges[0])
+        if sigma > 0:
+            counts = gaussian_filter1d(counts, sigma, mode="constant")  # density is cut at the data range
+
+    summary["grid"] = (edges[:-1] + edges[1:]) / 2
+    summary["density"] = counts / counts.max()
+    summary["quantiles"] = np.quantile(values, [0, 0.25, 0.5, 0.75, 1])
+
+    return summary
+
+
+@beartype
+def _plot_summary_violin(ax: matplotlib.axes.Axes,
+                         summary: dict[str, Any],
+                         position: int | float,
+                         color: Any,
+                         width: int | float = 0.8):
+    """
+    Draw a violin with an inner box from a summary created by _violin_summary.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes to draw the violin on.
+    summary : dict[str, Any]
+        Summary of values as returned by _violin_summary.
+    position : int | float
+        Position of the violin on the x-axis.
+    color : Any
+        Color of the violin.
+    width : int | float, default 0.8
+        Maximum width of the violin.
+    """
+
+    if len(summary["density"]) > 0:
+        half = summary["density"] * width / 2
+        ax.fill_betweenx(summary["grid"], position - half, position + half, facecolor=color, edgecolor="0.25", linewidth=1)
+
+    q_min, q25, q50, q75, q_max = summary["quantiles"]
+    if not np.isnan(q50):
+        ax.vlines(position, q_min, q_max, color="0.25", linewidth=1)  # whiskers
+        ax.vlines(position, q25, q75, color="0.25", linewidth=4)      # box between quartiles
+        ax.scatter([position], [q50], color="white", s=8, zorder=3)   # median
+
+
 @deco.log_anndata
 @beartype
 def quality_violin(adata: sc.AnnData,
@@ -629,6 +771,8 @@ def quality_violin(adata: sc.AnnData,
                    thresholds: Optional[dict[str, dict[str, dict[Literal["min", "max"], int | float]] | dict[Literal["min", "max"], int | float]]] = None,
                    global_threshold: bool = True,
                    interactive: bool = True,
+                   summary: Optional[Literal["smoothed", "histogram"]] = None,
+                   bins: int = 200,
                    save: Optional[str] = None,
                    **kwargs: Any
                    ) -> Tuple[Any, Dict[str, Any]]:
@@ -639,6 +783,9 @@ def quality_violin(adata: sc.AnnData,
     -----
     Notebook needs "%matplotlib widget" before the call for the interactive sliders to work.
 
+    For large datasets, 'summary' draws the violins from a binned density and exact quantiles computed once per group.
+    The sliders then only move the threshold lines and update the number of retained cells per group.
+
     Parameters
     ----------
     adata : sc.AnnData
@@ -663,10 +810,15 @@ def quality_violin(adata: sc.AnnData,
         Whether to use global thresholding as the initial setting. If False, thresholds are set per group.
     interactive : bool, default True
         Whether to show interactive sliders. If False, the static matplotlib plot is shown.
+    summary : Optional[Literal["smoothed", "histogram"]], default None
+        Draw violins from a precomputed per-group density instead of seaborn.violinplot. Either "smoothed" (binned histogram smoothed
+        by a gaussian kernel, which approximates seaborn's kernel density estimate) or "histogram". If None, seaborn.violinplot is used with all values.
+    bins : int, default 200
+        Number of bins for the density if 'summary' is set.
     save : Optional[str], optional
         Save the figure to the path given in 'save'. Default: None (figure is not saved).
     **kwargs : Any
-        Additional arguments passed to seaborn.violinplot.
+        Additional arguments passed to seaborn.violinplot. Ignored if 'summary' is set.
 
     Returns
     -------
@@ -766,19 +918,39 @@ def quality_violin(adata: sc.AnnData,
         slider_dict[column] = {}
 
         # Plot data from table
-        sns.violinplot(data=table,
-                       x=groupby,
-                       hue=groupby,
-                       y=column,
-                       ax=ax,
-                       order=groups,
-                       palette=color_list if len(color_list) > 1 else None,  # fixes palette without hue warning
-                       color=color_list[0] if len(color_list) == 1 else None,  # ^
-                       cut=0,
-                       legend=False,
-                       **kwargs)
-        ax.set_xticks(ax.get_xticks())  # get rid of userwarning https://stackoverflow.com/a/68794383/19870975
-        ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
+        if summary is not None:
+            if groupby is not None:
+                codes = table[groupby].astype('category').cat.codes.to_numpy()
+                values = table[column].to_numpy(dtype=float)
+                summaries = [_violin_summary(values[codes == j], bins=bins, method=summary) for j in range(len(groups))]
+            else:
+                summaries = [_violin_summary(table[column].to_numpy(dtype=float), bins=bins, method=summary)]
+
+            for j, group_summary in enumerate(summaries):
+                _plot_summary_violin(ax, group_summary, j, color_list[j])
+
+            # Same margins as seaborn
+            ax.set_xlim(-0.5, len(summaries) - 0.5)
+            ax.set_xticks(np.arange(len(summaries)))
+            ax.set_xticklabels(groups if groups is not None else [""], rotation=45, horizontalalignment='right')
+            ax.margins(y=0.05)
+            ax.autoscale_view()
+
+        else:
+            summaries = None
+            sns.violinplot(data=table,
+                           x=groupby,
+                           hue=groupby,
+                           y=column,
+                           ax=ax,
+                           order=groups,
+                           palette=color_list if len(color_list) > 1 else None,  # fixes palette without hue warning
+                           color=color_list[0] if len(color_list) == 1 else None,  # ^
+                           cut=0,
+                           legend=False,
+                           **kwargs)
+            ax.set_xticks(ax.get_xticks())  # get rid of userwarning https://stackoverflow.com/a/68794383/19870975
+            ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
         ax.set_ylabel("")
         ax.set_xlabel("")
 
@@ -799,6 +971,7 @@ def quality_violin(adata: sc.AnnData,
         data_min = table[column].min()
         data_max = table[column].max()
         slider_list = []
+        label_list = []
         for j, group in enumerate(group_names):
 
             # Establish the threshold to plot
@@ -833,12 +1006,22 @@ def quality_violin(adata: sc.AnnData,
                                                      value=[tmin, tmax],  # initial value
                                                      continuous_update=False)
 
+                # Cached number of retained cells for the group
+                label = None
+                if summaries is not None:
+                    group_summary = summaries[j]
+                    group_summary["retained"] = _count_retained(group_summary["values"], tmin, tmax)
+                    label = ipywidgets.Label(f"{group_summary['retained']} / {len(group_summary['values'])} retained")
+                    label_list.append(label)
+
                 slider.observe(functools.partial(_update_thresholds,
                                                  fig=fig,
                                                  min_line=min_line,
                                                  min_shade=min_shade,
                                                  max_line=max_line,
-                                                 max_shade=max_shade), names=["value"])
+                                                 max_shade=max_shade,
+                                                 summary=summaries[j] if summaries is not None else None,
+                                                 label=label), names=["value"])
 
                 slider_list.append(slider)
                 if groupby is not None:
@@ -862,10 +1045,10 @@ def quality_violin(adata: sc.AnnData,
                                             slider_list=slider_list,
                                             key=column), names=["value"])
 
-                box = ipywidgets.VBox([c] + slider_list)
+                box = ipywidgets.VBox([c] + _with_labels(slider_list, label_list))
 
             else:
-                box = ipywidgets.VBox(slider_list)  # no tickbox needed if there is only one slider per column
+                box = ipywidgets.VBox(_with_labels(slider_list, label_list))  # no tickbox needed if there is only one slider per column
 
             accordion_content.append(box)
 
@@ -961,35 +1144,12 @@ def _upset_select_cells(adata: sc.AnnData,
     Returns
     -------
     selection : pd.DataFrame
-        DataFrame containing boolean values for each cell based on thresholds.
+        DataFrame containing boolean values for each cell based on thresholds. NaN values are not counted as outside of the thresholds.
     """
-    selection = {}
-    # loop over all columns
-    for column_name, values in thresholds.items():
-        # loop over all groups
-        if groupby:
-            # initialize an array of False values
-            accumulate_results = np.zeros(adata.obs.shape[0], dtype=bool)
-            # loop over all samples
-            for sample, cutoffs in values.items():
-                # select cells based on the sample
-                sample_selection = np.array(adata.obs[groupby] == sample)
-                # select cells based on the cutoffs
-                cutoff_selection = np.array(
-                    (adata.obs[column_name] < cutoffs['min']) | (adata.obs[column_name] > cutoffs['max']))
-                # add up the selected cells
-                accumulate_results = accumulate_results + np.logical_and(sample_selection, cutoff_selection)
-            # add the results to the selection
-            selection[column_name] = accumulate_results
-
-        else:
-            # select cells based on the cutoffs
-            selection[column_name] = (adata.obs[column_name] < values['min']) | (adata.obs[column_name] > values['max'])
-    # convert to DataFrame
-    selection = pd.DataFrame(selection)
+    failed = tools.qc_filter.get_threshold_bitmask(adata.obs, thresholds, groupby=groupby, nan_fails=False)
 
-    # reset index
-    selection.reset_index(inplace=True, drop=True)
+    # one boolean column per metric from the bits of the mask
+    selection = pd.DataFrame({column_name: ((failed >> np.uint32(bit)) & 1).astype(bool) for bit, column_name in enumerate(thresholds)})
 
     return selection
 
@@ -1021,10 +1181,13 @@ def upset_plot_filter_impacts(adata: sc.AnnData,
 
         return None
 
-    selection = _upset_select_cells(adata, thresholds, groupby)
+    # one bit per metric; count the cells per unique combination of failed metrics
+    failed = tools.qc_filter.get_threshold_bitmask(adata.obs, thresholds, groupby=groupby, nan_fails=False)
+    masks, mask_counts = np.unique(failed, return_counts=True)
 
     # Number of variables
-    n = len(selection.columns)
+    columns = list(thresholds.keys())
+    n = len(columns)
 
     # Generate all combinations of True/False
     raw_combinations = np.array(np.meshgrid(*[[False, True]] * n)).T.reshape(-1, n)
@@ -1037,36 +1200,23 @@ def upset_plot_filter_impacts(adata: sc.AnnData,
     combinations = sorted_combinations[mask]
 
     # make a dataframe
-    combinations_df = pd.DataFrame(combinations, columns=selection.columns)
-
-    results = []
-
-    # loop over all combinations
-    for _, combination in combinations_df.iterrows():
-        # get a list of the column names selected
-        metric_combination = list(selection.columns[combination])
-        # initialize a results array for the combination with len n-cells
-        single_result = np.zeros(selection.shape[0], dtype=bool)
-        # loop over the selected combination
-        for metric in metric_combination:
-            # add up the selected cells
-            single_result = single_result + selection[metric]
-        # append result of the combination
-        results.append(sum(single_result))
-    # add to dataframe
-    combinations_df['counts'] = results
+    combinations_df = pd.DataFrame(combinations, columns=columns)
+
+    # cells filtered by a combination fail at least one of its metrics
+    combination_bits = combinations.astype(np.uint32) @ (np.uint32(1) << np.arange(n, dtype=np.uint32))
+    combinations_df['counts'] = ((combination_bits[:, None] & masks[None, :]) != 0).astype(np.int64) @ mask_counts
 
     # limit combinations
     if limit_combinations:
         # select all combinations with a grade less or equal the limit
-        limit_mask = np.array(np.sum(combinations_df[selection.columns], axis=1) <= limit_combinations)
+        limit_mask = np.array(np.sum(combinations_df[columns], axis=1) <= limit_combinations)
         # always include the total counts
         limit_mask[-1] = True
         # index by the mask
         combinations_df = combinations_df[limit_mask]
 
     # set the combinations as index
-    combinations_df.set_index(list(selection.columns), inplace=True)
+    combinations_df.set_index(columns, inplace=True)
 
     with warnings.catch_warnings():  # TODO remove when this is merged https://github.com/jnothman/UpSetPlot/pull/278
         warnings.filterwarnings("ignore", message="A value is trying to be set on a copy of a DataFrame or Series through chained assignment using an inplace method.")
@@ -1,15 +1,26 @@
 """Module for cell clustering."""
 import scanpy as sc
 import numpy as np
+import pandas as pd
+import scipy
+import itertools
+import random
+import multiprocessing as mp
+import time
 import warnings
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
 import sctoolbox.utils as utils
 import sctoolbox.utils.decorator as deco
 
-from beartype.typing import Literal, Optional, Tuple
+from beartype.typing import Literal, Optional, Tuple, Any, Iterator
 from beartype import beartype
 import numpy.typing as npt
 
+from sctoolbox._settings import settings
+logger = settings.logger
+
 
 @deco.log_anndata
 @beartype
@@ -137,29 +148,332 @@ def recluster(adata: sc.AnnData,
             ax[1].set_title(f"After re-clustering\n (column name: '{key_added}')")
 
 
-def gini(x: npt.ArrayLike) -> float:
+@deco.log_anndata
+@beartype
+def sweep_clustering(adata: sc.AnnData,
+                     method: Literal["leiden", "louvain"] = "leiden",
+                     resolutions: list[float | int] | Tuple[float | int, float | int, float | int] = (0.1, 1, 0.1),
+                     seeds: Optional[list[int]] = None,
+                     threads: int = 1,
+                     key_added: Optional[str] = None,
+                     neighbors_key: Optional[str] = None,
+                     n_iterations: int = 2) -> pd.DataFrame:
+    """
+    Cluster the neighbor graph for a range of resolutions (and seeds) without plotting.
+
+    The igraph graph is built once (once per worker process if threads > 1) and the clusterings are run in parallel.
+    All labelings are stored as integer codes in a table in adata.obsm[key_added] with one column per resolution/seed.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Annotated data matrix object with computed neighbors.
+    method : Literal["leiden", "louvain"], default "leiden"
+        Clustering method. Leiden uses the igraph implementation as sc.tl.leiden(flavor="igraph");
+        louvain uses the multilevel algorithm of igraph.
+    resolutions : list[float | int] | Tuple[float | int, float | int, float | int], default (0.1, 1, 0.1)
+        List of resolutions or a tuple in the form (min, max, step).
+    seeds : Optional[list[int]], default None
+        Random seeds to cluster each resolution with. If None, only seed 0 is used.
+    threads : int, default 1
+        Number of processes to use.
+    key_added : Optional[str], default None
+        Key in adata.obsm to store the labelings in. If None, f"{method}_sweep" is used.
+    neighbors_key : Optional[str], default None
+        Key in adata.uns of the neighbors to use. If None, "neighbors" is used.
+    n_iterations : int, default 2
+        Number of iterations of the leiden algorithm.
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with one row per column in adata.obsm[key_added] containing resolution, seed, number of clusters, runtime,
+        the adjusted rand index (ARI) and normalized mutual information (NMI) to the previous resolution with the same seed
+        and, for more than one seed, the mean ARI to the other seeds at the same resolution.
+
+    Raises
+    ------
+    ValueError
+        If neighbors are not found or if step is larger than max - min.
+    """
+
+    neighbors_key = "neighbors" if neighbors_key is None else neighbors_key
+    if neighbors_key not in adata.uns:
+        raise ValueError(f"Did not find .uns['{neighbors_key}']. Run `sc.pp.neighbors` first.")
+    key_added = f"{method}_sweep" if key_added is None else key_added
+    seeds = [0] if seeds is None else seeds
+
+    if isinstance(resolutions, tuple):
+        res_min, res_max, res_step = resolutions
+        if res_step > res_max - res_min:
+            raise ValueError("'step' of resolutions is larger than 'max' - 'min'. Please adjust.")
+        resolutions = np.around(np.arange(res_min, res_max, res_step), 2).tolist()
+
+    graph = scipy.sparse.csr_matrix(adata.obsp[adata.uns[neighbors_key].get("connectivities_key", "connectivities")])
+    tasks = list(itertools.product(seeds, resolutions))
+
+    # Cluster all resolutions and seeds on the same graph
+    if threads > 1:
+        # Each job builds the graph once from shared memory and clusters a chunk of the tasks
+        chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(tasks)), min(threads, len(tasks)))]
+        handles, spec = utils.multiprocessing.share_matrix(graph)
+        try:
+            pool = mp.Pool(len(chunks))
+            jobs = [pool.apply_async(_sweep_job, (spec, method, [tasks[i] for i in chunk], n_iterations)) for chunk in chunks]
+            pool.close()
+
+            utils.multiprocessing.monitor_jobs(jobs, f"Running {method}")
+            results = [result for job in jobs for result in job.get()]
+            pool.join()
+
+        finally:
+            utils.multiprocessing.release_shared(handles, unlink=True)
+
+    else:
+        results = _cluster_tasks(_igraph_from_adjacency(graph), method, tasks, n_iterations)
+
+    # Store labelings as integer codes
+    names = [f"{method}_{resolution}" if len(seeds) == 1 else f"{method}_{resolution}_seed{seed}" for seed, resolution in tasks]
+    codes = np.column_stack([membership for membership, _ in results])
+    adata.obsm[key_added] = pd.DataFrame(codes, index=adata.obs_names, columns=names)
+
+    # Number of clusters and stability between adjacent resolutions and between seeds
+    stats = pd.DataFrame({"resolution": [resolution for _, resolution in tasks],
+                          "seed": [seed for seed, _ in tasks],
+                          "n_clusters": codes.max(axis=0) + 1,
+                          "runtime": [runtime for _, runtime in results]}, index=names)
+
+    stats["ari_previous"] = np.nan
+    stats["nmi_previous"] = np.nan
+    for i in range(1, len(tasks)):
+        if tasks[i][0] == tasks[i - 1][0]:  # same seed
+            stats.iloc[i, stats.columns.get_loc("ari_previous")] = adjusted_rand_score(codes[:, i - 1], codes[:, i])
+            stats.iloc[i, stats.columns.get_loc("nmi_previous")] = normalized_mutual_info_score(codes[:, i - 1], codes[:, i])
+
+    if len(seeds) > 1:
+        ari_seeds = np.zeros(len(tasks))
+        for j in range(len(resolutions)):
+            columns = [i * len(resolutions) + j for i in range(len(seeds))]
+            for a, b in itertools.combinations(columns, 2):
+                ari = adjusted_rand_score(codes[:, a], codes[:, b])
+                ari_seeds[[a, b]] += ari / (len(seeds) - 1)
+        stats["ari_seeds"] = ari_seeds
+
+    logger.info(f"Clustered {len(tasks)} resolution/seed combinations. Labels were added to adata.obsm['{key_added}'].")
+
+    return stats
+
+
+def _igraph_from_adjacency(adjacency: scipy.sparse.csr_matrix) -> Any:
+    """
+    Build an undirected, weighted igraph graph with the edges of the adjacency matrix (as scanpy).
+
+    Parameters
+    ----------
+    adjacency : scipy.sparse.csr_matrix
+        Adjacency matrix, e.g. the connectivities of the neighbor graph.
+
+    Returns
+    -------
+    Any
+        igraph.Graph with the edge weights in the attribute 'weight'.
+    """
+
+    import igraph as ig
+
+    adjacency = adjacency.copy()
+    adjacency.eliminate_zeros()
+    coo = adjacency.tocoo()
+
+    g = ig.Graph(n=adjacency.shape[0], edges=np.column_stack([coo.row, coo.col]).tolist(), directed=False)
+    g.es["weight"] = coo.data.astype(np.float64)
+
+    return g
+
+
+class _IgraphRNG:
+    """
+    Random number generator for igraph based on a numpy RandomState (as used by scanpy).
+
+    Parameters
+    ----------
+    seed : int
+        Seed of the RandomState.
+    """
+
+    def __init__(self, seed: int) -> None:
+        self._rng = np.random.RandomState(seed)
+
+    def getrandbits(self, k: int) -> int:
+        """Return an integer with k random bits."""
+        return self._rng.tomaxint() & ((1 << k) - 1)
+
+    def randint(self, a: int, b: int) -> int:
+        """Return a random integer in [a, b]."""
+        return self._rng.randint(a, b + 1)
+
+    def __getattr__(self, attr: str) -> Any:
+        """Use the RandomState for the other methods required by igraph."""
+        return getattr(self._rng, "normal" if attr == "gauss" else attr)
+
+
+@contextmanager
+def _igraph_random_state(seed: int) -> Iterator[None]:
+    """
+    Set the random number generator of igraph to a seeded generator and restore the default afterwards.
+
+    The generator is the same as in sc.tl.leiden, so clusterings with the same seed are equal.
+
+    Parameters
+    ----------
+    seed : int
+        Random seed.
+
+    Yields
+    ------
+    None
+        Context with the seeded generator.
+    """
+
+    import igraph as ig
+
+    try:
+        ig.set_random_number_generator(_IgraphRNG(seed))
+        yield
+    finally:
+        ig.set_random_number_generator(random)
+
+
+def _cluster_graph(g: Any, method: str, resolution: float | int, seed: int, n_iterations: int) -> np.ndarray:
+    """
+    Cluster an igraph graph with leiden or louvain.
+
+    Parameters
+    ----------
+    g : Any
+        igraph.Graph with the edge weights in the attribute 'weight'.
+    method : str
+        Either "leiden" (igraph implementation with modularity) or "louvain" (igraph multilevel algorithm).
+    resolution : float | int
+        Resolution of the clustering.
+    seed : int
+        Random seed.
+    n_iterations : int
+        Number of iterations of the leiden algorithm.
+
+    Returns
+    -------
+    np.ndarray
+        Cluster membership of each vertex as integer codes.
+    """
+
+    with _igraph_random_state(seed):
+        if method == "leiden":
+            part = g.community_leiden(objective_function="modularity", weights="weight", resolution=resolution, n_iterations=n_iterations)
+        else:
+            part = g.community_multilevel(weights="weight", resolution=resolution)
+
+    return np.asarray(part.membership, dtype=np.int32)
+
+
+def _cluster_tasks(g: Any,
+                   method: str,
+                   tasks: list[Tuple[int, float | int]],
+                   n_iterations: int) -> list[Tuple[np.ndarray, float]]:
+    """
+    Cluster a graph for several seeds and resolutions.
+
+    Parameters
+    ----------
+    g : Any
+        igraph.Graph with the edge weights in the attribute 'weight'.
+    method : str
+        Either "leiden" or "louvain".
+    tasks : list[Tuple[int, float | int]]
+        Seed and resolution of each clustering.
+    n_iterations : int
+        Number of iterations of the leiden algorithm.
+
+    Returns
+    -------
+    list[Tuple[np.ndarray, float]]
+        Cluster membership and runtime in seconds per task.
+    """
+
+    results = []
+    for seed, resolution in tasks:
+        start = time.time()
+        membership = _cluster_graph(g, method, resolution, seed, n_iterations)
+        results.append((membership, time.time() - start))
+
+    return results
+
+
+def _sweep_job(spec: dict[str, Any],
+               method: str,
+               tasks: list[Tuple[int, float | int]],
+               n_iterations: int) -> list[Tuple[np.ndarray, float]]:
+    """
+    Cluster the graph in shared memory for several seeds and resolutions (run within worker processes).
+
+    Parameters
+    ----------
+    spec : dict[str, Any]
+        Description of the shared adjacency matrix as returned by `utils.multiprocessing.share_matrix`.
+    method : str
+        Either "leiden" or "louvain".
+    tasks : list[Tuple[int, float | int]]
+        Seed and resolution of each clustering.
+    n_iterations : int
+        Number of iterations of the leiden algorithm.
+
+    Returns
+    -------
+    list[Tuple[np.ndarray, float]]
+        Cluster membership and runtime in seconds per task.
+    """
+
+    adjacency, handles = utils.multiprocessing.load_shared_matrix(spec)
+    try:
+        g = _igraph_from_adjacency(adjacency)  # copies the edges into igraph
+        del adjacency
+    finally:
+        utils.multiprocessing.release_shared(handles)
+
+    return _cluster_tasks(g, method, tasks, n_iterations)
+
+
+def gini(x: npt.ArrayLike) -> float | npt.NDArray[np.float64]:
     """
     Calculate the Gini coefficient of a numpy array.
 
     Parameters
     ----------
     x : npt.ArrayLike
-        Array to calculate Gini coefficient for.
+        Array to calculate Gini coefficient for. For a 2D array, the coefficients of each column are calculated.
 
     Returns
     -------
-    float
-        Gini coefficient.
+    float | npt.NDArray[np.float64]
+        Gini coefficient (per column for a 2D array).
     """
-    total = 0
-    for i, xi in enumerate(x[:-1], 1):
-        total += np.sum(np.abs(xi - x[i:]))
 
-    return total / (len(x)**2 * np.mean(x))
+    # sum_{i<j} |x_i - x_j| = sum_i (2i - n - 1) * x_(i) for the values sorted ascending (i = 1..n)
+    x = np.sort(np.asarray(x, dtype=np.float64), axis=0)
+    n = x.shape[0]
+    weights = 2 * np.arange(1, n + 1) - n - 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coefficients = (weights @ (x - x[0])) / (n * x.sum(axis=0))  # weights sum to 0; subtracting the minimum keeps equal values exact
+
+    return coefficients if coefficients.ndim > 0 else float(coefficients)
 
 
 @deco.log_anndata
-def calc_ragi(adata: sc.AnnData, condition_column: str = 'clustering', binary_layer: Optional[str] = None) -> Tuple[sc.AnnData, np.float64]:
+def calc_ragi(adata: sc.AnnData,
+              condition_column: str = 'clustering',
+              binary_layer: Optional[str] = None,
+              inplace: bool = False) -> Tuple[sc.AnnData, np.float64]:
     """
     Calculate the RAGI score over all clusters in the adata.
 
@@ -167,7 +481,7 @@ def calc_ragi(adata: sc.AnnData, condition_column: str = 'clustering', binary_la
     The score is the mean of the Gini coefficients of the gene enrichments across the clusters.
     The functions uses binary sparse matrices ONLY. If the data is not binary, use `sctoolbox.utils.binarize`.
     Binary layers can be selected using the `binary_layer` parameter.
-    The adata.var table also needs the total counts for each gene.
+    The adata.var table also needs the total counts for each gene. If not available, the counts are summed from the matrix.
 
     Parameters
     ----------
@@ -176,74 +490,58 @@ def calc_ragi(adata: sc.AnnData, condition_column: str = 'clustering', binary_la
     condition_column : str
         Column in `adata.obs` to use for clustering.
     binary_layer : Optional[str], default None
-        Layer in `adata.layers` to use for calculating gene enrichment. If None, the raw layer is used.
+        Layer in `adata.layers` to use for calculating gene enrichment. If None, adata.X is used.
+    inplace : bool, default False
+        Whether to add the columns to adata.var in place instead of to a copy of adata.
 
     Returns
     -------
     Tuple[sc.AnnData, np.float64]
         Annotated data matrix with the Gini coefficients score in `adata.var` and RAGI score.
+
+    Raises
+    ------
+    KeyError
+        If the binary layer is not found in adata.layers.
     """
 
-    # copy adata
-    adata_copy = adata.copy()
+    if binary_layer is not None and binary_layer not in adata.layers:
+        raise KeyError(f"Binary layer '{binary_layer}' is not available in adata.layers.")
+    mat = adata.X if binary_layer is None else adata.layers[binary_layer]
 
-    # check if total_counts is in adata.var
-    if 'total_counts' not in adata_copy.var:
-        adata_copy.var["total_counts"] = adata_copy.X.sum(axis=1)
-
-    # get conditions
-    conditions = adata_copy.obs[condition_column].unique()
-    enrichment_columns = []
-
-    # loop over conditions
-    for cond in conditions:
-
-        # slice by condition
-        adata_slice = adata_copy.obs_names[adata_copy.obs[condition_column] == cond]  # Check if string works
-        subdata = adata_copy[adata_slice, :].copy()
-        # select all peaks available in the cluster
-        # check if binary layer is set
-        if binary_layer:
-            # check if binary layer is available
-            if binary_layer in subdata.layers.keys():
-                # count gene occurence
-                genes = subdata.var[subdata.layers[binary_layer].sum(axis=0).A1 > 1].copy()
-
-                # count total genes
-                gene_counts = subdata.layers[binary_layer].sum(axis=0).A1[
-                    subdata.layers[binary_layer].sum(axis=0).A1 > 1].copy()
-            else:
-                print('binary layer not available!')
-        else:
-            # count gene occurence
-            genes = subdata.var[subdata.X.sum(axis=0).A1 > 1].copy()
-            # count total genes
-            gene_counts = subdata.X.sum(axis=0).A1[subdata.X.sum(axis=0).A1 > 1].copy()
-
-        # add counts/cluster to genes
-        genes.loc[:, 'cluster_counts_' + str(cond)] = gene_counts
-        # calc enrichment
-        genes.loc[:, 'enrichment_' + str(cond)] = genes['cluster_counts_' + str(cond)] / genes['total_counts']
-
-        # remove old tables
-        # join results
-        adata_copy.var = adata_copy.var.join(genes['cluster_counts_' + str(cond)])
-        adata_copy.var = adata_copy.var.join(genes['enrichment_' + str(cond)])
-        # add column names to list
-        enrichment_columns.append('enrichment_' + str(cond))
-
-    # get enrichment values
-    enrichments = adata_copy.var[enrichment_columns].values
-    enrichments[np.isnan(enrichments)] = 0
-
-    # calculate gini coefficients
-    gini_coefficients = []
-    for enrichment in enrichments:
-        gini_coefficients.append(gini(enrichment))
-
-    adata_copy.var[condition_column + '_' + 'gini'] = gini_coefficients
+    # Counts of all clusters x features in one product
+    indicator, categories = utils.adata.get_group_indicator(adata, condition_column)
+    conditions = [cond for cond in adata.obs[condition_column].unique() if not pd.isna(cond)]
+    indicator = indicator[categories.get_indexer(conditions)]  # clusters in order of appearance
+
+    counts = indicator @ mat
+    counts = counts.toarray() if scipy.sparse.issparse(counts) else np.asarray(counts)
+
+    if 'total_counts' in adata.var:
+        total_counts = adata.var["total_counts"].to_numpy(dtype=np.float64)
+    else:
+        total_counts = np.asarray(mat.sum(axis=0)).ravel().astype(np.float64)
+
+    # Enrichment of features found more than once in a cluster
+    detected = counts > 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        enrichments = np.where(detected, counts / total_counts[None, :], 0)
+
+    gini_coefficients = gini(enrichments)
+
+    # Write all columns to var at once
+    columns = {}
+    for i, cond in enumerate(conditions):
+        columns['cluster_counts_' + str(cond)] = np.where(detected[i], counts[i], np.nan)
+        columns['enrichment_' + str(cond)] = np.where(detected[i], enrichments[i], np.nan)
+    columns[condition_column + '_' + 'gini'] = gini_coefficients
+    new_columns = pd.DataFrame(columns, index=adata.var.index)
+
+    if not inplace:
+        adata = adata.copy()
+    adata.var = pd.concat([adata.var.drop(columns=new_columns.columns, errors="ignore"), new_columns], axis=1)
 
     # calculate ragi score
     ragi_score = np.mean(gini_coefficients)
 
-    return adata_copy, ragi_score
+    return adata, ragi_score
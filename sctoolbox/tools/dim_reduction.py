@@ -1,4 +1,5 @@
 """Tools for dimensionality reduction with PCA/SVD."""
+import copy
 import numpy as np
 import scanpy as sc
 import scipy
@@ -8,7 +9,7 @@ from kneed import KneeLocator
 import deprecation
 from sctoolbox import __version__
 
-from beartype.typing import Optional, Any, Literal, List, Union
+from beartype.typing import Optional, Any, Literal, List, Union, Tuple
 from beartype import beartype
 
 import sctoolbox.tools.embedding as scem
@@ -26,10 +27,15 @@ logger = settings.logger
 def compute_PCA(anndata: sc.AnnData,
                 mask_var: Optional[str | List] = "highly_variable",
                 inplace: bool = False,
+                chunk_size: Optional[int] = None,
                 **kwargs: Any) -> Optional[sc.AnnData]:
     """
     Compute a principal component analysis.
 
+    If 'chunk_size' is given or the anndata object is backed, the PCA is computed out-of-core: blocks of rows of the masked
+    features are streamed through a randomized SVD with implicit centering, so neither the full matrix nor a dense copy is loaded.
+    The feature means are additionally stored in .uns['pca']['mean'] to project new cells with project_PCA.
+
     Parameters
     ----------
     anndata : sc.AnnData
@@ -38,20 +44,35 @@ def compute_PCA(anndata: sc.AnnData,
         To run only on a certain set of genes given by a boolean array or a string referring to an array in var. By default, uses .var['highly_variable'] if available, else everything.
     inplace : bool, default False
         Whether the anndata object is modified inplace.
+    chunk_size : Optional[int], default None
+        Number of rows per block for the out-of-core PCA. If None, scanpy.pp.pca is used for in-memory objects and blocks of 10000 rows for backed objects.
     **kwargs : Any
-        Additional parameters forwarded to scanpy.pp.pca().
+        Additional parameters forwarded to scanpy.pp.pca(). The out-of-core PCA supports 'n_comps', 'zero_center', 'random_state', 'n_oversamples' and 'n_iter'.
 
     Returns
     -------
     Optional[sc.AnnData]
         Returns anndata object with PCA components. Or None if inplace = True.
+
+    Raises
+    ------
+    ValueError
+        If a backed anndata object should be copied.
     """
 
+    if anndata.isbacked:
+        if not inplace:
+            raise ValueError("Copying a backed anndata object would load the full matrix. Please set inplace=True.")
+        chunk_size = 10000 if chunk_size is None else chunk_size
+
     adata_m = anndata if inplace else anndata.copy()
 
     # Computing PCA
     logger.info("Computing PCA")
-    sc.pp.pca(adata_m, mask_var=mask_var, **kwargs)
+    if chunk_size is None:
+        sc.pp.pca(adata_m, mask_var=mask_var, **kwargs)
+    else:
+        _chunked_pca(adata_m, mask_var=mask_var, chunk_size=chunk_size, **kwargs)
 
     # Adding info in anndata.uns["infoprocess"]
     # cr.build_infor(adata_m, "Scanpy computed PCA", "use_highly_variable= " + str(use_highly_variable), inplace=True)
@@ -60,11 +81,236 @@ def compute_PCA(anndata: sc.AnnData,
         return adata_m
 
 
+@beartype
+def _chunked_pca(adata: sc.AnnData,
+                 mask_var: Optional[str | List] = "highly_variable",
+                 chunk_size: int = 10000,
+                 n_comps: int = 50,
+                 zero_center: bool = True,
+                 random_state: int = 0,
+                 n_oversamples: int = 10,
+                 n_iter: int = 4) -> None:
+    """
+    Compute a PCA over blocks of rows of .X and store it like scanpy.pp.pca.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object, can be backed.
+    mask_var : Optional[str | List], default 'highly_variable'
+        Boolean mask or column in .var of the features to use. 'highly_variable' uses all features if the column is not available.
+    chunk_size : int, default 10000
+        Number of rows per block.
+    n_comps : int, default 50
+        Number of principal components.
+    zero_center : bool, default True
+        Center the features implicitly. If False, a truncated SVD of the uncentered matrix is computed.
+    random_state : int, default 0
+        Seed for the randomized SVD.
+    n_oversamples : int, default 10
+        Number of additional random vectors.
+    n_iter : int, default 4
+        Number of power iterations.
+    """
+
+    if isinstance(mask_var, str):
+        mask = adata.var[mask_var].to_numpy(dtype=bool) if mask_var != "highly_variable" or mask_var in adata.var else None
+    else:
+        mask = None if mask_var is None else np.asarray(mask_var, dtype=bool)
+    columns = None if mask is None else np.where(mask)[0]
+
+    mean, var = chunked_mean_var(adata.X, columns, chunk_size)
+    n_comps = min(n_comps, adata.n_obs - 1, len(mean))
+
+    _, s, vt = randomized_svd(adata.X, n_comps, center=mean if zero_center else None, n_oversamples=n_oversamples, n_iter=n_iter,
+                              random_state=random_state, columns=columns, chunk_size=chunk_size)
+
+    # Project onto the components, so the embedding is consistent with the loadings (as in scanpy)
+    x_pca = project_blocks(adata.X, columns, vt.T, mean if zero_center else np.zeros(len(mean)), chunk_size)
+
+    if zero_center:
+        variance = s ** 2 / (adata.n_obs - 1)
+        total_variance = var.sum()
+    else:  # same as sklearn TruncatedSVD used by scanpy
+        variance = x_pca.var(axis=0)
+        total_variance = (var * (adata.n_obs - 1) / adata.n_obs).sum()
+
+    loadings, feature_mean = vt.T, mean
+    if columns is not None:
+        loadings = np.zeros((adata.n_vars, n_comps))
+        loadings[columns] = vt.T
+        feature_mean = np.zeros(adata.n_vars)
+        feature_mean[columns] = mean
+
+    adata.obsm["X_pca"] = x_pca.astype(np.float32)
+    adata.varm["PCs"] = loadings
+    adata.uns["pca"] = {"params": {"zero_center": zero_center,
+                                   "use_highly_variable": mask_var == "highly_variable" and mask is not None,
+                                   "mask_var": mask_var if mask is not None else None},
+                        "variance": variance,
+                        "variance_ratio": variance / total_variance,
+                        "mean": feature_mean}
+
+
+@beartype
+def chunked_mean_var(mat: Any,
+                     columns: Optional[np.ndarray],
+                     chunk_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the mean and variance (ddof=1) per column over blocks of rows.
+
+    Parameters
+    ----------
+    mat : Any
+        Matrix supporting slicing of rows, e.g. a numpy array, scipy.sparse matrix or backed .X.
+    columns : Optional[np.ndarray]
+        Indices of the columns to use. If None, all columns are used.
+    chunk_size : int
+        Number of rows per block.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Mean and variance of each column.
+    """
+
+    n_obs = mat.shape[0]
+    n_vars = mat.shape[1] if columns is None else len(columns)
+    sums = np.zeros(n_vars)
+    squares = np.zeros(n_vars)
+
+    for start in range(0, n_obs, chunk_size):
+        block = mat[start:start + chunk_size]
+        block = block if columns is None else block[:, columns]
+        sums += np.asarray(block.sum(axis=0, dtype=np.float64)).ravel()
+        squares += np.asarray(block.multiply(block).sum(axis=0) if scipy.sparse.issparse(block) else (block.astype(np.float64) ** 2).sum(axis=0)).ravel()
+
+    mean = sums / n_obs
+    var = (squares - n_obs * mean ** 2) / (n_obs - 1)
+
+    return mean, var
+
+
+@beartype
+def project_blocks(mat: Any,
+                   columns: Optional[np.ndarray],
+                   components: np.ndarray,
+                   mean: np.ndarray,
+                   chunk_size: int) -> np.ndarray:
+    """
+    Compute (mat[:, columns] - mean) @ components over blocks of rows.
+
+    Parameters
+    ----------
+    mat : Any
+        Matrix supporting slicing of rows, e.g. a numpy array, scipy.sparse matrix or backed .X.
+    columns : Optional[np.ndarray]
+        Indices of the columns matching the rows of components. If None, all columns are used.
+    components : np.ndarray
+        Loadings of shape (n_columns, n_comps).
+    mean : np.ndarray
+        Mean of each column to subtract.
+    chunk_size : int
+        Number of rows per block.
+
+    Returns
+    -------
+    np.ndarray
+        Projected matrix of shape (n_obs, n_comps).
+    """
+
+    offset = mean @ components
+    projected = np.empty((mat.shape[0], components.shape[1]))
+    for start in range(0, mat.shape[0], chunk_size):
+        block = mat[start:start + chunk_size]
+        block = block if columns is None else block[:, columns]
+        projected[start:start + chunk_size] = np.asarray(block @ components) - offset
+
+    return projected
+
+
+@deco.log_anndata
+@beartype
+def project_PCA(anndata: sc.AnnData,
+                reference: sc.AnnData,
+                inplace: bool = False,
+                chunk_size: int = 10000) -> Optional[sc.AnnData]:
+    """
+    Project cells onto the principal components of a reference without refitting.
+
+    The features of the reference with non-zero loadings are matched by name, centered with the feature means of
+    the reference and multiplied with the loadings block by block.
+
+    Parameters
+    ----------
+    anndata : sc.AnnData
+        Anndata object with the new cells, normalized like the reference. Can be backed.
+    reference : sc.AnnData
+        Anndata object with a PCA in .varm['PCs'] and .uns['pca'], e.g. computed with compute_PCA.
+    inplace : bool, default False
+        Whether the anndata object is modified inplace.
+    chunk_size : int, default 10000
+        Number of rows per block.
+
+    Returns
+    -------
+    Optional[sc.AnnData]
+        Anndata object with .obsm['X_pca'], .varm['PCs'] and .uns['pca'] of the reference. Or None if inplace = True.
+
+    Raises
+    ------
+    KeyError
+        If the reference does not contain a PCA.
+    ValueError
+        If features of the reference are missing in anndata or if a backed anndata object should be copied.
+    """
+
+    if "PCs" not in reference.varm or "pca" not in reference.uns:
+        raise KeyError("The reference does not contain a PCA. Please run compute_PCA first.")
+    if anndata.isbacked and not inplace:
+        raise ValueError("Copying a backed anndata object would load the full matrix. Please set inplace=True.")
+
+    loadings = np.asarray(reference.varm["PCs"])
+    used = np.where(np.any(loadings != 0, axis=1))[0]
+    columns = anndata.var_names.get_indexer(reference.var_names[used])
+    if np.any(columns < 0):
+        raise ValueError(f"{np.sum(columns < 0)} features of the reference are not found in anndata.var_names.")
+
+    # Reference means of the used features (stored by the out-of-core PCA)
+    if not reference.uns["pca"].get("params", {}).get("zero_center", True):
+        mean = np.zeros(len(used))
+    elif "mean" in reference.uns["pca"]:
+        mean = np.asarray(reference.uns["pca"]["mean"])[used]
+    else:
+        mean, _ = chunked_mean_var(reference.X, used, chunk_size)
+
+    adata_m = anndata if inplace else anndata.copy()
+
+    logger.info("Projecting cells onto the reference PCA")
+    components = loadings[used]
+    x_pca = project_blocks(adata_m.X, columns, components, mean, chunk_size)
+
+    projected = np.zeros((adata_m.n_vars, components.shape[1]))
+    projected[columns] = components
+
+    adata_m.obsm["X_pca"] = x_pca.astype(np.float32)
+    adata_m.varm["PCs"] = projected
+    adata_m.uns["pca"] = copy.deepcopy(reference.uns["pca"])
+
+    if not inplace:
+        return adata_m
+
+
 @beartype
 def lsi(data: sc.AnnData,
         scale_embeddings: bool = True,
         n_comps: int = 50,
-        use_highly_variable: bool = False) -> None:
+        use_highly_variable: bool = False,
+        solver: Literal["arpack", "randomized"] = "arpack",
+        n_oversamples: int = 10,
+        n_iter: int = 4,
+        chunk_size: Optional[int] = None,
+        random_state: int = 0) -> None:
     """
     Run Latent Semantic Indexing for dimensionality reduction.
 
@@ -81,6 +327,20 @@ def lsi(data: sc.AnnData,
         Number of components to calculate with SVD.
     use_highly_variable : bool, default True
         If true, use highly variable genes to compute LSI.
+    solver : Literal["arpack", "randomized"], default "arpack"
+        SVD solver. "arpack" uses scipy.sparse.linalg.svds. "randomized" uses a randomized SVD with oversampling and power iterations,
+        which can stream over blocks of rows of a backed .X (see 'chunk_size'). Without chunk_size, the highly variable features
+        are copied once; with chunk_size, they are selected per block of rows.
+        Backed anndata objects always use the randomized solver.
+    n_oversamples : int, default 10
+        Number of additional random vectors for the randomized solver.
+    n_iter : int, default 4
+        Number of power iterations for the randomized solver.
+    chunk_size : Optional[int], default None
+        Number of rows per block for the randomized solver. If None, blocks of 10000 rows are used for backed objects and
+        the full matrix otherwise.
+    random_state : int, default 0
+        Seed for the randomized solver.
 
     Raises
     ------
@@ -98,20 +358,32 @@ def lsi(data: sc.AnnData,
     if use_highly_variable:
         if "highly_variable" not in adata.var:
             raise ValueError("Highly variable genes not found in adata.var['highly_variable'].")
-        adata_comp = adata[:, adata.var['highly_variable']]
+        columns = np.where(adata.var['highly_variable'])[0]
     else:
-        adata_comp = adata
+        columns = None
+
+    if adata.isbacked:
+        if solver != "randomized":
+            logger.info("Using the randomized solver for backed anndata.")
+        solver = "randomized"
+        chunk_size = 10000 if chunk_size is None else chunk_size
 
     # In an unlikely scnenario when there are less 50 features, set n_comps to that value
-    n_comps = min(n_comps, adata_comp.X.shape[1])
+    n_features = adata.n_vars if columns is None else len(columns)
+    n_comps = min(n_comps, n_features)
 
     # logging.info("Performing SVD")
-    cell_embeddings, svalues, peaks_loadings = svds(adata_comp.X, k=n_comps)
+    if solver == "randomized":
+        cell_embeddings, svalues, peaks_loadings = randomized_svd(adata.X, n_comps, n_oversamples=n_oversamples, n_iter=n_iter,
+                                                                  random_state=random_state, columns=columns, chunk_size=chunk_size)
+    else:
+        mat = adata.X if columns is None else adata.X[:, columns]
+        cell_embeddings, svalues, peaks_loadings = svds(mat, k=n_comps)
 
-    # Re-order components in the descending order
-    cell_embeddings = cell_embeddings[:, ::-1]
-    svalues = svalues[::-1]
-    peaks_loadings = peaks_loadings[::-1, :]
+        # Re-order components in the descending order
+        cell_embeddings = cell_embeddings[:, ::-1]
+        svalues = svalues[::-1]
+        peaks_loadings = peaks_loadings[::-1, :]
 
     if scale_embeddings:
         cell_embeddings = (cell_embeddings - cell_embeddings.mean(axis=0)) / cell_embeddings.std(
@@ -119,14 +391,14 @@ def lsi(data: sc.AnnData,
         )
 
     var_explained = np.round(svalues ** 2 / np.sum(svalues ** 2), decimals=3)
-    stdev = svalues / np.sqrt(adata_comp.X.shape[0] - 1)
+    stdev = svalues / np.sqrt(adata.n_obs - 1)
 
     # Add results to adata
     adata.obsm["X_lsi"] = cell_embeddings
     # if highly variable genes are used, only store the loadings for those genes and set the rest to 0
     if use_highly_variable:
         adata.varm["LSI"] = np.zeros(shape=(adata.n_vars, n_comps))
-        adata.varm["LSI"][adata.var['highly_variable']] = peaks_loadings.T
+        adata.varm["LSI"][columns] = peaks_loadings.T
     else:
         adata.varm["LSI"] = peaks_loadings.T
 
@@ -143,7 +415,9 @@ def lsi(data: sc.AnnData,
 
 @beartype
 def apply_svd(adata: sc.AnnData,
-              layer: Optional[str] = None) -> sc.AnnData:
+              layer: Optional[str] = None,
+              n_comps: int = 30,
+              solver: Literal["arpack", "randomized"] = "arpack") -> sc.AnnData:
     """
     Singular value decomposition of anndata object.
 
@@ -153,6 +427,10 @@ def apply_svd(adata: sc.AnnData,
         The anndata object to be decomposed.
     layer : Optional[str], default None
         The layer to be decomposed. If None, the layer is set to "X".
+    n_comps : int, default 30
+        Number of components to calculate.
+    solver : Literal["arpack", "randomized"], default "arpack"
+        Use scipy.sparse.linalg.svds ("arpack") or a randomized SVD ("randomized").
 
     Returns
     -------
@@ -166,12 +444,15 @@ def apply_svd(adata: sc.AnnData,
         mat = adata.layers[layer]
 
     # SVD
-    u, s, v = scipy.sparse.linalg.svds(mat, k=30, which="LM")  # find largest variance
+    if solver == "randomized":
+        u, s, v = randomized_svd(mat, n_comps)
+    else:
+        u, s, v = scipy.sparse.linalg.svds(mat, k=n_comps, which="LM")  # find largest variance
 
-    # u/s/v are reversed in scipy.sparse.linalg.svds:
-    s = s[::-1]
-    u = np.fliplr(u)
-    v = np.flipud(v)
+        # u/s/v are reversed in scipy.sparse.linalg.svds:
+        s = s[::-1]
+        u = np.fliplr(u)
+        v = np.flipud(v)
 
     # Visualize explained variance
     var_explained = np.round(s**2 / np.sum(s**2), decimals=3)
@@ -189,6 +470,101 @@ def apply_svd(adata: sc.AnnData,
     return adata
 
 
+@beartype
+def randomized_svd(mat: np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray | Any,
+                   n_comps: int,
+                   center: Optional[np.ndarray] = None,
+                   scale: Optional[np.ndarray] = None,
+                   n_oversamples: int = 10,
+                   n_iter: int = 4,
+                   random_state: int = 0,
+                   columns: Optional[np.ndarray] = None,
+                   chunk_size: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Randomized truncated SVD of (mat - center) / scale without densifying or copying mat.
+
+    Centering and scaling are applied implicitly within the matrix products, so a sparse matrix stays sparse.
+    With 'chunk_size', every product runs over blocks of rows, so mat can be a backed matrix which is read once per pass.
+
+    Parameters
+    ----------
+    mat : np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray | Any
+        Matrix of shape (n_obs, n_vars) to decompose. With 'chunk_size', any matrix supporting slicing of rows (e.g. a backed .X).
+    n_comps : int
+        Number of components to compute.
+    center : Optional[np.ndarray], default None
+        Per column values to subtract, e.g. the column means for PCA. If None, the matrix is not centered.
+    scale : Optional[np.ndarray], default None
+        Per column values to divide by, e.g. the column standard deviations. If None, the matrix is not scaled.
+    n_oversamples : int, default 10
+        Number of additional random vectors used to sample the range of the matrix.
+    n_iter : int, default 4
+        Number of power iterations to improve the accuracy for slowly decaying singular values.
+    random_state : int, default 0
+        Seed for the random projection.
+    columns : Optional[np.ndarray], default None
+        Indices of the columns to decompose (e.g. highly variable features). center/scale refer to these columns.
+    chunk_size : Optional[int], default None
+        Number of rows per block. If None, the products use the full matrix at once.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Left singular vectors (n_obs x n_comps), singular values (n_comps) and right singular vectors (n_comps x n_vars)
+        in descending order of the singular values.
+    """
+
+    if columns is not None and chunk_size is None:
+        mat = mat[:, columns]  # subset once instead of in every pass
+        columns = None
+
+    n_obs = mat.shape[0]
+    n_vars = mat.shape[1] if columns is None else len(columns)
+    col_scale = np.ones(n_vars) if scale is None else np.where(scale == 0, 1, scale).astype(np.float64)
+    col_center = np.zeros(n_vars) if center is None else np.asarray(center, dtype=np.float64) / col_scale
+
+    def blocks():  # blocks of rows of mat restricted to columns
+        if chunk_size is None:
+            yield slice(None), mat
+            return
+        for start in range(0, n_obs, chunk_size):
+            rows = slice(start, min(start + chunk_size, n_obs))
+            block = mat[rows]
+            yield rows, block if columns is None else block[:, columns]
+
+    def matmul(B):  # (mat - center) / scale @ B
+        scaled = B / col_scale[:, None]
+        out = np.empty((n_obs, B.shape[1]))
+        for rows, block in blocks():
+            out[rows] = np.asarray(block @ scaled)
+        return out - col_center @ B
+
+    def rmatmul(B):  # ((mat - center) / scale).T @ B
+        out = np.zeros((n_vars, B.shape[1]))
+        for rows, block in blocks():
+            out += np.asarray(block.T @ B[rows])
+        return out / col_scale[:, None] - np.outer(col_center, B.sum(axis=0))
+
+    rng = np.random.default_rng(random_state)
+    n_random = min(n_comps + n_oversamples, n_obs, n_vars)
+    Q = matmul(rng.standard_normal((n_vars, n_random)))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(rmatmul(Q))
+        Q = matmul(Q)
+    Q, _ = np.linalg.qr(Q)
+
+    u_small, s, vt = np.linalg.svd(rmatmul(Q).T, full_matrices=False)
+    u = Q @ u_small
+
+    # Flip signs for deterministic output (largest absolute loading is positive)
+    signs = np.sign(vt[np.arange(vt.shape[0]), np.abs(vt).argmax(axis=1)])
+    signs[signs == 0] = 1
+    u, vt = u * signs, vt * signs[:, None]
+
+    return u[:, :n_comps], s[:n_comps], vt[:n_comps]
+
+
 ############################################################################
 #                         Subset number of PCs                             #
 ############################################################################
@@ -2,23 +2,29 @@
 import scanpy as sc
 import multiprocessing as mp
 import pandas as pd
-import itertools
 import scipy
 import re
 import numpy as np
 import warnings
+import time
 
 from beartype.typing import Iterable, Any, Literal, Optional, Tuple
 from beartype import beartype
 
 import sctoolbox.utils as utils
+from sctoolbox._settings import settings
+logger = settings.logger
 
 
 @beartype
-def wrap_umap(adatas: Iterable[sc.AnnData], threads: int = 4, **kwargs: Any) -> None:
+def wrap_umap(adatas: Iterable[sc.AnnData], threads: int = 4, **kwargs: Any) -> list[float]:
     """
     Compute umap for a list of adatas in parallel.
 
+    Only the neighbor graph and the initial positions of each adata are passed to the workers via shared memory,
+    and only the embedding is returned. The initial positions and the optimization each use a generator seeded with
+    'random_state', so the embeddings are not identical to sc.tl.umap with the same 'random_state'.
+
     Parameters
     ----------
     adatas : Iterable[sc.AnnData]
@@ -26,27 +32,280 @@ def wrap_umap(adatas: Iterable[sc.AnnData], threads: int = 4, **kwargs: Any) ->
     threads : int, default 4
         Number of threads to use.
     **kwargs : Any
-        Additional arguments to be passed to sc.tl.umap.
+        Additional arguments to be passed to sc.tl.umap, e.g. 'min_dist', 'spread', 'init_pos' or 'random_state'.
+        Only method 'umap' is supported.
+
+    Returns
+    -------
+    list[float]
+        Runtime in seconds of the UMAP calculation for each adata.
+    """
+
+    adatas = list(adatas)
+    kwargs.pop("copy", None)  # embeddings are always added to the given adatas
+
+    setup = [_umap_setup(adata, **kwargs) for adata in adatas]
+    results = _umap_jobs([(graph, init, params) for graph, init, params in setup], threads=threads, description="Computing UMAPs ")
+
+    # Add results to adatas
+    key_obsm, key_uns = ("X_umap", "umap") if kwargs.get("key_added", None) is None else [kwargs["key_added"]] * 2
+    runtimes = []
+    for adata, (_, _, params), (embedding, runtime) in zip(adatas, setup, results):
+        adata.obsm[key_obsm] = embedding
+        adata.uns[key_uns] = {"params": {"a": params["a"], "b": params["b"]}}
+        runtimes.append(runtime)
+
+    logger.debug(f"UMAP runtimes (s): {', '.join(f'{r:.1f}' for r in runtimes)}")
+
+    return runtimes
+
+
+@beartype
+def _umap_setup(adata: sc.AnnData,
+                min_dist: int | float = 0.5,
+                spread: int | float = 1.0,
+                n_components: int = 2,
+                maxiter: Optional[int] = None,
+                alpha: int | float = 1.0,
+                gamma: int | float = 1.0,
+                negative_sample_rate: int = 5,
+                init_pos: str | np.ndarray = "spectral",
+                random_state: int = 0,
+                a: Optional[float] = None,
+                b: Optional[float] = None,
+                method: str = "umap",
+                neighbors_key: Optional[str] = None,
+                key_added: Optional[str] = None,
+                copy: bool = False) -> Tuple[scipy.sparse.csr_matrix, np.ndarray, dict[str, Any]]:
+    """
+    Get the neighbor graph, initial positions and optimization parameters for a UMAP as in sc.tl.umap.
+
+    The initial positions are computed by sc.tl.umap without optimization epochs. They only depend on the graph
+    and can be reused for different 'min_dist'/'spread' values.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object with computed neighbors.
+    min_dist : int | float, default 0.5
+        See sc.tl.umap.
+    spread : int | float, default 1.0
+        See sc.tl.umap.
+    n_components : int, default 2
+        See sc.tl.umap.
+    maxiter : Optional[int], default None
+        See sc.tl.umap.
+    alpha : int | float, default 1.0
+        See sc.tl.umap.
+    gamma : int | float, default 1.0
+        See sc.tl.umap.
+    negative_sample_rate : int, default 5
+        See sc.tl.umap.
+    init_pos : str | np.ndarray, default "spectral"
+        See sc.tl.umap. Either a key in adata.obsm, "paga", "spectral", "random" or an array of positions.
+    random_state : int, default 0
+        See sc.tl.umap.
+    a : Optional[float], default None
+        See sc.tl.umap.
+    b : Optional[float], default None
+        See sc.tl.umap.
+    method : str, default "umap"
+        See sc.tl.umap. Only "umap" is supported.
+    neighbors_key : Optional[str], default None
+        See sc.tl.umap.
+    key_added : Optional[str], default None
+        See sc.tl.umap. Not used for the setup; the caller adds the embedding.
+    copy : bool, default False
+        See sc.tl.umap. Not used for the setup; the caller adds the embedding.
+
+    Returns
+    -------
+    Tuple[scipy.sparse.csr_matrix, np.ndarray, dict[str, Any]]
+        Connectivities graph, initial positions (float32) and parameters for `_umap_embedding`.
+
+    Raises
+    ------
+    ValueError
+        If neighbors were not computed or method is not "umap".
+    """
+
+    from umap.umap_ import find_ab_params
+
+    if method != "umap":
+        raise ValueError(f"UMAP method '{method}' is not supported. Please use sc.tl.umap instead.")
+
+    neighbors_key = "neighbors" if neighbors_key is None else neighbors_key
+    if neighbors_key not in adata.uns:
+        raise ValueError(f"Did not find .uns['{neighbors_key}']. Run `sc.pp.neighbors` first.")
+    graph = scipy.sparse.csr_matrix(adata.obsp[adata.uns[neighbors_key].get("connectivities_key", "connectivities")])
+
+    if isinstance(init_pos, str):
+        # sc.tl.umap with 0 epochs returns the (rescaled) initial positions, which are not changed by a second rescaling
+        init_adata = sc.AnnData(X=adata.X, obs=adata.obs, obsm=dict(adata.obsm), obsp=dict(adata.obsp), uns=dict(adata.uns))
+        sc.tl.umap(init_adata, n_components=n_components, maxiter=0, init_pos=init_pos, random_state=random_state,
+                   neighbors_key=neighbors_key)
+        init = np.asarray(init_adata.obsm["X_umap"], dtype=np.float32)
+    else:
+        init = np.asarray(init_pos, dtype=np.float32)
+
+    if a is None or b is None:
+        a, b = find_ab_params(spread, min_dist)
+
+    default_epochs = 500 if graph.shape[0] <= 10000 else 200
+    params = {"a": a, "b": b, "n_epochs": default_epochs if maxiter is None else maxiter, "alpha": alpha, "gamma": gamma,
+              "negative_sample_rate": negative_sample_rate, "random_state": random_state}
+
+    return graph, np.ascontiguousarray(init), params
+
+
+@beartype
+def _umap_embedding(graph: scipy.sparse.csr_matrix,
+                    init: np.ndarray,
+                    a: float,
+                    b: float,
+                    n_epochs: int,
+                    alpha: int | float,
+                    gamma: int | float,
+                    negative_sample_rate: int,
+                    random_state: int) -> np.ndarray:
+    """
+    Optimize a UMAP embedding of the graph starting from the initial positions.
+
+    Parameters
+    ----------
+    graph : scipy.sparse.csr_matrix
+        Connectivities graph of the cells.
+    init : np.ndarray
+        Initial positions of shape (n_obs, n_components).
+    a : float
+        Parameter 'a' of the UMAP curve (see sc.tl.umap).
+    b : float
+        Parameter 'b' of the UMAP curve (see sc.tl.umap).
+    n_epochs : int
+        Number of optimization epochs.
+    alpha : int | float
+        Initial learning rate.
+    gamma : int | float
+        Weight of the negative samples.
+    negative_sample_rate : int
+        Number of negative samples per positive sample.
+    random_state : int
+        Seed of the optimization.
+
+    Returns
+    -------
+    np.ndarray
+        Embedding of shape (n_obs, n_components).
+    """
+
+    from umap.umap_ import simplicial_set_embedding
+    from sklearn.utils import check_random_state
+
+    embedding, _ = simplicial_set_embedding(data=None,
+                                            graph=graph.tocoo(copy=True),  # the graph is pruned in place
+                                            n_components=init.shape[1],
+                                            initial_alpha=alpha,
+                                            a=a,
+                                            b=b,
+                                            gamma=gamma,
+                                            negative_sample_rate=negative_sample_rate,
+                                            n_epochs=n_epochs,
+                                            init=init,
+                                            random_state=check_random_state(random_state),
+                                            metric="euclidean",
+                                            metric_kwds={},
+                                            densmap=False,
+                                            densmap_kwds={},
+                                            output_dens=False)
+
+    return embedding
+
+
+def _umap_job(graph_spec: dict[str, Any], init_spec: dict[str, Any], params: dict[str, Any]) -> Tuple[np.ndarray, float]:
+    """
+    Compute one UMAP from a graph and initial positions in shared memory (run within worker processes).
+
+    Parameters
+    ----------
+    graph_spec : dict[str, Any]
+        Description of the shared connectivities graph as returned by `utils.multiprocessing.share_matrix`.
+    init_spec : dict[str, Any]
+        Description of the shared initial positions as returned by `utils.multiprocessing.share_matrix`.
+    params : dict[str, Any]
+        Parameters for `_umap_embedding`.
+
+    Returns
+    -------
+    Tuple[np.ndarray, float]
+        Embedding and runtime in seconds.
+    """
+
+    start = time.time()
+    graph, graph_handles = utils.multiprocessing.load_shared_matrix(graph_spec)
+    init, init_handles = utils.multiprocessing.load_shared_matrix(init_spec)
+    try:
+        embedding = _umap_embedding(graph, init, **params)
+        del graph, init
+    finally:
+        utils.multiprocessing.release_shared(graph_handles)
+        utils.multiprocessing.release_shared(init_handles)
+
+    return embedding, time.time() - start
+
+
+@beartype
+def _umap_jobs(tasks: list[Tuple[scipy.sparse.csr_matrix, np.ndarray, dict[str, Any]]],
+               threads: int = 1,
+               description: str = "Computing UMAPs") -> list[Tuple[np.ndarray, float]]:
     """
+    Compute UMAP embeddings for a list of graphs, initial positions and parameters.
 
-    pool = mp.Pool(threads)
+    With threads > 1, each distinct graph and initial position is copied once into shared memory and the jobs are run in a pool.
 
-    kwargs["copy"] = True  # always copy
+    Parameters
+    ----------
+    tasks : list[Tuple[scipy.sparse.csr_matrix, np.ndarray, dict[str, Any]]]
+        Graph, initial positions and parameters as returned by `_umap_setup`.
+    threads : int, default 1
+        Number of processes to use.
+    description : str, default "Computing UMAPs"
+        Description of the progress bar.
 
-    jobs = []
-    for i, adata in enumerate(adatas):
-        adata_minimal = utils.adata.get_minimal_adata(adata)
-        job = pool.apply_async(sc.tl.umap, args=(adata_minimal, ), kwds=kwargs)
-        jobs.append(job)
-    pool.close()
+    Returns
+    -------
+    list[Tuple[np.ndarray, float]]
+        Embedding and runtime in seconds per task.
+    """
 
-    utils.multiprocessing.monitor_jobs(jobs, "Computing UMAPs ")
-    pool.join()
+    if threads <= 1:
+        results = []
+        for graph, init, params in tasks:
+            start = time.time()
+            results.append((_umap_embedding(graph, init, **params), time.time() - start))
+        return results
 
-    # Get results and add to adatas
-    for i, adata in enumerate(adatas):
-        adata_return = jobs[i].get()
-        adata.obsm["X_umap"] = adata_return.obsm["X_umap"]
+    # Share each graph / initial position only once
+    handles = []
+    specs = {}
+    try:
+        for graph, init, _ in tasks:
+            for mat in [graph, init]:
+                if id(mat) not in specs:
+                    mat_handles, specs[id(mat)] = utils.multiprocessing.share_matrix(mat)
+                    handles.extend(mat_handles)
+
+        pool = mp.Pool(min(threads, len(tasks)))
+        jobs = [pool.apply_async(_umap_job, (specs[id(graph)], specs[id(init)], params)) for graph, init, params in tasks]
+        pool.close()
+
+        utils.multiprocessing.monitor_jobs(jobs, description)
+        results = [job.get() for job in jobs]
+        pool.join()
+
+    finally:
+        utils.multiprocessing.release_shared(handles, unlink=True)
+
+    return results
 
 
 @beartype
@@ -96,20 +355,17 @@ def correlation_matrix(adata: sc.AnnData,
 
     # Establish which table to use
     if which == "obs":
-        table = adata.obs.copy()
+        table = adata.obs
         mat = adata.obsm[basis]
     elif which == "var":
         if "pca" not in basis.lower():
             raise ValueError("Correlation with 'var' can only be calculated with PCA components!")
-        table = adata.var.copy()
+        table = adata.var
         mat = adata.varm["PCs"]
 
     # Check that method is available
-    try:
-        corr_method = getattr(scipy.stats, method)
-    except AttributeError:
-        s = f"'{method}' is not a valid method within scipy.stats. Please choose one of pearsonr/spearmanr."
-        raise ValueError(s)
+    if method not in ["spearmanr", "pearsonr"]:
+        raise ValueError(f"'{method}' is not a valid method. Please choose one of pearsonr/spearmanr.")
 
     # Get columns
     numeric_columns = table.select_dtypes(include='number').columns.tolist()
@@ -127,22 +383,68 @@ def correlation_matrix(adata: sc.AnnData,
         comp_columns = [f"PC{i+1}" for i in range(n_components)]  # e.g. PC1, PC2, ...
     else:
         comp_columns = [f"{re.sub('^X_', '', basis.upper())}{i+1}" for i in range(n_components)]  # e.g. UMAP1, UMAP2, ...
-    comp_table = pd.DataFrame(mat[:, :n_components], columns=comp_columns)
-    comp_table[numeric_columns] = table[numeric_columns].reset_index(drop=True)
 
     # Calculate correlation of columns
-    combinations = list(itertools.product(numeric_columns, comp_columns))
+    values = table[numeric_columns].to_numpy(dtype=float, na_value=np.nan)
+    corr, pvalues = _correlate_columns(np.asarray(mat[:, :n_components], dtype=float), values, rank=method == "spearmanr")
+
+    corr_table = pd.DataFrame(corr, index=numeric_columns, columns=comp_columns)
+    pvalue_table = pd.DataFrame(pvalues, index=numeric_columns, columns=comp_columns)
 
-    corr_table = pd.DataFrame(index=numeric_columns, columns=comp_columns, dtype=float)
-    pvalue_table = pd.DataFrame(index=numeric_columns, columns=comp_columns, dtype=float)
-    for row, col in combinations:
-        # remove NaN values and the corresponding values from both lists
-        x = np.vstack([comp_table[row], comp_table[col]])  # stack values of row and column
-        x = x[:, ~np.any(np.isnan(x), axis=0)]  # remove columns with NaN values
+    return corr_table, pvalue_table
 
-        res = corr_method(x[0], x[1])
 
-        corr_table.loc[row, col] = res.statistic
-        pvalue_table.loc[row, col] = res.pvalue
+def _correlate_columns(mat: np.ndarray,
+                       values: np.ndarray,
+                       rank: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Correlate every column of values with every column of mat.
 
-    return corr_table, pvalue_table
+    Rows with NaN in mat are ignored for all pairs, rows with NaN in a column of values are ignored for this column.
+    Columns of values sharing the same NaN rows are correlated with a single product of the standardized matrices.
+
+    Parameters
+    ----------
+    mat : np.ndarray
+        Matrix of shape (n_obs, n_components), e.g. an embedding.
+    values : np.ndarray
+        Matrix of shape (n_obs, n_columns), e.g. numeric columns of .obs.
+    rank : bool, default False
+        Correlate ranks (spearman) instead of values (pearson).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Correlation coefficients and two-sided p-values of shape (n_columns, n_components).
+    """
+
+    corr = np.full((values.shape[1], mat.shape[1]), np.nan)
+    n_valid = np.zeros(values.shape[1])
+
+    # Group columns by their rows with missing values
+    missing = np.isnan(values) | np.isnan(mat).any(axis=1)[:, None]
+    patterns, groups = np.unique(missing.T, axis=0, return_inverse=True)
+
+    for i, pattern in enumerate(patterns):
+        columns = np.where(groups.ravel() == i)[0]
+        x, y = mat[~pattern], values[~pattern][:, columns]
+        if rank:
+            x, y = scipy.stats.rankdata(x, axis=0), scipy.stats.rankdata(y, axis=0)
+
+        # center and scale to unit norm; constant columns give NaN
+        x = x - x.mean(axis=0)
+        y = y - y.mean(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x = x / np.linalg.norm(x, axis=0)
+            y = y / np.linalg.norm(y, axis=0)
+
+        corr[columns] = np.clip(y.T @ x, -1, 1)
+        n_valid[columns] = (~pattern).sum()
+
+    # two-sided p-value of the t-statistic with n - 2 degrees of freedom (as in scipy.stats.pearsonr/spearmanr)
+    df = (n_valid - 2)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = corr * np.sqrt(df / (1 - corr ** 2))
+    pvalues = 2 * scipy.stats.t.sf(np.abs(t), df)
+
+    return corr, pvalues
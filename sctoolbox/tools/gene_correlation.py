@@ -2,17 +2,17 @@
 import pandas as pd
 import numpy as np
 import scanpy as sc
-from scipy.stats import spearmanr
-from scipy.stats import norm
+import multiprocessing as mp
+from scipy import sparse
+from scipy.stats import norm, rankdata
+import scipy.stats
 import statsmodels.api
-from joblib import Parallel, delayed
-from tqdm import tqdm
 
 from beartype import beartype
-from beartype.typing import Optional
+from beartype.typing import Optional, Any, Iterator, Tuple
 
+import sctoolbox.utils as utils
 from sctoolbox.utils.checker import check_columns
-from sctoolbox.utils.adata import get_adata_subsets
 from sctoolbox.plotting.embedding import umap_marker_overview
 from sctoolbox._settings import settings
 logger = settings.logger
@@ -20,30 +20,40 @@ logger = settings.logger
 
 @beartype
 def correlate_conditions(adata: sc.AnnData,
-                         gene: str,
+                         gene: str | list[str],
                          condition_col: str,
                          condition_A: str,
-                         condition_B: str) -> pd.DataFrame:
+                         condition_B: str,
+                         chunk_size: int = 1000,
+                         threads: int = 1) -> pd.DataFrame:
     """
     Calculate the correlation of a gene expression over two conditions and compares the two conditions.
 
+    The cells of each condition are selected by index from the shared matrix, and the correlations of all reference genes
+    are computed together over blocks of genes.
+
     Parameters
     ----------
     adata : sc.AnnData
         Annotated adata object.
-    gene : str
-        Gene of interest.
+    gene : str | list[str]
+        Gene of interest or a list of reference genes.
     condition_col : str
         Column in adata.obs containing conditions.
     condition_A : str
         Name of the first condition.
     condition_B : str
         Name of the second condition.
+    chunk_size : int, default 1000
+        Number of genes per block.
+    threads : int, default 1
+        Number of threads to use for the blocks of genes.
 
     Returns
     -------
     pd.DataFrame
         Dataframe containing the correlation of a gene expression over two conditions.
+        For a list of genes, the tables are concatenated with the reference gene as first level of the index.
 
     Raises
     ------
@@ -51,33 +61,41 @@ def correlate_conditions(adata: sc.AnnData,
         If one or both condition columns are not in adata.obs.
     """
 
-    # Subset adata on conditions
     check_columns(adata.obs, columns=[condition_col], name="adata.obs")
-    adata_subsets = get_adata_subsets(adata, groupby=condition_col)
+    conditions = adata.obs[condition_col].to_numpy()
+    rows = {condition: np.flatnonzero(conditions == condition) for condition in [condition_A, condition_B]}
 
-    if not all(x in adata_subsets.keys() for x in [condition_A, condition_B]):
+    if any(len(idx) == 0 for idx in rows.values()):
         raise ValueError(f"One or both conditions ({condition_A}, {condition_B}]) \
                          could not be found in adata.obs['{condition_col}']")
 
-    # Calculate correlations
-    corr_A_df = correlate_ref_vs_all(adata_subsets[condition_A], gene)
-    corr_B_df = correlate_ref_vs_all(adata_subsets[condition_B], gene)
+    # Calculate correlations of all reference genes per condition
+    ref_genes = [gene] if isinstance(gene, str) else gene
+    corr = _correlate_groups(adata, ref_genes, rows, chunk_size=chunk_size, threads=threads)
 
     # Compare correlations
-    comparison = compare_two_conditons(corr_A_df, corr_B_df,
-                                       adata_subsets[condition_A].shape[1],
-                                       adata_subsets[condition_B].shape[1])
-    return comparison
+    tables = []
+    for i in range(len(ref_genes)):
+        corr_A_df = _correlation_table(corr[condition_A][:, i], len(rows[condition_A]), adata.var.index)
+        corr_B_df = _correlation_table(corr[condition_B][:, i], len(rows[condition_B]), adata.var.index)
+        tables.append(compare_two_conditons(corr_A_df, corr_B_df, len(rows[condition_A]), len(rows[condition_B])))
+
+    if isinstance(gene, str):
+        return tables[0]
+    return pd.concat(tables, keys=ref_genes, names=["reference", adata.var.index.name])
 
 
 @beartype
 def correlate_ref_vs_all(adata: sc.AnnData,
                          ref_gene: str,
                          correlation_threshold: float = 0.4,
-                         save: Optional[str] = None) -> pd.DataFrame:
+                         save: Optional[str] = None,
+                         chunk_size: int = 1000,
+                         threads: int = 1) -> pd.DataFrame:
     """
-    Calculate the correlation of the reference gene vs all other genes.
+    Calculate the spearman correlation of the reference gene vs all other genes.
 
+    The genes are ranked in blocks of columns and correlated with the ranks of the reference by one matrix product per block.
     Additionally, plots umap highlighting correlating gene expression.
 
     Parameters
@@ -91,16 +109,37 @@ def correlate_ref_vs_all(adata: sc.AnnData,
         if plot parameter is set to True.
     save : str, default None
         Path to save the figure to.
+    chunk_size : int, default 1000
+        Number of genes per block.
+    threads : int, default 1
+        Number of threads to use for the blocks of genes.
 
     Returns
     -------
     pd.DataFrame
         Dataframe containing correlation of refrence gene to other genes.
+
+    Raises
+    ------
+    ValueError
+        If ref_gene is not in adata.var.index.
     """
 
-    def spearmanr_of_gene(ref, gene, gene_name):
-        """Get tuple of gene and spearman correlation of gene to reference."""
-        return (gene_name, spearmanr(ref, gene))
+    if ref_gene not in adata.var.index:
+        raise ValueError(f"Gene '{ref_gene}' is not in adata.var.index.")
+
+    logger.info(f"Calculating the correlation to {ref_gene}")
+    corr = _correlate_groups(adata, [ref_gene], {"all": None}, chunk_size=chunk_size, threads=threads)["all"][:, 0]
+    corr_df = _correlation_table(corr, adata.n_obs, adata.var.index)
+
+    if save:
+        to_plot = corr_df[corr_df["correlation"] > correlation_threshold].index.to_list()
+        _ = umap_marker_overview(adata, to_plot, ncols=4, save=save, cbar_label="Relative expr.")
+    return corr_df
+
+
+def _correlation_table(corr: np.ndarray, n_obs: int, index: pd.Index) -> pd.DataFrame:
+    """Build the table of correlate_ref_vs_all from the correlations of all genes with the reference."""
 
     def map_correlation_strength(x):
         """Map correlation to describing strings."""
@@ -119,13 +158,9 @@ def correlate_ref_vs_all(adata: sc.AnnData,
         else:
             raise ValueError("Invalid correlation value.")
 
-    # Get expression values of reference gene
-    ref = adata[:, ref_gene].to_df()[ref_gene]
-
-    logger.info(f"Calculating the correlation to {ref_gene}")
-    results = dict(Parallel(n_jobs=-1)(delayed(spearmanr_of_gene)(ref, adata[:, gene].to_df()[gene], gene) for gene in tqdm(adata.var.index.values.tolist())))
-    corr_df = pd.DataFrame.from_dict(results, orient="index")
-    corr_df.columns = ["correlation", "p-value"]
+    corr_df = pd.DataFrame({"correlation": corr,
+                            "p-value": _correlation_pvalues(corr, n_obs)},
+                           index=index)
 
     # Adjust p-values
     corr_df["padj"] = statsmodels.stats.multitest.multipletests(corr_df["p-value"], method="bonferroni")[1]
@@ -138,9 +173,6 @@ def correlate_ref_vs_all(adata: sc.AnnData,
     # Clean up after nan values
     corr_df.loc[corr_df.isnull().any(axis=1), :] = np.nan
 
-    if save:
-        to_plot = corr_df[corr_df["correlation"] > correlation_threshold].index.to_list()
-        _ = umap_marker_overview(adata, to_plot, ncols=4, save=save, cbar_label="Relative expr.")
     return corr_df
 
 
@@ -169,28 +201,264 @@ def compare_two_conditons(df_cond_A: pd.DataFrame,
         Dataframe containing single correlation and Fischer Z transformation
     """
 
-    def independent_corr(gene_row, n_xy, n_ab):
-        """z-transforms correlation coefficient xy (of n cells) andab (of n2 cells) and p-value of the difference."""
-        if (1 - gene_row['correlation_A']) == 0 or (1 - gene_row['correlation_B']) == 0:
-            return np.nan, np.nan
-        # Fisher's r-to-Z Transformation
-        xy_z = 0.5 * np.log((1 + gene_row['correlation_A']) / (1 - gene_row['correlation_A']))
-        ab_z = 0.5 * np.log((1 + gene_row['correlation_B']) / (1 - gene_row['correlation_B']))
-        # fisher1925 - denominator
-        se_diff_r = np.sqrt(1 / (n_xy - 3) + 1 / (n_ab - 3))
-        # fisher1925 - numerator
-        diff = xy_z - ab_z
-        # fisher1925 - significance test
-        z = abs(diff / se_diff_r)
-        # two-tailed p-value, therefore *2
-        p = (1 - norm.cdf(z)) * 2
-        return z, p
-
     # Join both correlation tables
     df_cond = df_cond_A.join(df_cond_B, lsuffix='_A', rsuffix='_B')
+    corr_A = df_cond['correlation_A'].to_numpy(dtype=float)
+    corr_B = df_cond['correlation_B'].to_numpy(dtype=float)
+
+    # Fisher's r-to-Z Transformation (fisher1925); undefined for a correlation of 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diff = np.arctanh(corr_A) - np.arctanh(corr_B)
+    se_diff_r = np.sqrt(1 / (n_cells_A - 3) + 1 / (n_cells_B - 3))
+    z = np.abs(diff / se_diff_r)
+    z[(corr_A == 1) | (corr_B == 1)] = np.nan
 
-    # Compare both correlation coefficients
-    df_cond['comparison z-score'], df_cond['comparison p-value'] = \
-        zip(*df_cond.apply(independent_corr, args=(n_cells_A, n_cells_B), axis=1))
+    # two-tailed p-value, therefore *2
+    df_cond['comparison z-score'] = z
+    df_cond['comparison p-value'] = norm.sf(z) * 2
 
     return df_cond
+
+
+#####################################################################
+# ------------------ Blockwise rank correlation ------------------- #
+#####################################################################
+
+@beartype
+def _correlate_groups(adata: sc.AnnData,
+                      ref_genes: list[str],
+                      rows: dict[str, Optional[np.ndarray]],
+                      chunk_size: int = 1000,
+                      threads: int = 1) -> dict[str, np.ndarray]:
+    """
+    Compute the spearman correlation of reference genes with all genes within groups of cells.
+
+    The groups are selected by row indices from the shared .X, and the genes are processed in blocks of columns,
+    which are distributed to the threads.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Annotated data matrix.
+    ref_genes : list[str]
+        Reference genes.
+    rows : dict[str, Optional[np.ndarray]]
+        Row indices of the cells per group. None selects all cells.
+    chunk_size : int, default 1000
+        Number of genes per block.
+    threads : int, default 1
+        Number of threads to use for the blocks of genes.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Correlations of shape (n_vars, n_refs) per group.
+
+    Raises
+    ------
+    ValueError
+        If a reference gene is not in adata.var.index.
+    """
+
+    missing = [gene for gene in ref_genes if gene not in adata.var.index]
+    if missing:
+        raise ValueError(f"Gene(s) {missing} are not in adata.var.index.")
+
+    # Ranks of the references within each group
+    mat = adata.X
+    ref = mat[:, adata.var.index.get_indexer(ref_genes)]
+    ref = ref.toarray() if sparse.issparse(ref) else np.asarray(ref)
+    refs = {group: _reference_ranks(ref if idx is None else ref[idx]) for group, idx in rows.items()}
+
+    # Blocks of genes are sliced straight from the columns of a CSC matrix (converted once)
+    if sparse.issparse(mat) and mat.format != "csc":
+        mat = sparse.csc_matrix(mat)
+
+    starts = list(range(0, adata.n_vars, chunk_size))
+    if threads == 1 or len(starts) == 1:
+        blocks = {start: _correlate_block(block, rows, refs) for start, block in _column_blocks(mat, chunk_size)}
+    else:
+        handles, spec = utils.multiprocessing.share_matrix(mat)
+
+        # Share the reference ranks of all groups once as one stacked matrix; only the sums of squares are pickled
+        bounds = np.cumsum([0] + [refs[group][0].shape[0] for group in rows])
+        ref_bounds = {group: (bounds[i], bounds[i + 1]) for i, group in enumerate(rows)}
+        ref_squares = {group: refs[group][1] for group in rows}
+        ref_handles, ref_spec = utils.multiprocessing.share_matrix(np.vstack([refs[group][0] for group in rows]))
+        handles += ref_handles
+        del refs
+
+        try:
+            pool = mp.Pool(threads)
+            jobs = {start: pool.apply_async(_correlation_job, (spec, start, chunk_size, rows, ref_spec, ref_bounds, ref_squares))
+                    for start in starts}
+            pool.close()
+
+            utils.multiprocessing.monitor_jobs(list(jobs.values()), "Correlating blocks of genes")  # waits for all jobs to finish
+            blocks = {start: job.get() for start, job in jobs.items()}
+            pool.join()
+        finally:
+            utils.multiprocessing.release_shared(handles, unlink=True)
+
+    return {group: np.vstack([blocks[start][group] for start in starts]) for group in rows}
+
+
+def _correlation_job(spec: dict[str, Any],
+                     start: int,
+                     chunk_size: int,
+                     rows: dict[str, Optional[np.ndarray]],
+                     ref_spec: dict[str, Any],
+                     ref_bounds: dict[str, Tuple[int, int]],
+                     ref_squares: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Correlate one block of genes of a matrix in shared memory (run within worker processes).
+
+    Parameters
+    ----------
+    spec : dict[str, Any]
+        Description of the shared matrix as returned by `utils.multiprocessing.share_matrix`.
+    start : int
+        Index of the first gene of the block.
+    chunk_size : int
+        Number of genes per block.
+    rows : dict[str, Optional[np.ndarray]]
+        Row indices of the cells per group. None selects all cells.
+    ref_spec : dict[str, Any]
+        Description of the shared reference ranks of all groups, stacked in the order of rows.
+    ref_bounds : dict[str, Tuple[int, int]]
+        First and last (exclusive) row of the reference ranks of each group in the stacked matrix.
+    ref_squares : dict[str, np.ndarray]
+        Sum of squares of the reference ranks per group.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Correlations of shape (n_genes, n_refs) per group.
+    """
+
+    mat, handles = utils.multiprocessing.load_shared_matrix(spec)
+    ref_ranks, ref_handles = utils.multiprocessing.load_shared_matrix(ref_spec)
+    try:
+        block = mat[:, start:start + chunk_size]
+        block = sparse.csc_matrix(block, copy=True) if sparse.issparse(block) else np.array(block)  # detach from shared memory
+        del mat
+        refs = {group: (ref_ranks[first:last], ref_squares[group]) for group, (first, last) in ref_bounds.items()}
+        corr = _correlate_block(block, rows, refs)
+        del refs, ref_ranks
+    finally:
+        utils.multiprocessing.release_shared(handles + ref_handles)
+
+    return corr
+
+
+def _correlate_block(block: np.ndarray | sparse.csc_matrix,
+                     rows: dict[str, Optional[np.ndarray]],
+                     refs: dict[str, Tuple[np.ndarray, np.ndarray]]) -> dict[str, np.ndarray]:
+    """Correlate a block of genes with the references of each group of cells."""
+    return {group: _spearman_block(block if idx is None else block[idx], refs[group]) for group, idx in rows.items()}
+
+
+def _column_blocks(mat: Any, chunk_size: int) -> Iterator[Tuple[int, np.ndarray | sparse.csc_matrix]]:
+    """Yield the start index and a CSC (or dense) block of chunk_size columns of mat."""
+    for start in range(0, mat.shape[1], chunk_size):
+        block = mat[:, start:start + chunk_size]
+        yield start, sparse.csc_matrix(block) if sparse.issparse(block) else np.asarray(block)
+
+
+@beartype
+def _rank_block(block: np.ndarray | sparse.csc_matrix) -> Tuple[np.ndarray | sparse.csc_matrix, np.ndarray]:
+    """
+    Rank each column of a block (average ranks for ties, as in scipy.stats.rankdata).
+
+    For sparse blocks only the nonzero values are sorted; the rank of the zeros of a column follows from the number
+    of negative values and zeros. The ranks are returned as deviations from the rank of zero, so the sparsity is kept.
+
+    Parameters
+    ----------
+    block : np.ndarray | sparse.csc_matrix
+        Block of shape (n_obs, n_genes).
+
+    Returns
+    -------
+    Tuple[np.ndarray | sparse.csc_matrix, np.ndarray]
+        Ranks shifted by a constant per column (rank of zero for sparse blocks, mean rank for dense blocks)
+        and the sum of squared deviations of the ranks from their mean per column.
+    """
+
+    n_obs, n_genes = block.shape
+    mean_rank = (n_obs + 1) / 2
+
+    if not sparse.issparse(block):
+        ranks = rankdata(block, axis=0) - mean_rank
+        return ranks, (ranks ** 2).sum(axis=0)
+
+    block = sparse.csc_matrix(block, dtype=np.float64, copy=True)
+    block.eliminate_zeros()
+    n_zeros = n_obs - np.diff(block.indptr)
+    col = np.repeat(np.arange(n_genes), np.diff(block.indptr))
+
+    # Rank of the nonzero values within their column; positive values are ranked after the zeros
+    order = np.lexsort((block.data, col))
+    values, col = block.data[order], col[order]
+    ranks = np.arange(len(values)) - block.indptr[col] + 1 + np.where(values < 0, 0, n_zeros[col])
+
+    # Average the ranks of ties, which are consecutive in the sorted values
+    starts = np.flatnonzero(np.r_[True, (values[1:] != values[:-1]) | (col[1:] != col[:-1])])
+    ends = np.r_[starts[1:], len(values)] - 1
+    ranks = ((ranks[starts] + ranks[ends]) / 2)[np.repeat(np.arange(len(starts)), ends - starts + 1)]
+
+    n_negative = np.bincount(col, weights=values < 0, minlength=n_genes)
+    zero_rank = n_negative + (n_zeros + 1) / 2
+    squares = np.bincount(col, weights=(ranks - mean_rank) ** 2, minlength=n_genes) + n_zeros * (zero_rank - mean_rank) ** 2
+
+    data = np.empty(len(values))
+    data[order] = ranks - zero_rank[col]
+
+    return sparse.csc_matrix((data, block.indices, block.indptr), shape=block.shape), squares
+
+
+@beartype
+def _reference_ranks(ref: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the centered ranks of the columns of ref (n_obs x n_refs) and their sum of squares."""
+    ranks = rankdata(ref, axis=0) - (ref.shape[0] + 1) / 2
+
+    return ranks, (ranks ** 2).sum(axis=0)
+
+
+@beartype
+def _spearman_block(block: np.ndarray | sparse.csc_matrix, ref: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """
+    Compute the spearman correlation of each gene of a block with each reference.
+
+    Parameters
+    ----------
+    block : np.ndarray | sparse.csc_matrix
+        Block of shape (n_obs, n_genes).
+    ref : Tuple[np.ndarray, np.ndarray]
+        Centered ranks of the references and their sum of squares as returned by _reference_ranks.
+
+    Returns
+    -------
+    np.ndarray
+        Correlations of shape (n_genes, n_refs). NaN for constant genes or references.
+    """
+
+    ref_ranks, ref_squares = ref
+    ranks, squares = _rank_block(block)
+
+    # The shift of the block ranks does not change the product, as the reference ranks are centered
+    products = np.asarray(ranks.T @ ref_ranks)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = products / np.sqrt(np.outer(squares, ref_squares))
+    corr[(squares == 0)[:, None] | (ref_squares == 0)[None, :]] = np.nan
+
+    return np.clip(corr, -1, 1)
+
+
+def _correlation_pvalues(corr: np.ndarray, n_obs: int) -> np.ndarray:
+    """Two-sided p-values of correlations from the t-distribution (as scipy.stats.spearmanr)."""
+    dof = n_obs - 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = corr * np.sqrt((dof / ((corr + 1.0) * (1.0 - corr))).clip(0))
+
+    return 2 * scipy.stats.t.sf(np.abs(t), dof)
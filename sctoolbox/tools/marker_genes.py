@@ -7,8 +7,10 @@ import pandas as pd
 import numpy as np
 import scanpy as sc
 import itertools
+import multiprocessing as mp
 import warnings
 import anndata
+import scipy
 from pathlib import Path
 import matplotlib.pyplot as plt
 
@@ -357,6 +359,7 @@ def pairwise_rank_genes(adata: sc.AnnData,
                         foldchange_threshold: int | float = 1,
                         min_in_group_fraction: float = 0.25,
                         max_out_group_fraction: float = 0.5,
+                        threads: Optional[int] = None,
                         **kwargs: Any
                         ) -> pd.DataFrame:
     """
@@ -374,6 +377,9 @@ def pairwise_rank_genes(adata: sc.AnnData,
         Minimum fraction of cells in a group that must express a gene to be considered as a marker gene.
     max_out_group_fraction : float, default 0.5
         Maximum fraction of cells in other groups that must express a gene to be considered as a marker gene.
+    threads : Optional[int], default None
+        Number of processes used to calculate the contrasts in parallel. If None, sctoolbox.settings.threads is used.
+        The expression matrix is placed in shared memory once and each process only receives the row indices of the two compared groups.
     **kwargs : Any
         Additional arguments to be passed to scanpy.tl.rank_genes_groups.
 
@@ -388,6 +394,9 @@ def pairwise_rank_genes(adata: sc.AnnData,
         Dataframe containinge the pairwise ranked gened between the groups.
     """
 
+    if threads is None:
+        threads = settings.threads
+
     groups = adata.obs[groupby].astype("category").cat.categories
     contrasts = list(itertools.combinations(groups, 2))
     logger.debug(f"Contrasts: {contrasts}")
@@ -404,47 +413,22 @@ def pairwise_rank_genes(adata: sc.AnnData,
                        "Consider using raw/normalized data instead.")
         use_fractions = False
 
-    # Calculate marker genes for each contrast
-    tables = []
-    for contrast in contrasts:
-        logger.info(f"Calculating rank genes for contrast: {contrast}")
-
-        # Get adata for contrast
-        adata_sub = adata[adata.obs[groupby].isin(contrast)]   # subset to contrast
-
-        # Run rank_genes_groups
-        run_rank_genes(adata_sub, groupby=groupby, **kwargs)
-
-        # Get table
-        c1, c2 = contrast
-        table_dict = get_rank_genes_tables(adata_sub, key=f"rank_genes_{groupby}", n_genes=None, out_group_fractions=True)  # returns dict with each group
-        table = table_dict[c1]
-
-        # Reorder columns
-        table.set_index("names", inplace=True)
-        columns = ["scores", "logfoldchanges", "pvals", "pvals_adj"]
-        if use_fractions:
-            columns += [c1 + "_fraction", c2 + "_fraction"]
-        table = table[columns]  # reorder columns
-        table = table.copy(deep=True)  # prevent SettingWithCopyWarning
-
-        # Calculate up/down genes
-        c1, c2 = contrast
-        groups = ["C1", "C2"]
-        if use_fractions:
-            conditions = [(table["logfoldchanges"] >= foldchange_threshold) & (table[c1 + "_fraction"] >= min_in_group_fraction) & (table[c2 + "_fraction"] <= max_out_group_fraction),  # up
-                          (table["logfoldchanges"] <= -foldchange_threshold) & (table[c1 + "_fraction"] <= max_out_group_fraction) & (table[c2 + "_fraction"] >= min_in_group_fraction)]  # down
-        else:
-            conditions = [table["logfoldchanges"] >= foldchange_threshold,  # up
-                          table["logfoldchanges"] <= -foldchange_threshold]  # down
-        table["group"] = np.select(conditions, groups, "NS")
+    table_params = {"use_fractions": use_fractions,
+                    "foldchange_threshold": foldchange_threshold,
+                    "min_in_group_fraction": min_in_group_fraction,
+                    "max_out_group_fraction": max_out_group_fraction}
 
-        # Rename columns
-        prefix = "/".join(contrast) + "_"
-        table.columns = [prefix + col if "fraction" not in col else col for col in table.columns]
+    # Calculate marker genes for each contrast
+    if threads > 1 and len(contrasts) > 1:
+        tables = _pairwise_rank_genes_parallel(adata, groupby, contrasts, threads, table_params, kwargs)
+    else:
+        tables = []
+        for contrast in contrasts:
+            logger.info(f"Calculating rank genes for contrast: {contrast}")
 
-        # Add table to list
-        tables.append(table)
+            # Get adata for contrast
+            adata_sub = adata[adata.obs[groupby].isin(contrast)]   # subset to contrast
+            tables.append(_contrast_rank_genes_table(adata_sub, groupby, contrast, **table_params, **kwargs))
 
     # Join individual tables
     merged = pd.concat(tables, join="inner", axis=1)
@@ -458,6 +442,209 @@ def pairwise_rank_genes(adata: sc.AnnData,
     return merged
 
 
+def _contrast_rank_genes_table(adata: sc.AnnData,
+                               groupby: str,
+                               contrast: Tuple[str, str],
+                               use_fractions: bool,
+                               foldchange_threshold: int | float,
+                               min_in_group_fraction: float,
+                               max_out_group_fraction: float,
+                               **kwargs: Any) -> pd.DataFrame:
+    """
+    Rank genes for one contrast of pairwise_rank_genes and label up/down regulated genes.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object only containing the cells of the two groups in contrast.
+    groupby : str
+        Key in adata.obs containing the groups.
+    contrast : Tuple[str, str]
+        The two groups to compare.
+    use_fractions : bool
+        Whether to add and filter by the fraction of expressing cells.
+    foldchange_threshold : int | float
+        Minimum foldchange (+/-) to be considered as a marker gene.
+    min_in_group_fraction : float
+        Minimum fraction of cells in a group that must express a gene to be considered as a marker gene.
+    max_out_group_fraction : float
+        Maximum fraction of cells in other groups that must express a gene to be considered as a marker gene.
+    **kwargs : Any
+        Additional arguments to be passed to scanpy.tl.rank_genes_groups.
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with genes as index and columns prefixed with the contrast.
+    """
+
+    # Run rank_genes_groups
+    run_rank_genes(adata, groupby=groupby, **kwargs)
+
+    # Get table
+    c1, c2 = contrast
+    table_dict = get_rank_genes_tables(adata, key=f"rank_genes_{groupby}", n_genes=None, out_group_fractions=True)  # returns dict with each group
+    table = table_dict[c1]
+
+    # Reorder columns
+    table.set_index("names", inplace=True)
+    columns = ["scores", "logfoldchanges", "pvals", "pvals_adj"]
+    if use_fractions:
+        columns += [c1 + "_fraction", c2 + "_fraction"]
+    table = table[columns]  # reorder columns
+    table = table.copy(deep=True)  # prevent SettingWithCopyWarning
+
+    # Calculate up/down genes
+    groups = ["C1", "C2"]
+    if use_fractions:
+        conditions = [(table["logfoldchanges"] >= foldchange_threshold) & (table[c1 + "_fraction"] >= min_in_group_fraction) & (table[c2 + "_fraction"] <= max_out_group_fraction),  # up
+                      (table["logfoldchanges"] <= -foldchange_threshold) & (table[c1 + "_fraction"] <= max_out_group_fraction) & (table[c2 + "_fraction"] >= min_in_group_fraction)]  # down
+    else:
+        conditions = [table["logfoldchanges"] >= foldchange_threshold,  # up
+                      table["logfoldchanges"] <= -foldchange_threshold]  # down
+    table["group"] = np.select(conditions, groups, "NS")
+
+    # Rename columns
+    prefix = "/".join(contrast) + "_"
+    table.columns = [prefix + col if "fraction" not in col else col for col in table.columns]
+
+    return table
+
+
+def _pairwise_rank_genes_parallel(adata: sc.AnnData,
+                                  groupby: str,
+                                  contrasts: list[Tuple[str, str]],
+                                  threads: int,
+                                  table_params: dict[str, Any],
+                                  kwargs: dict[str, Any]) -> list[pd.DataFrame]:
+    """
+    Calculate the contrasts of pairwise_rank_genes in a pool of processes sharing the expression matrix.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object containing expression data.
+    groupby : str
+        Key in adata.obs containing groups to be compared.
+    contrasts : list[Tuple[str, str]]
+        Pairs of groups to compare.
+    threads : int
+        Number of processes.
+    table_params : dict[str, Any]
+        Parameters forwarded to _contrast_rank_genes_table.
+    kwargs : dict[str, Any]
+        Additional arguments to be passed to scanpy.tl.rank_genes_groups.
+
+    Returns
+    -------
+    list[pd.DataFrame]
+        One table per contrast in the order of contrasts.
+    """
+
+    # Share all matrices which might be used by rank_genes_groups
+    matrices = {"X": adata.X}
+    if kwargs.get("layer") is not None:
+        matrices["layer"] = adata.layers[kwargs["layer"]]
+    raw_var_names = None
+    use_raw = kwargs.get("use_raw", None)
+    if adata.raw is not None and (use_raw or (use_raw is None and kwargs.get("layer") is None)):  # same logic as scanpy
+        matrices["raw"] = adata.raw.X
+        raw_var_names = adata.raw.var_names
+
+    handles = []
+    specs = {}
+    try:
+        for name, mat in matrices.items():
+            mat_handles, specs[name] = utils.multiprocessing.share_matrix(mat)
+            handles.extend(mat_handles)
+
+        uns = {"log1p": dict(adata.uns["log1p"])} if "log1p" in adata.uns else {}
+        group_values = adata.obs[groupby].astype(str).to_numpy()
+
+        with mp.Pool(min(threads, len(contrasts))) as pool:  # terminates the workers if a job fails
+            jobs = []
+            for contrast in contrasts:
+                rows = np.flatnonzero(adata.obs[groupby].isin(contrast).to_numpy())
+                job_args = (specs, rows, group_values[rows], contrast, adata.var_names, raw_var_names, groupby, uns, table_params, kwargs)
+                jobs.append(pool.apply_async(_contrast_rank_genes_job, job_args))
+            pool.close()
+
+            utils.multiprocessing.monitor_jobs(jobs, description="Ranking contrasts")
+            tables = [job.get() for job in jobs]
+            pool.join()
+
+    finally:
+        utils.multiprocessing.release_shared(handles, unlink=True)
+
+    return tables
+
+
+def _contrast_rank_genes_job(specs: dict[str, dict[str, Any]],
+                             rows: np.ndarray,
+                             row_groups: np.ndarray,
+                             contrast: Tuple[str, str],
+                             var_names: pd.Index,
+                             raw_var_names: Optional[pd.Index],
+                             groupby: str,
+                             uns: dict[str, Any],
+                             table_params: dict[str, Any],
+                             kwargs: dict[str, Any]) -> pd.DataFrame:
+    """
+    Build the anndata of one contrast from the shared matrices and rank the genes (run within worker processes).
+
+    Parameters
+    ----------
+    specs : dict[str, dict[str, Any]]
+        Descriptions of the shared matrices ('X', and optionally 'layer' and 'raw').
+    rows : np.ndarray
+        Row indices of the cells in the two compared groups.
+    row_groups : np.ndarray
+        Group of each row.
+    contrast : Tuple[str, str]
+        The two groups to compare.
+    var_names : pd.Index
+        Names of the genes in X.
+    raw_var_names : Optional[pd.Index]
+        Names of the genes in raw.X if raw is shared.
+    groupby : str
+        Key in adata.obs containing the groups.
+    uns : dict[str, Any]
+        Entries of adata.uns needed for ranking.
+    table_params : dict[str, Any]
+        Parameters forwarded to _contrast_rank_genes_table.
+    kwargs : dict[str, Any]
+        Additional arguments to be passed to scanpy.tl.rank_genes_groups.
+
+    Returns
+    -------
+    pd.DataFrame
+        Table of the contrast.
+    """
+
+    handles = []
+    try:
+        subsets = {}
+        for name, spec in specs.items():
+            mat, mat_handles = utils.multiprocessing.load_shared_matrix(spec)
+            handles.extend(mat_handles)
+            subsets[name] = mat[rows]  # copies only the rows of the contrast
+            del mat
+
+        obs = pd.DataFrame({groupby: pd.Categorical(row_groups, categories=list(contrast))}, index=rows.astype(str))
+        adata_sub = sc.AnnData(X=subsets["X"], obs=obs, var=pd.DataFrame(index=var_names), uns=uns)
+        if "layer" in subsets:
+            adata_sub.layers[kwargs["layer"]] = subsets["layer"]
+        if "raw" in subsets:
+            adata_sub.raw = sc.AnnData(X=subsets["raw"], obs=obs, var=pd.DataFrame(index=raw_var_names))
+
+        table = _contrast_rank_genes_table(adata_sub, groupby, contrast, **table_params, **kwargs)
+
+    finally:
+        utils.multiprocessing.release_shared(handles)
+
+    return table
+
+
 @deco.log_anndata
 @beartype
 def get_rank_genes_tables(adata: sc.AnnData,
@@ -532,35 +719,34 @@ def get_rank_genes_tables(adata: sc.AnnData,
     # Get in/out group fraction of expressed genes (only works for .X-values above 0)
     if (adata.X.min() < 0) == 0:  # only calculate fractions for raw expression data
         groupby = adata.uns[key]["params"]["groupby"]
-        n_cells_dict = adata.obs[groupby].value_counts().to_dict()  # number of cells in groups
 
-        for group in groups:
+        # Number of cells with expression > 0 per group and gene; computed once for all groups
+        indicator, categories = utils.adata.get_group_indicator(adata, groupby)
+        n_expr_all = indicator @ (adata.X > 0)
+        n_expr_all = n_expr_all.toarray() if scipy.sparse.issparse(n_expr_all) else np.asarray(n_expr_all)
+        n_cells_all = np.diff(indicator.indptr)
 
-            # Fraction of cells inside group expressing each gene
-            s = np.ravel((adata[adata.obs[groupby].isin([group]), :].X > 0).sum(axis=0))  # sum of cells with expression > 0 for this cluster
-            expressed = pd.DataFrame([adata.var.index, s]).T
-            expressed.columns = ["names", "n_expr"]
+        # Select the ranked groups; groups not found in adata.obs have no cells
+        group_idx = pd.Series(range(len(categories)), index=categories.astype(str)).reindex(groups)
+        found = group_idx.notna().to_numpy()
+        n_expr = np.zeros((len(groups), adata.n_vars))
+        n_cells = np.zeros(len(groups))
+        n_expr[found] = n_expr_all[group_idx[found].astype(int)]
+        n_cells[found] = n_cells_all[group_idx[found].astype(int)]
 
-            group_tables[group] = group_tables[group].merge(expressed, left_on="names", right_on="names", how="left")
-            group_tables[group][group + "_fraction"] = group_tables[group]["n_expr"] / n_cells_dict[group] if group in n_cells_dict else 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fractions = pd.DataFrame((n_expr / n_cells[:, None]).T, index=adata.var.index, columns=[group + "_fraction" for group in groups])
 
-            # Fraction of cells for individual groups
-            if out_group_fractions is True:
-                for compare_group in groups:
-                    if compare_group != group:
-                        s = np.ravel((adata[adata.obs[groupby].isin([compare_group]), :].X > 0).sum(axis=0))
-                        expressed = pd.DataFrame(s, index=adata.var.index, dtype="float64")  # expression per gene for this group
-                        expressed.columns = [compare_group + "_fraction"]
-                        expressed.iloc[:, 0] = expressed.iloc[:, 0] / n_cells_dict[compare_group] if compare_group in n_cells_dict else 0.0
-
-                        group_tables[group] = group_tables[group].merge(expressed, left_on="names", right_index=True, how="left")
-
-            # Fraction of cells outside group expressing each gene
-            other_groups = [g for g in groups if g != group]
-            s = np.ravel((adata[adata.obs[groupby].isin(other_groups), :].X > 0).sum(axis=0))
-            expressed = pd.DataFrame([adata.var.index, s]).T
-            expressed.columns = ["names", "n_out_expr"]
-            group_tables[group] = group_tables[group].merge(expressed, left_on="names", right_on="names", how="left")
+            # Cells outside of a group are derived by subtraction from the total of all groups
+            n_out_expr = n_expr.sum(axis=0) - n_expr
+            n_out_cells = n_cells.sum() - n_cells
+            out_fractions = pd.DataFrame((n_out_expr / n_out_cells[:, None]).T, index=adata.var.index, columns=groups)
+
+        # Groups without cells have a fraction of 0
+        fractions = fractions.fillna(0)
+        out_fractions = out_fractions.fillna(0)
+
+        for group in groups:
 
             # If there are only two groups, out_group_fraction -> name of the other group
             if len(groups) == 2:
@@ -568,9 +754,16 @@ def get_rank_genes_tables(adata: sc.AnnData,
             else:
                 out_group_name = "out_group_fraction"
 
-            n_out_group = sum([n_cells_dict[other_group] if other_group in n_cells_dict else 0 for other_group in other_groups])  # sum of cells in other groups
-            group_tables[group][out_group_name] = group_tables[group]["n_out_expr"] / n_out_group
-            group_tables[group].drop(columns=["n_expr", "n_out_expr"], inplace=True)
+            # Fraction of cells inside group, for individual groups (if chosen) and outside group expressing each gene
+            columns = [group + "_fraction"]
+            if out_group_fractions is True:
+                columns += [compare_group + "_fraction" for compare_group in groups if compare_group != group]
+            table_fractions = fractions[columns].copy()
+            table_fractions[out_group_name] = out_fractions[group]
+
+            table = group_tables[group].reset_index(drop=True)
+            table_fractions = table_fractions.reindex(table["names"]).reset_index(drop=True)
+            group_tables[group] = pd.concat([table, table_fractions], axis=1)
 
     # Add additional columns to table
     if len(var_columns) > 0:
@@ -661,7 +854,8 @@ def run_deseq2(adata: sc.AnnData,
                contrasts: Optional[list[Tuple]] = None,
                min_counts: int = 5,
                percentile_range: Tuple[int, int] = (0, 100),
-               threads: Optional[int] = None) -> pd.DataFrame:
+               threads: Optional[int] = None,
+               groupby: Optional[str] = None) -> pd.DataFrame:
     """
     Run pyDESeq2 on counts within adata. Must be run on the raw counts per sample. If the adata contains normalized counts in .X, 'layer' can be used to specify raw counts.
 
@@ -686,12 +880,18 @@ def run_deseq2(adata: sc.AnnData,
         to the cells in the 0-95% percentile ranges. Default is (0, 100), which means all cells are used.
     threads : Optional[int]
         The number of threads to use for parallelizable calculations. If None is given, sctoolbox.settings.threads is used
+    groupby : Optional[str], default None
+        Column name in adata.obs containing e.g. cell types or clusters. If given, DESeq2 is run separately within each group.
+        The pseudobulks of all groups are calculated in one pass. If there are at least as many groups as threads, the groups are
+        fitted in parallel processes (one CPU each); otherwise the groups are fitted one after another with all threads used by pyDESeq2.
 
     Returns
     -------
     pd.DataFrame
         A dataframe containing the results of the DESeq2 analysis.
-        Also adds the dataframe to adata.uns["deseq_result"]
+        Also adds the dataframe to adata.uns["sctoolbox"]["deseq_result"].
+        If groupby is given, the results of all groups are returned as one long table with the columns groupby and 'gene'.
+        The table of each group is added to adata.uns["sctoolbox"]["deseq_result"][<group>].
 
     Raises
     ------
@@ -699,6 +899,7 @@ def run_deseq2(adata: sc.AnnData,
         1. If any given column name is not found in adata.obs.
         2. Invalid contrasts are supplied.
         3. Negative counts are encountered.
+        4. No group in groupby contains samples of both conditions of a contrast.
 
     Notes
     -----
@@ -710,9 +911,6 @@ def run_deseq2(adata: sc.AnnData,
     sctoolbox.utils.bioutils.pseudobulk_table
     """
     utils.checker.check_module("pydeseq2")
-    from pydeseq2.dds import DeseqDataSet
-    from pydeseq2.ds import DeseqStats
-    from pydeseq2.default_inference import DefaultInference
 
     if threads is None:
         threads = settings.threads
@@ -725,7 +923,7 @@ def run_deseq2(adata: sc.AnnData,
 
     # Check that sample_col and condition_col are in adata.obs
     cols = [sample_col, condition_col] + confounders
-    utils.checker.check_columns(adata.obs, cols, name="adata.obs", error=True)
+    utils.checker.check_columns(adata.obs, cols + ([groupby] if groupby is not None else []), name="adata.obs", error=True)
 
     # Build sample_df
     sample_df = adata.obs[cols].reset_index(drop=True).drop_duplicates()
@@ -739,6 +937,7 @@ def run_deseq2(adata: sc.AnnData,
 
     # Establish contrasts
     all_contrasts = list(itertools.combinations(conditions, 2))
+    adata_contrasts = adata
     if contrasts is None:
         contrasts = all_contrasts
     else:
@@ -751,15 +950,108 @@ def run_deseq2(adata: sc.AnnData,
         # Remove cells not in contrasts
         contrast_conditions = set(itertools.chain.from_iterable(contrasts))
         logger.debug(contrast_conditions)
-        adata = adata[adata.obs[condition_col].isin(contrast_conditions)]
+        adata_contrasts = adata[adata.obs[condition_col].isin(contrast_conditions)]
 
         # Remove samples not in contrasts
-        sample_df = sample_df[sample_df["condition"].isin(contrast_conditions)]
+        sample_df = sample_df[sample_df[condition_col].isin(contrast_conditions)]
+
+    design_factors = confounders + [condition_col]
+
+    if groupby is None:
+
+        # Build count matrix
+        logger.debug("Building count matrix")
+        counts_df = utils.bioutils.pseudobulk_table(adata_contrasts, sample_col, how="sum", layer=layer,
+                                                    percentile_range=percentile_range, threads=threads)
+        counts_df = _prepare_deseq2_counts(counts_df, min_counts)
+
+        # Run DEseq2
+        logger.debug("Running pyDESeq2")
+        deseq_table = _deseq2_table(counts_df, sample_df, condition_col, list(conditions), contrasts, design_factors, threads)
+
+        # Add to adata uns
+        utils.adata.add_uns_info(adata, "deseq_result", deseq_table)
+
+        return deseq_table
+
+    # Build count matrices of all groups in one pass; pseudobulks are the combinations of group and sample
+    logger.debug("Building count matrices for all groups")
+    groups = adata_contrasts.obs[groupby].astype(str)
+    samples = adata_contrasts.obs[sample_col].astype(str)
+    codes, pseudobulks = pd.MultiIndex.from_arrays([groups, samples], names=["group", "sample"]).factorize()
+
+    key_adata = sc.AnnData(X=adata_contrasts.layers[layer] if layer is not None else adata_contrasts.X,
+                           obs=pd.DataFrame({"pseudobulk": pd.Categorical.from_codes(codes, categories=range(len(pseudobulks)))},
+                                            index=adata_contrasts.obs_names),
+                           var=pd.DataFrame(index=adata_contrasts.var_names))
+    counts_all = utils.bioutils.pseudobulk_table(key_adata, "pseudobulk", how="sum", percentile_range=percentile_range, threads=threads)
+    counts_all.columns = pseudobulks
+
+    # Setup one design per group
+    designs = {}
+    for group in groups.astype("category").cat.categories:
+        group_samples = [sample for sample_group, sample in pseudobulks if sample_group == group]
+        group_sample_df = sample_df.loc[sample_df.index.astype(str).isin(group_samples)]
+        group_conditions = [c for c in conditions if c in set(group_sample_df[condition_col])]
+        group_contrasts = [(C1, C2) for C1, C2 in contrasts if C1 in group_conditions and C2 in group_conditions]
+
+        if len(group_contrasts) == 0:
+            logger.warning(f"Skipping group '{group}' as it does not contain samples of both conditions of any contrast.")
+            continue
+
+        counts_df = counts_all[[(group, sample) for sample in group_sample_df.index.astype(str)]]
+        counts_df.columns = group_sample_df.index
+        designs[group] = (_prepare_deseq2_counts(counts_df, min_counts), group_sample_df, condition_col, group_conditions, group_contrasts, design_factors)
+
+    if len(designs) == 0:
+        raise ValueError(f"No group in '{groupby}' contains samples of both conditions of any contrast.")
+
+    # Run DEseq2 per group
+    if len(designs) >= threads and threads > 1:
+        logger.debug(f"Running pyDESeq2 for {len(designs)} groups in {threads} processes")
+        with mp.Pool(threads) as pool:  # terminates the workers if a job fails
+            jobs = {group: pool.apply_async(_deseq2_table, design + (1,)) for group, design in designs.items()}
+            pool.close()
+            utils.multiprocessing.monitor_jobs(list(jobs.values()), description="Running pyDESeq2")
+            tables = {group: job.get() for group, job in jobs.items()}
+            pool.join()
+    else:
+        tables = {}
+        for group, design in designs.items():
+            logger.info(f"Running pyDESeq2 for group '{group}'")
+            tables[group] = _deseq2_table(*design, threads)
+
+    # Add to adata uns
+    utils.adata.add_uns_info(adata, "deseq_result", tables)
+
+    # Combine into one long table
+    deseq_table = pd.concat(tables, names=[groupby, "gene"]).reset_index()
+
+    return deseq_table
+
+
+def _prepare_deseq2_counts(counts_df: pd.DataFrame, min_counts: int) -> pd.DataFrame:
+    """
+    Convert a pseudobulk table into the count matrix expected by pyDESeq2.
+
+    Parameters
+    ----------
+    counts_df : pd.DataFrame
+        Pseudobulk table with genes as rows and samples as columns.
+    min_counts : int
+        Minimum number of counts per gene to be included in the analysis.
+
+    Returns
+    -------
+    pd.DataFrame
+        Integer counts with samples as rows and the genes passing min_counts as columns.
+
+    Raises
+    ------
+    ValueError
+        If negative counts are found.
+    """
 
-    # Build count matrix
-    logger.debug("Building count matrix")
-    counts_df = utils.bioutils.pseudobulk_table(adata, sample_col, how="sum", layer=layer,
-                                                percentile_range=percentile_range)
     counts_df = counts_df.astype(int)  # pyDESeq2 requires integer counts
     counts_df = counts_df.transpose()  # pyDESeq2 requires genes as columns
     if counts_df.min().min() < 0:
@@ -769,9 +1061,45 @@ def run_deseq2(adata: sc.AnnData,
     genes_to_keep = counts_df.columns[counts_df.sum(axis=0) >= min_counts]
     counts_df = counts_df[genes_to_keep]
 
-    # Run DEseq2
-    logger.debug("Running pyDESeq2")
-    design_factors = confounders + [condition_col]
+    return counts_df
+
+
+def _deseq2_table(counts_df: pd.DataFrame,
+                  sample_df: pd.DataFrame,
+                  condition_col: str,
+                  conditions: list[str],
+                  contrasts: list[Tuple],
+                  design_factors: list[str],
+                  threads: int) -> pd.DataFrame:
+    """
+    Fit pyDESeq2 for one design and collect the results of all contrasts.
+
+    Parameters
+    ----------
+    counts_df : pd.DataFrame
+        Integer counts with samples as rows and genes as columns.
+    sample_df : pd.DataFrame
+        Metadata with samples as index.
+    condition_col : str
+        Column in sample_df containing the conditions.
+    conditions : list[str]
+        Conditions for which the mean normalized counts are reported.
+    contrasts : list[Tuple]
+        Pairs of conditions to compare.
+    design_factors : list[str]
+        Columns in sample_df used in the design.
+    threads : int
+        Number of CPUs used by pyDESeq2.
+
+    Returns
+    -------
+    pd.DataFrame
+        Table with mean values per condition, statistics per contrast and normalized counts per sample.
+    """
+    from pydeseq2.dds import DeseqDataSet
+    from pydeseq2.ds import DeseqStats
+    from pydeseq2.default_inference import DefaultInference
+
     dds = DeseqDataSet(counts=counts_df,
                        metadata=sample_df,
                        design_factors=design_factors,
@@ -808,40 +1136,63 @@ def run_deseq2(adata: sc.AnnData,
     C1, C2 = contrasts[0]
     deseq_table.sort_values(by=C2 + "/" + C1 + "_pvalue", inplace=True)
 
-    # Add to adata uns
-    utils.adata.add_uns_info(adata, "deseq_result", deseq_table)
-
     return deseq_table
 
 
 @deco.log_anndata
 @beartype
 def score_genes(adata: sc.AnnData,
-                gene_set: str | list[str],
+                gene_set: str | list[str] | dict[str, list[str]],
                 score_name: str = 'score',
                 inplace: bool = True,
+                ctrl_size: int = 50,
+                n_bins: int = 25,
+                gene_pool: Optional[list[str]] = None,
+                layer: Optional[str] = None,
+                scale: bool = True,
+                random_state: int = 0,
                 **kwargs: Any) -> Optional[sc.AnnData]:
     """
-    Assign a score to each cell depending on the expression of a set of genes. This is a wrapper for scanpy.tl.score_genes.
+    Assign a score to each cell depending on the expression of one or more sets of genes.
+
+    The score is the average (scaled) expression of the gene set subtracted by the average expression of
+    a set of control genes sampled per expression bin, following the approach of scanpy.tl.score_genes.
+    All scores are computed with a single sparse matrix product (see score_gene_sets). Scaling is applied
+    analytically to the genes used for scoring, so the full expression matrix is never scaled or densified.
 
     Parameters
     ----------
     adata : sc.AnnData
         Anndata object to score.
-    gene_set : str | list[str]
-        A list of genes or path to a file containing a list of genes.
-        The txt file should have one gene per row.
+    gene_set : str | list[str] | dict[str, list[str]]
+        A list of genes, a dictionary of {set name: list of genes} or path to a file containing gene set(s).
+        A .gmt file is read as one gene set per line (name, description, genes separated by tabs).
+        Any other file should have one gene per row.
     score_name : str, default "score"
-        Name of the column in obs table where the score will be added.
+        Name of the column in obs table where the score will be added. Only used for a single list of genes;
+        for multiple gene sets the set names are used as column names.
     inplace : bool, default True
-        Adds the new column to the original anndata object.
+        Adds the new column(s) to the original anndata object.
+    ctrl_size : int, default 50
+        Number of control genes sampled from each expression bin.
+    n_bins : int, default 25
+        Number of expression bins used for sampling the control genes.
+    gene_pool : Optional[list[str]], default None
+        Genes for sampling the control genes. Default is all genes.
+    layer : Optional[str], default None
+        Layer to use for scoring. If None, adata.X is used.
+    scale : bool, default True
+        Whether to score on the expression scaled to zero mean and unit variance per gene (as sc.pp.scale).
+    random_state : int, default 0
+        Seed for sampling the control genes.
     **kwargs : Any
-        Additional arguments to be passed to scanpy.tl.score_genes.
+        Additional arguments to be passed to scanpy.tl.score_genes (e.g. use_raw). If given, each gene set is scored
+        with scanpy.tl.score_genes on a scaled copy of adata instead of the single matrix product.
 
     Returns
     -------
     Optional[sc.AnnData]
-        If inplace is False, return a copy of anndata object with the new column in the obs table.
+        If inplace is False, return a copy of anndata object with the new column(s) in the obs table.
 
     Raises
     ------
@@ -855,17 +1206,165 @@ def score_genes(adata: sc.AnnData,
     # check if list is in a file
     if isinstance(gene_set, str):
         # check if file exists
-        if Path(gene_set).is_file():
-            gene_set = [x.strip() for x in open(gene_set)]
-        else:
+        if not Path(gene_set).is_file():
             raise FileNotFoundError('The list was not found!')
+        if gene_set.endswith(".gmt"):
+            gene_set = _read_gmt(gene_set)
+        else:
+            gene_set = [x.strip() for x in open(gene_set)]
 
-    # scale data
-    sdata = sc.pp.scale(adata, copy=True)
+    gene_sets = gene_set if isinstance(gene_set, dict) else {score_name: gene_set}
 
-    # Score the cells
-    sc.tl.score_genes(sdata, gene_list=gene_set, score_name=score_name, **kwargs)
-    # add score to adata.obs
-    adata.obs[score_name] = sdata.obs[score_name]
+    if kwargs:
+        # arguments which are only supported by scanpy
+        sdata = sc.pp.scale(adata, layer=layer, copy=True) if scale else adata.copy()
+        for name, genes in gene_sets.items():
+            sc.tl.score_genes(sdata, gene_list=genes, score_name=name, ctrl_size=ctrl_size, n_bins=n_bins, gene_pool=gene_pool,
+                              layer=layer, random_state=random_state, **kwargs)
+        scores = sdata.obs[list(gene_sets.keys())]
+    else:
+        scores = score_gene_sets(adata, gene_sets, ctrl_size=ctrl_size, n_bins=n_bins, gene_pool=gene_pool,
+                                 layer=layer, scale=scale, random_state=random_state)
+
+    # add scores to adata.obs
+    for name in scores.columns:
+        adata.obs[name] = scores[name]
 
     return adata if not inplace else None
+
+
+@beartype
+def _read_gmt(path: str) -> dict[str, list[str]]:
+    """
+    Read gene sets from a .gmt file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .gmt file.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Dictionary of {set name: list of genes}.
+    """
+
+    gene_sets = {}
+    with open(path) as f:
+        for line in f:
+            columns = [c.strip() for c in line.rstrip("\n").split("\t")]
+            if len(columns) < 3:
+                continue
+            gene_sets[columns[0]] = [gene for gene in columns[2:] if gene != ""]
+
+    return gene_sets
+
+
+@beartype
+def score_gene_sets(adata: sc.AnnData,
+                    gene_sets: dict[str, list[str]],
+                    ctrl_size: int = 50,
+                    n_bins: int = 25,
+                    gene_pool: Optional[list[str]] = None,
+                    layer: Optional[str] = None,
+                    scale: bool = True,
+                    random_state: int = 0) -> pd.DataFrame:
+    """
+    Score cells for several gene sets with one sparse matrix product.
+
+    For each gene set, ctrl_size control genes are sampled per expression bin of the set genes from the genes of the bin
+    which are not part of the set (as scanpy.tl.score_genes with ctrl_as_ref=False).
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object to score.
+    gene_sets : dict[str, list[str]]
+        Dictionary of {score name: list of genes}.
+    ctrl_size : int, default 50
+        Number of control genes sampled from each expression bin.
+    n_bins : int, default 25
+        Number of expression bins used for sampling the control genes.
+    gene_pool : Optional[list[str]], default None
+        Genes for sampling the control genes. Default is all genes.
+    layer : Optional[str], default None
+        Layer to use for scoring. If None, adata.X is used.
+    scale : bool, default True
+        Whether to score on the expression scaled to zero mean and unit variance per gene.
+    random_state : int, default 0
+        Seed for sampling the control genes.
+
+    Returns
+    -------
+    pd.DataFrame
+        Table of scores with one column per gene set and cells as index.
+
+    Raises
+    ------
+    ValueError
+        If a gene set or the gene pool does not contain any genes of adata.
+    """
+
+    mat = adata.layers[layer] if layer is not None else adata.X
+    var_names = adata.var_names
+
+    # Bin genes of the pool by their mean expression
+    pool_idx = np.arange(len(var_names)) if gene_pool is None else var_names.get_indexer(pd.Index(gene_pool).intersection(var_names))
+    if len(pool_idx) == 0:
+        raise ValueError("No valid genes were passed for reference set.")
+
+    means = np.asarray(mat.mean(axis=0, dtype=np.float64)).ravel()
+    pool_means = pd.Series(means[pool_idx])
+    n_items = int(np.round(len(pool_means) / (n_bins - 1)))
+    pool_cut = (pool_means.rank(method="min") // max(n_items, 1)).to_numpy().astype(int)
+
+    gene_cut = np.full(len(var_names), -1)
+    gene_cut[pool_idx] = pool_cut
+    rng = np.random.default_rng(random_state)
+
+    # Build gene x set weight matrix with +1/n for set genes and -1/n for control genes
+    rows, cols, weights = [], [], []
+    for i, (name, genes) in enumerate(gene_sets.items()):
+        genes = pd.Index(genes)
+        missing = genes.difference(var_names)
+        if len(missing) > 0:
+            logger.warning(f"Genes of '{name}' are not in var_names and are ignored: {list(missing)}")
+        set_idx = np.unique(var_names.get_indexer(genes.intersection(var_names)))
+        if len(set_idx) == 0:
+            raise ValueError(f"No valid genes were passed for scoring '{name}'.")
+
+        # Draw control genes per bin of the set genes; genes of the set are not used as control
+        cuts = np.unique(gene_cut[set_idx])
+        ctrl_idx = [np.array([], dtype=int)]
+        for cut in cuts[cuts >= 0]:
+            bin_genes = np.setdiff1d(pool_idx[pool_cut == cut], set_idx)
+            ctrl_idx.append(rng.choice(bin_genes, size=ctrl_size, replace=False) if len(bin_genes) > ctrl_size else bin_genes)
+        ctrl_idx = np.unique(np.concatenate(ctrl_idx))
+        if len(ctrl_idx) == 0:
+            raise ValueError(f"No control genes found for scoring '{name}'. Check the gene_pool.")
+
+        rows.extend([set_idx, ctrl_idx])
+        cols.extend([np.full(len(set_idx), i), np.full(len(ctrl_idx), i)])
+        weights.extend([np.full(len(set_idx), 1 / len(set_idx)), np.full(len(ctrl_idx), -1 / len(ctrl_idx))])
+
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    used = np.unique(rows)
+    weight_mat = np.zeros((len(used), len(gene_sets)))
+    np.add.at(weight_mat, (np.searchsorted(used, rows), cols), weights)
+
+    # Only the genes used for scoring are extracted from the matrix
+    sub = mat[:, used]
+    offset = np.zeros(len(gene_sets))
+    if scale:
+        # (x - mu) / sd @ W = x @ (W / sd) - mu @ (W / sd); keeps the matrix sparse
+        sq_means = np.asarray(sub.multiply(sub).mean(axis=0) if scipy.sparse.issparse(sub) else np.square(sub).mean(axis=0), dtype=np.float64).ravel()
+        n_obs = sub.shape[0]
+        var = (sq_means - means[used] ** 2) * n_obs / max(n_obs - 1, 1)
+        sd = np.sqrt(np.clip(var, 0, None))
+        sd[sd == 0] = 1
+        weight_mat = weight_mat / sd[:, None]
+        offset = means[used] @ weight_mat
+
+    scores = np.asarray(sub @ weight_mat, dtype=np.float64) - offset
+
+    return pd.DataFrame(scores, index=adata.obs_names, columns=list(gene_sets.keys()))
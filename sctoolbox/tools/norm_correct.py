@@ -5,14 +5,22 @@ import io
 from contextlib import redirect_stderr
 import copy
 import multiprocessing as mp
+import pandas as pd
+import psutil
+import resource
+import sys
+import time
 import scanpy as sc
 import scanpy.external as sce
+import h5py
+from pynndescent import NNDescent
+from sklearn.neighbors import NearestNeighbors
 
-from beartype.typing import Optional, Any, Union, Literal, Callable
+from beartype.typing import Optional, Any, Union, Literal, Callable, Iterator, Tuple
 from beartype import beartype
 
 import sctoolbox.utils as utils
-from sctoolbox.tools.dim_reduction import lsi
+from sctoolbox.tools.dim_reduction import lsi, chunked_mean_var, project_blocks, randomized_svd
 import sctoolbox.utils.decorator as deco
 from sctoolbox._settings import settings
 logger = settings.logger
@@ -143,7 +151,8 @@ def tfidf(anndata: sc.AnnData,
           log_tfidf: bool = False,
           scale_factor: int = int(1e4),
           inplace: bool = False,
-          layer: Optional[str] = None) -> Optional[sc.AnnData]:
+          layer: Optional[str] = None,
+          chunk_size: int = 10000) -> Optional[sc.AnnData]:
     """
     Transform peak counts with TF-IDF (Term Frequency - Inverse Document Frequency).
 
@@ -152,6 +161,10 @@ def tfidf(anndata: sc.AnnData,
     IDF: number of cells divided by DF.
     By default, log(TF) * log(IDF) is returned.
 
+    The matrix is transformed in place over blocks of rows (columns for CSC matrices) without creating dense or diagonal helper matrices.
+    Float matrices keep their dtype, integer matrices are converted to float32. For backed anndata objects, .X is transformed
+    block by block within the backing file, which must be opened in 'r+' mode.
+
     Parameters
     ----------
     anndata : sc.AnnData
@@ -168,6 +181,8 @@ def tfidf(anndata: sc.AnnData,
         If True, change the anndata object inplace. Otherwise return changed anndata object.
     layer : Optional[str], default None
         Perform tfidf on given layer. If None tfidf is run on adata.X.
+    chunk_size : int, default 10000
+        Number of rows (columns for CSC matrices) transformed at once.
 
     Notes
     -----
@@ -178,6 +193,8 @@ def tfidf(anndata: sc.AnnData,
     ------
     AttributeError
         log(TF*IDF) requires log(TF) and log(IDF) to be False.
+    ValueError
+        If a backed anndata object should be copied or its .X is stored as integers.
 
     Returns
     -------
@@ -185,50 +202,182 @@ def tfidf(anndata: sc.AnnData,
         TF-IDF normalized anndata object.
     """
 
-    adata = anndata if inplace else anndata.copy()
-    matrix = adata.layers[layer] if layer else adata.X
-
     if log_tfidf and (log_tf or log_idf):
         raise AttributeError(
             "When returning log(TF*IDF), \
             applying neither log(TF) nor log(IDF) is possible."
         )
 
-    if sparse.issparse(matrix):
-        n_peaks = np.asarray(matrix.sum(axis=1)).reshape(-1)
-        n_peaks = sparse.dia_matrix((1.0 / n_peaks, 0), shape=(n_peaks.size, n_peaks.size))
-        # This prevents making TF dense
-        tf = np.dot(n_peaks, matrix)
+    backed = anndata.isbacked and layer is None
+    if anndata.isbacked and not inplace:
+        raise ValueError("Copying a backed anndata object would load the full matrix. Please set inplace=True.")
+
+    adata = anndata if inplace else anndata.copy()
+
+    if backed:
+        matrix = adata.file["X"]  # h5py group (sparse) or dataset (dense) within the backing file
+        dtype = matrix["data"].dtype if isinstance(matrix, h5py.Group) else matrix.dtype
+        if not np.issubdtype(dtype, np.floating):
+            raise ValueError("The backed .X is stored as integers and can not be transformed in place. Please convert it to float first.")
     else:
-        n_peaks = np.asarray(matrix.sum(axis=1)).reshape(-1, 1)
-        tf = matrix / n_peaks
-    if scale_factor is not None and scale_factor != 0 and scale_factor != 1:
-        tf = tf * scale_factor
-    if log_tf:
-        tf = np.log1p(tf)
-
-    idf = np.asarray(adata.shape[0] / matrix.sum(axis=0)).reshape(-1)
+        matrix = adata.layers[layer] if layer else adata.X
+        if not np.issubdtype(matrix.dtype, np.floating):
+            matrix = matrix.astype(np.float32)
+            if layer:
+                adata.layers[layer] = matrix
+            else:
+                adata.X = matrix
+
+    cell_totals, peak_totals = _tfidf_totals(matrix, adata.shape, chunk_size)
+
+    # TF factors per cell and IDF per peak; empty cells/peaks get 0 instead of inf
+    scale = scale_factor if scale_factor is not None and scale_factor != 0 else 1
+    tf_factor = np.divide(scale, cell_totals, out=np.zeros_like(cell_totals), where=cell_totals > 0)
+    idf = np.divide(adata.shape[0], peak_totals, out=np.zeros_like(peak_totals), where=peak_totals > 0)
     if log_idf:
         idf = np.log1p(idf)
 
-    if sparse.issparse(tf):
-        idf = sparse.dia_matrix((idf, 0), shape=(idf.size, idf.size))
-        tf_idf = np.dot(tf, idf)
-    else:
-        tf_idf = np.dot(sparse.csr_matrix(tf), sparse.csr_matrix(np.diag(idf)))
-
-    if log_tfidf:
-        tf_idf = np.log1p(tf_idf)
-
-    if layer:
-        adata.layers[layer] = np.nan_to_num(tf_idf, 0)
-    else:
-        adata.X = np.nan_to_num(tf_idf, 0)
+    _tfidf_transform(matrix, adata.shape, tf_factor, idf, log_tf, log_tfidf, chunk_size)
 
     if not inplace:
         return adata
 
 
+def _compressed_blocks(matrix: Any,
+                       chunk_size: int) -> Iterator[tuple[int, int, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Iterate over blocks of the major axis of a CSR/CSC matrix or its h5py group.
+
+    Parameters
+    ----------
+    matrix : Any
+        scipy.sparse CSR/CSC matrix or h5py group with 'data', 'indices' and 'indptr'.
+    chunk_size : int
+        Number of rows (CSR) or columns (CSC) per block.
+
+    Yields
+    ------
+    tuple[int, int, np.ndarray, np.ndarray, np.ndarray]
+        Start and end of the block in the data array, the data values, their index along the major axis and along the minor axis.
+        The values are a view into matrix.data for in-memory matrices.
+    """
+
+    indptr = np.asarray(matrix["indptr"][:] if isinstance(matrix, h5py.Group) else matrix.indptr)
+    n_major = len(indptr) - 1
+
+    for start in range(0, n_major, chunk_size):
+        end = min(start + chunk_size, n_major)
+        first, last = indptr[start], indptr[end]
+        data = matrix["data"][first:last] if isinstance(matrix, h5py.Group) else matrix.data[first:last]
+        minor = matrix["indices"][first:last] if isinstance(matrix, h5py.Group) else matrix.indices[first:last]
+        major = np.repeat(np.arange(start, end), np.diff(indptr[start:end + 1]))
+        yield first, last, data, major, minor
+
+
+def _is_csc(matrix: Any) -> bool:
+    """Check if a scipy.sparse matrix or h5py group is stored in CSC format."""
+    if isinstance(matrix, h5py.Group):
+        return matrix.attrs.get("encoding-type", "").startswith("csc")
+    return sparse.issparse(matrix) and matrix.format == "csc"
+
+
+def _tfidf_totals(matrix: Any,
+                  shape: tuple[int, int],
+                  chunk_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sum counts per cell and per peak in one pass over blocks of the matrix.
+
+    Parameters
+    ----------
+    matrix : Any
+        Dense or sparse matrix, h5py dataset or h5py group of a sparse matrix.
+    shape : tuple[int, int]
+        Shape of the matrix.
+    chunk_size : int
+        Number of rows (columns for CSC) per block.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        Total counts per cell and per peak.
+    """
+
+    n_obs, n_vars = shape
+    if not isinstance(matrix, h5py.Group) and not sparse.issparse(matrix):  # dense array or h5py dataset
+        cell_totals = np.zeros(n_obs)
+        peak_totals = np.zeros(n_vars)
+        for start in range(0, n_obs, chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size])
+            cell_totals[start:start + chunk_size] = block.sum(axis=1, dtype=np.float64)
+            peak_totals += block.sum(axis=0, dtype=np.float64)
+        return cell_totals, peak_totals
+
+    csc = _is_csc(matrix)
+    n_major, n_minor = (n_vars, n_obs) if csc else (n_obs, n_vars)
+    major_totals = np.zeros(n_major)
+    minor_totals = np.zeros(n_minor)
+    for _, _, data, major, minor in _compressed_blocks(matrix, chunk_size):
+        major_totals += np.bincount(major, weights=data, minlength=n_major)
+        minor_totals += np.bincount(minor, weights=data, minlength=n_minor)
+
+    return (minor_totals, major_totals) if csc else (major_totals, minor_totals)
+
+
+def _tfidf_transform(matrix: Any,
+                     shape: tuple[int, int],
+                     tf_factor: np.ndarray,
+                     idf: np.ndarray,
+                     log_tf: bool,
+                     log_tfidf: bool,
+                     chunk_size: int) -> None:
+    """
+    Apply TF-IDF in place to blocks of the matrix.
+
+    Parameters
+    ----------
+    matrix : Any
+        Dense or sparse matrix, h5py dataset or h5py group of a sparse matrix.
+    shape : tuple[int, int]
+        Shape of the matrix.
+    tf_factor : np.ndarray
+        Factor per cell to compute TF from the counts.
+    idf : np.ndarray
+        IDF per peak.
+    log_tf : bool
+        Log-transform the TF term.
+    log_tfidf : bool
+        Log-transform the TF*IDF term.
+    chunk_size : int
+        Number of rows (columns for CSC) per block.
+    """
+
+    def transform(block, cell_factor, peak_factor):
+        block *= cell_factor
+        if log_tf:
+            np.log1p(block, out=block)
+        block *= peak_factor
+        if log_tfidf:
+            np.log1p(block, out=block)
+
+    if not isinstance(matrix, h5py.Group) and not sparse.issparse(matrix):  # dense array or h5py dataset
+        for start in range(0, shape[0], chunk_size):
+            rows = slice(start, start + chunk_size)
+            if isinstance(matrix, h5py.Dataset):
+                block = matrix[rows]
+                transform(block, tf_factor[rows, None], idf)
+                matrix[rows] = block
+            else:
+                transform(matrix[rows], tf_factor[rows, None], idf)  # view into matrix
+        return
+
+    csc = _is_csc(matrix)
+    for first, last, data, major, minor in _compressed_blocks(matrix, chunk_size):
+        cells, peaks = (minor, major) if csc else (major, minor)
+        transform(data, tf_factor[cells], idf[peaks])
+        if isinstance(matrix, h5py.Group):
+            matrix["data"][first:last] = data
+
+
 ###################################################################################
 # --------------------------- Batch correction methods -------------------------- #
 ###################################################################################
@@ -240,10 +389,17 @@ def wrap_corrections(adata: sc.AnnData,
                      methods: Union[batch_methods,
                                     list[batch_methods],
                                     Callable] = ["bbknn", "mnn"],
-                     method_kwargs: dict = {}) -> dict[str, sc.AnnData]:
+                     method_kwargs: dict = {},
+                     threads: int = 1,
+                     return_stats: bool = False) -> dict[str, sc.AnnData] | Tuple[dict[str, sc.AnnData], pd.DataFrame]:
     """
     Calculate multiple batch corrections for adata using the 'batch_correction' function.
 
+    With 'threads' > 1 or 'return_stats', each method runs in its own worker process, which only receives the inputs
+    needed by the method: .obsm['X_pca'] and the batch labels for bbknn, harmony and scanorama, and .X with the batch labels
+    for mnn and combat (custom functions receive the full object). The corrected objects then share unchanged matrices
+    (.X, layers) with adata instead of copying them.
+
     Parameters
     ----------
     adata : sc.AnnData
@@ -260,11 +416,18 @@ def wrap_corrections(adata: sc.AnnData,
         Or provide a custom batch correction function. See `batch_correction(method)` for more information.
     method_kwargs : dict, default {}
         Dict with methods as keys. Values are dicts of additional parameters forwarded to method. See batch_correction(**kwargs).
+    threads : int, default 1
+        Number of methods to run in parallel. The workers are spawned, so custom functions must be importable (not lambdas)
+        to be sent to the workers.
+    return_stats : bool, default False
+        If True, additionally return the wall time and peak memory of each method.
 
     Returns
     -------
-    dict[str, sc.AnnData]
+    dict[str, sc.AnnData] | Tuple[dict[str, sc.AnnData], pd.DataFrame]
         Dictonary of batch corrected anndata objects. Where the key is the correction method and the value is the corrected anndata.
+        If return_stats is True, also a table with the columns 'runtime' (seconds) and 'peak_rss' (increase of the resident set size
+        of the worker during the correction in MB) per method.
 
     Raises
     ------
@@ -282,7 +445,7 @@ def wrap_corrections(adata: sc.AnnData,
         raise ValueError(f"Unknown methods in `method_kwargs` keys: {unknown_keys}")
 
     # Check the existance of packages before running batch_corrections
-    required_packages = {"harmony": "harmonypy", "bbknn": "bbknn", "scanorama": "scanorama"}
+    required_packages = {"harmony": "harmonypy", "bbknn": "bbknn", "scanorama": "scanorama", "mnn": "mnnpy"}
     for method in methods:
         if method in required_packages:  # not all packages need external tools
             f = io.StringIO()
@@ -291,14 +454,173 @@ def wrap_corrections(adata: sc.AnnData,
 
     # Collect batch correction per method
     anndata_dict = {'uncorrected': adata}
+    if threads == 1 and not return_stats:
+        for method in methods:
+            anndata_dict[method] = batch_correction(adata, batch_key, method, **method_kwargs.get(method, {}))  # batch correction returns the corrected adata
+
+        logger.info("Finished batch correction(s)!")
+        return anndata_dict
+
+    # Run each method in a fresh worker to measure its memory independently
+    # spawned workers do not inherit locks of thread pools which the parent may already have started (forking can deadlock)
+    pool = mp.get_context("spawn").Pool(min(threads, len(methods)), maxtasksperchild=1)
+    jobs = {}
     for method in methods:
-        anndata_dict[method] = batch_correction(adata, batch_key, method, **method_kwargs.setdefault(method, {}))  # batch correction returns the corrected adata
+        payload = _correction_payload(adata, batch_key, method)
+        jobs[method] = pool.apply_async(_correction_job, (payload, batch_key, method, method_kwargs.get(method, {})))
+    pool.close()
+
+    utils.multiprocessing.monitor_jobs(list(jobs.values()), description="Batch corrections")
+    pool.join()
+
+    stats = {}
+    for method, job in jobs.items():
+        corrected, runtime, peak_rss = job.get()
+        anndata_dict[method] = _merge_correction(adata, corrected, batch_key, method)
+        stats[method.__name__ if callable(method) else method] = {"runtime": runtime, "peak_rss": peak_rss}
 
     logger.info("Finished batch correction(s)!")
 
+    if return_stats:
+        return anndata_dict, pd.DataFrame.from_dict(stats, orient="index")
     return anndata_dict
 
 
+def _replaces_x(adata: sc.AnnData, method: batch_methods | Callable) -> bool:
+    """Check if .X of adata is replaced by an empty placeholder in the payload of the method."""
+    # sc.pp.neighbors only uses .obsm['X_pca'] for more than N_PCS features
+    return not callable(method) and method.lower() in ["bbknn", "harmony", "scanorama"] and adata.n_vars > sc.settings.N_PCS
+
+
+@beartype
+def _correction_payload(adata: sc.AnnData,
+                        batch_key: str,
+                        method: batch_methods | Callable) -> sc.AnnData:
+    """
+    Build an anndata object with only the inputs needed by a batch correction method.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object to correct.
+    batch_key : str
+        The column in adata.obs containing batch information.
+    method : batch_methods | Callable
+        Batch correction method.
+
+    Returns
+    -------
+    sc.AnnData
+        Anndata object with the batch labels, .var and .uns, and either .obsm['X_pca'] or .X. For custom functions adata itself.
+    """
+
+    if callable(method):
+        return adata  # custom functions can use any part of the object
+
+    if method.lower() in ["bbknn", "harmony", "scanorama"]:
+        X = sparse.csr_matrix(adata.shape, dtype=np.float32) if _replaces_x(adata, method) else adata.X
+        obsm = {"X_pca": adata.obsm["X_pca"]} if "X_pca" in adata.obsm else {}
+    else:  # mnn, combat
+        X = adata.X
+        obsm = {}
+
+    return sc.AnnData(X=X, obs=adata.obs[[batch_key]], var=adata.var, obsm=obsm, uns=adata.uns)
+
+
+@beartype
+def _correction_job(adata: sc.AnnData,
+                    batch_key: str,
+                    method: batch_methods | Callable,
+                    kwargs: dict) -> Tuple[sc.AnnData, float, float]:
+    """
+    Run batch_correction in a worker and measure its wall time and peak memory.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object (payload) to correct.
+    batch_key : str
+        The column in adata.obs containing batch information.
+    method : batch_methods | Callable
+        Batch correction method.
+    kwargs : dict
+        Additional parameters forwarded to batch_correction.
+
+    Returns
+    -------
+    Tuple[sc.AnnData, float, float]
+        Corrected anndata, runtime in seconds and increase of the peak resident set size in MB.
+    """
+
+    start_rss = psutil.Process().memory_info().rss
+    start_time = time.time()
+
+    corrected = batch_correction(adata, batch_key, method, **kwargs)
+
+    runtime = time.time() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)  # kB on linux
+
+    return corrected, runtime, max(peak_rss - start_rss, 0) / 1024 ** 2
+
+
+@beartype
+def _merge_correction(adata: sc.AnnData,
+                      corrected: sc.AnnData,
+                      batch_key: str,
+                      method: batch_methods | Callable) -> sc.AnnData:
+    """
+    Add the parts of adata which were not sent to the worker to the corrected payload.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Uncorrected anndata object.
+    corrected : sc.AnnData
+        Corrected payload as returned by the worker.
+    batch_key : str
+        The column in adata.obs containing batch information.
+    method : batch_methods | Callable
+        Batch correction method.
+
+    Returns
+    -------
+    sc.AnnData
+        Corrected anndata object with the remaining tables and matrices of adata.
+    """
+
+    if callable(method):
+        return corrected
+
+    # methods may return the cells in a different order
+    order = adata.obs_names.get_indexer(corrected.obs_names)
+    same_order = np.array_equal(order, np.arange(adata.n_obs))
+
+    def take(mat):
+        return mat if same_order else mat[order]
+
+    obs = adata.obs.iloc[order].copy()
+    obs[batch_key] = corrected.obs[batch_key].values  # methods may change the type of the batch column
+    corrected.obs = obs
+
+    if _replaces_x(adata, method):
+        corrected.X = take(adata.X)
+    for key, value in adata.layers.items():
+        if key not in corrected.layers:
+            corrected.layers[key] = take(value)
+    for key, value in adata.obsm.items():
+        if key not in corrected.obsm:
+            corrected.obsm[key] = take(value)
+    for key, value in adata.varm.items():
+        if key not in corrected.varm:
+            corrected.varm[key] = value
+    if same_order:
+        for key, value in adata.obsp.items():
+            if key not in corrected.obsp:
+                corrected.obsp[key] = value
+
+    return corrected
+
+
 @deco.log_anndata
 @beartype
 def batch_correction(adata: sc.AnnData,
@@ -329,6 +651,7 @@ def batch_correction(adata: sc.AnnData,
             - combat
     highly_variable : bool, default True
         Only for method 'mnn'. If True, only the highly variable genes (column 'highly_variable' in .var) will be used for batch correction.
+        Only these genes are corrected in .X (as float32); the other genes keep their values.
     **kwargs : Any
         Additional arguments will be forwarded to the method function.
 
@@ -370,29 +693,32 @@ def batch_correction(adata: sc.AnnData,
 
     elif method == "mnn":
 
-        var_table = adata.var  # var_table before batch correction
-
-        # split adata on batch_key
-        batch_categories = list(set(adata.obs[batch_key]))
-        adatas = [adata[adata.obs[batch_key] == category] for category in batch_categories]
-
-        # Set highly variable genes as var_subset if chosen (and available)
-        var_subset = None
-        if highly_variable:
-            if "highly_variable" in adata.var.columns:
-                var_subset = adata.var[adata.var.highly_variable].index
-
-        # give individual adatas to mnn_correct
-        corrected_adatas, _, _ = sce.pp.mnn_correct(adatas, batch_key=batch_key, var_subset=var_subset,
-                                                    batch_categories=batch_categories, do_concatenate=False, **kwargs)
-
-        # Join corrected adatas
-        corrected_adatas = corrected_adatas[0]  # the output is a dict of list ([adata1, adata2, (...)], )
-        adata = sc.concat(corrected_adatas, join="outer", uns_merge="first")
-        adata.var = var_table  # add var table back into corrected adata
-
-        sc.pp.scale(adata)  # from the mnnpy github example
-        sc.tl.pca(adata)  # rerun pca
+        # Correct the highly variable genes (if chosen and available) as float32 matrices per batch
+        var_mask = np.ones(adata.n_vars, dtype=bool)
+        if highly_variable and "highly_variable" in adata.var.columns:
+            var_mask = adata.var["highly_variable"].to_numpy(dtype=bool)
+        var_idx = np.flatnonzero(var_mask)
+
+        # Per batch row indices instead of copies of the adata
+        codes, batch_categories = pd.factorize(adata.obs[batch_key], sort=True)
+        batch_rows = [np.flatnonzero(codes == i) for i in range(len(batch_categories))]
+        batches = [_dense_float32(adata.X[rows][:, var_idx]) for rows in batch_rows]
+
+        # give individual batches to mnn_correct; the corrected batches are returned as a list of arrays
+        corrected, _, _ = sce.pp.mnn_correct(*batches, var_index=adata.var_names[var_idx], batch_categories=list(batch_categories),
+                                             do_concatenate=False, **kwargs)
+        del batches
+
+        # Restore the original cell order; each batch is released once it is placed
+        mat = np.empty((adata.n_obs, len(var_idx)), dtype=np.float32)
+        for i, rows in enumerate(batch_rows):
+            mat[rows] = corrected[i]
+            corrected[i] = None
+        del corrected
+
+        # corrected values of the corrected genes; the other matrices of adata are copied, but not the old .X
+        adata = _copy_with_x(adata, _replace_columns(adata.X, var_idx, mat))
+        _scaled_pca(adata, mat, var_idx)  # rerun pca on the scaled matrix (from the mnnpy github example)
         sc.pp.neighbors(adata)
 
     elif method == "harmony":
@@ -404,19 +730,25 @@ def batch_correction(adata: sc.AnnData,
         sc.pp.neighbors(adata)
 
     elif method == "scanorama":
-        adata = adata.copy()  # there is no copy option for scanorama
+        basis = kwargs.get("basis", "X_pca")
+        adjusted_basis = kwargs.get("adjusted_basis", "X_scanorama")
 
-        # scanorama expect the batch key in a sorted format
-        # therefore anndata.obs should be sorted based on batch column before this method.
-        original_order = adata.obs.index
-        adata = adata[adata.obs[batch_key].argsort()]  # sort the whole adata to make sure obs is the same order as matrix
+        # scanorama expects the cells sorted by batch; only the embedding and batch column are permuted
+        order = adata.obs[batch_key].argsort(kind="stable").to_numpy()
+        sorted_adata = sc.AnnData(X=sparse.csr_matrix((adata.n_obs, 0), dtype=np.float32),  # placeholder without features
+                                  obs=adata.obs[[batch_key]].iloc[order],
+                                  obsm={basis: adata.obsm[basis][order]})
+        sce.pp.scanorama_integrate(sorted_adata, key=batch_key, **kwargs)
 
-        sce.pp.scanorama_integrate(adata, key=batch_key, **kwargs)
-        adata.obsm["X_pca"] = adata.obsm["X_scanorama"]
-        sc.pp.neighbors(adata)
+        # sort the embedding back to the original order
+        integrated = np.empty_like(sorted_adata.obsm[adjusted_basis])
+        integrated[order] = sorted_adata.obsm[adjusted_basis]
+        del sorted_adata
 
-        # sort the adata back to the original order
-        adata = adata[original_order]
+        adata = adata.copy()  # there is no copy option for scanorama
+        adata.obsm[adjusted_basis] = integrated
+        adata.obsm["X_pca"] = integrated
+        sc.pp.neighbors(adata)
 
     elif method == "combat":
 
@@ -435,15 +767,156 @@ def batch_correction(adata: sc.AnnData,
     return adata  # the corrected adata object
 
 
+def _dense_float32(mat: np.ndarray | sparse.spmatrix) -> np.ndarray:
+    """Convert a (sparse) matrix to a dense float32 array without copying a dense float32 input."""
+    mat = mat.toarray() if sparse.issparse(mat) else mat
+    return np.asarray(mat, dtype=np.float32)
+
+
+@beartype
+def _replace_columns(mat: np.ndarray | sparse.spmatrix,
+                     columns: np.ndarray,
+                     values: np.ndarray,
+                     chunk_size: int = 10000) -> np.ndarray | sparse.csr_matrix:
+    """
+    Return a float32 copy of mat with the given columns replaced by values.
+
+    For sparse matrices, the rows of the new matrix are assembled directly from the entries of the other columns and the
+    (dense) values, so mat is copied once.
+
+    Parameters
+    ----------
+    mat : np.ndarray | sparse.spmatrix
+        Matrix of shape (n_obs, n_vars). It is not modified.
+    columns : np.ndarray
+        Indices of the columns to replace.
+    values : np.ndarray
+        New values of shape (n_obs, len(columns)).
+    chunk_size : int, default 10000
+        Number of rows per block when writing the values into a sparse matrix.
+
+    Returns
+    -------
+    np.ndarray | sparse.csr_matrix
+        Matrix with the replaced columns. Sparse input stays sparse (csr).
+    """
+
+    if not sparse.issparse(mat):
+        mat = np.array(mat, dtype=np.float32)
+        mat[:, columns] = values
+        return mat
+
+    mat = sparse.csr_matrix(mat)  # no copy for csr input
+    n_obs, n_vars = mat.shape
+    n_columns = len(columns)
+
+    # Entries of the other columns keep their order within each row and are followed by the values
+    replaced = np.zeros(n_vars, dtype=bool)
+    replaced[columns] = True
+    keep = ~replaced[mat.indices]
+    entry_rows = np.repeat(np.arange(n_obs), np.diff(mat.indptr))[keep]
+    n_keep = np.bincount(entry_rows, minlength=n_obs)
+
+    indptr = np.zeros(n_obs + 1, dtype=np.int64)
+    np.cumsum(n_keep + n_columns, out=indptr[1:])
+    index_dtype = np.int32 if max(indptr[-1], n_vars) <= np.iinfo(np.int32).max else np.int64
+    data = np.empty(indptr[-1], dtype=np.float32)
+    indices = np.empty(indptr[-1], dtype=index_dtype)
+
+    kept_start = np.cumsum(n_keep) - n_keep  # position of the first kept entry of each row among all kept entries
+    positions = indptr[entry_rows] + np.arange(len(entry_rows)) - kept_start[entry_rows]
+    data[positions] = mat.data[keep]
+    indices[positions] = mat.indices[keep]
+    del entry_rows, positions, keep
+
+    for start in range(0, n_obs, chunk_size):
+        rows = slice(start, min(start + chunk_size, n_obs))
+        positions = (indptr[:-1][rows] + n_keep[rows])[:, None] + np.arange(n_columns)
+        data[positions] = values[rows]
+        indices[positions] = columns
+
+    result = sparse.csr_matrix((data, indices, indptr.astype(index_dtype)), shape=mat.shape)
+    result.sort_indices()  # in place
+
+    return result
+
+
+def _copy_with_x(adata: sc.AnnData, X: np.ndarray | sparse.spmatrix) -> sc.AnnData:
+    """Copy adata with a new .X without copying the old .X."""
+
+    if adata.is_view:  # .X of a view cannot be removed temporarily
+        copied = adata.copy()
+    else:
+        old_x = adata.X
+        try:
+            adata.X = None
+            copied = adata.copy()
+        finally:
+            adata.X = old_x
+
+    copied.X = X
+    return copied
+
+
+@beartype
+def _scaled_pca(adata: sc.AnnData,
+                mat: np.ndarray,
+                var_idx: np.ndarray,
+                n_comps: int = 50,
+                chunk_size: int = 10000) -> None:
+    """
+    Compute a PCA of the scaled matrix and store it like scanpy.pp.pca.
+
+    The same as sc.pp.scale followed by sc.tl.pca, but the scaling is applied implicitly within the PCA, so mat is not copied.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object to add the PCA to.
+    mat : np.ndarray
+        Matrix of shape (n_obs, len(var_idx)) to decompose.
+    var_idx : np.ndarray
+        Indices of the features in adata.var which correspond to the columns of mat.
+    n_comps : int, default 50
+        Number of principal components.
+    chunk_size : int, default 10000
+        Number of rows per block for the computation of the statistics and embedding.
+    """
+
+    mean, var = chunked_mean_var(mat, None, chunk_size)
+    std = np.sqrt(var)
+    std[std == 0] = 1  # same as sc.pp.scale
+    n_comps = min(n_comps, adata.n_obs - 1, mat.shape[1] - 1)
+
+    _, s, vt = randomized_svd(mat, n_comps, center=mean, scale=std)
+
+    # Project onto the components, so the embedding is consistent with the loadings
+    x_pca = project_blocks(mat, None, vt.T / std[:, None], mean, chunk_size)
+    variance = s ** 2 / (adata.n_obs - 1)
+
+    loadings = np.zeros((adata.n_vars, n_comps))
+    loadings[var_idx] = vt.T
+
+    adata.obsm["X_pca"] = x_pca.astype(np.float32)
+    adata.varm["PCs"] = loadings
+    adata.uns["pca"] = {"params": {"zero_center": True,
+                                   "use_highly_variable": len(var_idx) < adata.n_vars,
+                                   "mask_var": "highly_variable" if len(var_idx) < adata.n_vars else None},
+                        "variance": variance,
+                        "variance_ratio": variance / (var / std ** 2).sum()}
+
+
 @deco.log_anndata
 @beartype
 def evaluate_batch_effect(adata: sc.AnnData,
-                          batch_key: str,
+                          batch_key: str | list[str],
                           obsm_key: str = 'X_umap',
                           col_name: str = 'LISI_score',
-                          max_dims: int = 5,
+                          max_dims: Optional[int] = 5,
                           perplexity: int = 30,
-                          inplace: bool = False) -> Optional[sc.AnnData]:
+                          inplace: bool = False,
+                          use_neighbors: bool = True,
+                          neighbors_key: str = "neighbors") -> Optional[sc.AnnData]:
     """
     Evaluate batch effect methods using LISI.
 
@@ -451,18 +924,25 @@ def evaluate_batch_effect(adata: sc.AnnData,
     ----------
     adata : sc.AnnData
         Anndata object with PCA and umap/tsne for batch evaluation.
-    batch_key : str
-        The column in adata.obs containing batch information.
+    batch_key : str | list[str]
+        The column(s) in adata.obs containing batch information, e.g. batch, condition or cell type. All columns are evaluated
+        on the same neighbors.
     obsm_key : str, default 'X_umap'
         The column in adata.obsm containing coordinates.
     col_name : str, default 'LISI_score'
-        Column name for storing the LISI score in .obs.
-    max_dims : int, default 5
-        Maximum number of dimensions of adata.obsm matrix to use for LISI (to speed up computation).
+        Column name for storing the LISI score in .obs. For multiple batch keys, the scores are stored in '<col_name>_<batch_key>'.
+    max_dims : Optional[int], default 5
+        Maximum number of dimensions of adata.obsm matrix to use for LISI (to speed up computation). If None, all dimensions are used.
     perplexity : int, default 30
         Perplexity for the LISI score calculation.
     inplace : bool, default False
         Whether to work inplace on the anndata object.
+    use_neighbors : bool, default True
+        Use the distances of the neighbor graph in .obsp if it was computed on the same dimensions of obsm_key and has at least
+        3 * perplexity neighbors per cell (of which the nearest 3 * perplexity are used). Otherwise, a kNN with 3 * perplexity neighbors
+        is computed.
+    neighbors_key : str, default "neighbors"
+        Key in .uns of the neighbor graph to reuse.
 
     Returns
     -------
@@ -484,24 +964,25 @@ def evaluate_batch_effect(adata: sc.AnnData,
         2. If batch_key is no column in adata.obs.
     """
 
-    # Load LISI
-    utils.checker.check_module("harmonypy")
-    from harmonypy.lisi import compute_lisi
-
-    # Handle inplace option
-    adata_m = adata if inplace else adata.copy()
+    batch_keys = [batch_key] if isinstance(batch_key, str) else batch_key
 
     # checks
-    if obsm_key not in adata_m.obsm:
+    if obsm_key not in adata.obsm:
         raise KeyError(f"adata.obsm does not contain the obsm key: {obsm_key}")
 
-    if batch_key not in adata_m.obs:
-        raise KeyError(f"adata.obs does not contain the batch key: {batch_key}")
+    missing = [key for key in batch_keys if key not in adata.obs]
+    if missing:
+        raise KeyError(f"adata.obs does not contain the batch key: {', '.join(missing)}")
+
+    # Handle inplace option
+    adata_m = adata if inplace else adata.copy()
 
-    # run LISI on all adata objects
-    obsm_matrix = adata_m.obsm[obsm_key][:, :max_dims]
-    lisi_res = compute_lisi(obsm_matrix, adata_m.obs, [batch_key], perplexity=perplexity)
-    adata_m.obs[col_name] = lisi_res.flatten()
+    # run LISI for all batch keys on the same neighbors
+    mat, perplexity = _lisi_input(adata_m, obsm_key, max_dims, perplexity, use_neighbors, neighbors_key)
+    lisi_res = _lisi(mat, _lisi_codes(adata_m, batch_keys), perplexity)
+
+    for i, key in enumerate(batch_keys):
+        adata_m.obs[col_name if isinstance(batch_key, str) else f"{col_name}_{key}"] = lisi_res[:, i]
 
     if not inplace:
         return adata_m
@@ -509,11 +990,12 @@ def evaluate_batch_effect(adata: sc.AnnData,
 
 @beartype
 def wrap_batch_evaluation(adatas: dict[str, sc.AnnData],
-                          batch_key: str,
+                          batch_key: str | list[str],
                           obsm_keys: str | list[str] = ['X_pca', 'X_umap'],
                           threads: int = 1,
-                          max_dims: int = 5,
-                          inplace: bool = False) -> Optional[dict[str, sc.AnnData]]:
+                          max_dims: Optional[int] = 5,
+                          inplace: bool = False,
+                          use_neighbors: bool = True) -> Optional[dict[str, sc.AnnData]]:
     """
     Evaluate batch correction methods for a dict of anndata objects (using LISI score calculation).
 
@@ -522,16 +1004,18 @@ def wrap_batch_evaluation(adatas: dict[str, sc.AnnData],
     adatas : dict[str, sc.AnnData]
         Dict containing an anndata object for each batch correction method as values. Keys are the name of the respective method.
         E.g.: {"bbknn": anndata}
-    batch_key : str
-        The column in adata.obs containing batch information.
+    batch_key : str | list[str]
+        The column(s) in adata.obs containing batch information. For multiple columns, the scores are stored in 'LISI_score_<obsm>_<batch_key>'.
     obsm_keys : str | list[str], default ['X_pca', 'X_umap']
         Key(s) to coordinates on which the score is calculated.
     threads : int, default 1
-        Number of threads to use for parallelization.
-    max_dims : int, default 5
-        Maximum number of dimensions of adata.obsm matrix to use for LISI (to speed up computation).
+        Number of threads to use for parallelization. The coordinates (or neighbor distances) are passed to the workers via shared memory.
+    max_dims : Optional[int], default 5
+        Maximum number of dimensions of adata.obsm matrix to use for LISI (to speed up computation). If None, all dimensions are used.
     inplace : bool, default False
         Whether to work inplace on the anndata dict.
+    use_neighbors : bool, default True
+        Reuse compatible neighbor graphs, see `evaluate_batch_effect`.
 
     Returns
     -------
@@ -539,55 +1023,265 @@ def wrap_batch_evaluation(adatas: dict[str, sc.AnnData],
         Dict containing an anndata object for each batch correction method as values of LISI scores added to .obs.
     """
 
-    if utils.jupyter._is_notebook() is True:
-        from tqdm import tqdm_notebook as tqdm
-    else:
-        from tqdm import tqdm
-
     # Handle inplace option
     adatas_m = adatas if inplace else copy.deepcopy(adatas)
 
     # Ensure that obsm_key can be looped over
     if isinstance(obsm_keys, str):
         obsm_keys = [obsm_keys]
-
-    # Evaluate batch effect for every adata
+    batch_keys = [batch_key] if isinstance(batch_key, str) else batch_key
+
+    # Collect the neighbors/coordinates of every embedding
+    tasks = {}
+    codes = {}
+    for name, adata in adatas_m.items():
+        perplexity = min(30, int(adata.shape[0] / 3))  # adjust perplexity for small datasets
+        codes[name] = _lisi_codes(adata, batch_keys)
+        for obsm_key in obsm_keys:
+            tasks[(name, obsm_key)] = _lisi_input(adata, obsm_key, max_dims, perplexity, use_neighbors)
+
+    # Evaluate batch effect for every embedding
+    results = {}
     if threads == 1:
+        pbar = utils.multiprocessing.get_pbar(len(tasks), "Calculation progress ")
+        for (name, obsm_key), (mat, perplexity) in tasks.items():
+            results[(name, obsm_key)] = _lisi(mat, codes[name], perplexity)
+            pbar.update()
+        pbar.close()
+    else:
+        handles = []
+        try:
+            specs = {}
+            for key, mat in list(codes.items()) + [(key, mat) for key, (mat, _) in tasks.items()]:
+                mat_handles, specs[key] = utils.multiprocessing.share_matrix(mat)
+                handles.extend(mat_handles)
+
+            pool = mp.Pool(threads)
+            jobs = {}
+            for (name, obsm_key), (_, perplexity) in tasks.items():
+                jobs[(name, obsm_key)] = pool.apply_async(_lisi_job, (specs[(name, obsm_key)], specs[name], perplexity))
+            pool.close()
+
+            # Monitor all jobs with a pbar
+            utils.multiprocessing.monitor_jobs(list(jobs.values()), "Calculating LISI scores")  # waits for all jobs to finish
+            results = {key: job.get() for key, job in jobs.items()}
+            pool.join()
+        finally:
+            utils.multiprocessing.release_shared(handles, unlink=True)
+
+    # Assign results to adata
+    for (name, obsm_key), lisi_res in results.items():
+        for i, key in enumerate(batch_keys):
+            col = f"LISI_score_{obsm_key}" if isinstance(batch_key, str) else f"LISI_score_{obsm_key}_{key}"
+            adatas_m[name].obs[col] = lisi_res[:, i]
+
+    if not inplace:
+        return adatas_m
+
+
+def _lisi_codes(adata: sc.AnnData, batch_keys: list[str]) -> np.ndarray:
+    """Return the category codes (n_obs x n_keys) of the batch keys; missing values get their own code."""
+    codes = [pd.Categorical(adata.obs[key]).codes for key in batch_keys]
+    return np.column_stack([np.where(c < 0, c.max() + 1, c) for c in codes]).astype(np.int32)
+
+
+@beartype
+def _lisi_input(adata: sc.AnnData,
+                obsm_key: str,
+                max_dims: Optional[int],
+                perplexity: int | float,
+                use_neighbors: bool = True,
+                neighbors_key: str = "neighbors") -> Tuple[np.ndarray | sparse.csr_matrix, float]:
+    """
+    Select the neighbor distances or coordinates to calculate LISI on.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object.
+    obsm_key : str
+        The key in adata.obsm containing coordinates.
+    max_dims : Optional[int]
+        Maximum number of dimensions to use.
+    perplexity : int | float
+        Perplexity for the LISI score calculation.
+    use_neighbors : bool, default True
+        Use the distances of the neighbor graph if it was computed on the same dimensions and has at least 3 * perplexity neighbors.
+    neighbors_key : str, default "neighbors"
+        Key in .uns of the neighbor graph.
+
+    Returns
+    -------
+    Tuple[np.ndarray | sparse.csr_matrix, float]
+        Sparse distances of the neighbor graph or the coordinates, and the perplexity to use.
+    """
+
+    coords = np.asarray(adata.obsm[obsm_key])
+    n_dims = coords.shape[1] if max_dims is None else min(max_dims, coords.shape[1])
+
+    neighbors = adata.uns.get(neighbors_key, {})
+    params = neighbors.get("params", {})
+    distances_key = neighbors.get("distances_key", "distances")
+    if use_neighbors and distances_key in adata.obsp:
+        default_rep = "X_pca" if adata.n_vars > sc.settings.N_PCS else "X"
+        graph_rep = params.get("use_rep", default_rep)
+        graph_dims = params.get("n_pcs") or (adata.obsm[graph_rep].shape[1] if graph_rep in adata.obsm else None)
+
+        if graph_rep == obsm_key and graph_dims == n_dims and params.get("metric", "euclidean") == "euclidean":
+            distances = sparse.csr_matrix(adata.obsp[distances_key])
+            if np.diff(distances.indptr).min() >= min(int(perplexity * 3), adata.n_obs - 1):
+                return distances, float(perplexity)
+            logger.info(f"The neighbor graph of '{obsm_key}' has fewer than 3 * perplexity neighbors; computing the neighbors for LISI")
+
+    return np.ascontiguousarray(coords[:, :n_dims], dtype=np.float64), float(perplexity)
+
+
+def _lisi_job(spec: dict[str, Any], codes_spec: dict[str, Any], perplexity: float) -> np.ndarray:
+    """Calculate LISI from a matrix and codes in shared memory (run within worker processes)."""
+
+    mat, handles = utils.multiprocessing.load_shared_matrix(spec)
+    codes, codes_handles = utils.multiprocessing.load_shared_matrix(codes_spec)
+    try:
+        lisi_res = _lisi(mat, codes, perplexity)
+        del mat, codes
+    finally:
+        utils.multiprocessing.release_shared(handles)
+        utils.multiprocessing.release_shared(codes_handles)
+
+    return lisi_res
 
-        pbar = tqdm(total=len(adatas_m) * len(obsm_keys), desc="Calculation progress ")
-        for adata in adatas_m.values():
-            n_cells = adata.shape[0]
-            perplexity = min(30, int(n_cells / 3))  # adjust perplexity for small datasets
 
-            for obsm in obsm_keys:
-                evaluate_batch_effect(adata, batch_key, col_name=f"LISI_score_{obsm}", obsm_key=obsm, max_dims=max_dims, perplexity=perplexity, inplace=True)
-                pbar.update()
+@beartype
+def _lisi(mat: np.ndarray | sparse.spmatrix,
+          codes: np.ndarray,
+          perplexity: int | float,
+          random_state: int = 0) -> np.ndarray:
+    """
+    Calculate the Local Inverse Simpson Index of every cell for one or more label columns.
+
+    The neighbors are calibrated to the perplexity once and used for all label columns (as in harmonypy's compute_lisi).
+
+    Parameters
+    ----------
+    mat : np.ndarray | sparse.spmatrix
+        Coordinates (n_obs x n_dims) or sparse distances of a neighbor graph (n_obs x n_obs).
+    codes : np.ndarray
+        Integer codes of the labels of shape (n_obs, n_columns).
+    perplexity : int | float
+        Effective number of neighbors.
+    random_state : int, default 0
+        Seed for the approximate kNN (pynndescent), which is used for more than 10 dimensions.
+
+    Returns
+    -------
+    np.ndarray
+        LISI scores of shape (n_obs, n_columns).
+    """
+
+    k = min(int(perplexity * 3), mat.shape[0] - 1)
+    if sparse.issparse(mat):
+        indices, distances = _graph_neighbors(sparse.csr_matrix(mat))
+
+        # use the k nearest neighbors of the graph (as for coordinates)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        indices, distances = np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
     else:
-        utils.checker.check_module("harmonypy")
-        from harmonypy.lisi import compute_lisi
+        if mat.shape[1] <= 10:  # a KD-tree is exact and faster for few dimensions (e.g. umap, max_dims PCs)
+            distances, indices = NearestNeighbors(n_neighbors=k + 1, algorithm="kd_tree").fit(mat).kneighbors(mat)
+        else:
+            indices, distances = NNDescent(mat, n_neighbors=k + 1, random_state=random_state).neighbor_graph
 
-        pool = mp.Pool(threads)
-        jobs = {}
-        for i, adata in enumerate(adatas_m.values()):
-            n_cells = adata.shape[0]
-            perplexity = min(30, int(n_cells / 3))  # adjust perplexity for small datasets
+        # remove each cell from its own neighbors
+        is_self = indices == np.arange(mat.shape[0])[:, None]
+        order = np.argsort(is_self, axis=1, kind="stable")[:, :k]
+        indices, distances = np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1).astype(np.float64)
 
-            for obsm_key in obsm_keys:
-                obsm_matrix = adata.obsm[obsm_key][:, :max_dims]
-                obs_mat = adata.obs[[batch_key]]
+    weights, entropy = _perplexity_weights(distances, perplexity)
 
-                job = pool.apply_async(compute_lisi, args=(obsm_matrix, obs_mat, [batch_key], perplexity,))
-                jobs[(i, obsm_key)] = job
-        pool.close()
+    # Simpson index: sum over categories of the squared neighbor weights per category
+    n_obs, k = indices.shape
+    lisi_res = np.empty((n_obs, codes.shape[1]))
+    for i in range(codes.shape[1]):
+        n_categories = codes[:, i].max() + 1
+        bins = (np.arange(n_obs)[:, None] * n_categories + codes[indices, i]).ravel()
+        per_category = np.bincount(bins, weights=weights.ravel(), minlength=n_obs * n_categories)
+        simpson = (per_category.reshape(n_obs, n_categories) ** 2).sum(axis=1)
+        with np.errstate(divide="ignore"):
+            lisi_res[:, i] = 1 / simpson
+        lisi_res[entropy == 0, i] = -1  # as in harmonypy
 
-        # Monitor all jobs with a pbar
-        utils.multiprocessing.monitor_jobs(jobs, "Calculating LISI scores")  # waits for all jobs to finish
-        pool.join()
+    return lisi_res
 
-        # Assign results to adata
-        for adata_i, obsm_key in jobs:
-            adata = list(adatas_m.values())[adata_i]
-            adata.obs[f"LISI_score_{obsm_key}"] = jobs[(adata_i, obsm_key)].get().flatten()
 
-    if not inplace:
-        return adatas_m
+def _graph_neighbors(distances: sparse.csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert sparse distances to dense neighbor indices and distances; rows with fewer neighbors are padded with infinite distances."""
+
+    counts = np.diff(distances.indptr)
+    k = counts.max()
+    rows = np.repeat(np.arange(distances.shape[0]), counts)
+    cols = np.arange(len(rows)) - np.repeat(distances.indptr[:-1], counts)
+
+    indices = np.zeros((distances.shape[0], k), dtype=np.int64)
+    dense = np.full((distances.shape[0], k), np.inf)
+    indices[rows, cols] = distances.indices
+    dense[rows, cols] = distances.data
+
+    return indices, dense
+
+
+def _perplexity_weights(distances: np.ndarray,
+                        perplexity: int | float,
+                        tol: float = 1e-5,
+                        n_tries: int = 50) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find Gaussian kernel weights per cell with the given perplexity by a binary search over all cells at once.
+
+    Parameters
+    ----------
+    distances : np.ndarray
+        Distances to the neighbors of shape (n_obs, k).
+    perplexity : int | float
+        Target perplexity.
+    tol : float, default 1e-5
+        Tolerance of the entropy.
+    n_tries : int, default 50
+        Maximum number of search steps.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Normalized weights of shape (n_obs, k) and the entropy of each cell.
+    """
+
+    def kernel(dist, beta):
+        weights = np.exp(-dist * beta[:, None])
+        total = weights.sum(axis=1)
+        weighted = np.where(weights > 0, dist * weights, 0).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy = np.where(total > 0, np.log(total) + beta * weighted / total, 0)
+            weights = np.where(total[:, None] > 0, weights / total[:, None], 0)
+        return weights, entropy
+
+    n_obs = distances.shape[0]
+    beta = np.ones(n_obs)
+    beta_min = np.full(n_obs, -np.inf)
+    beta_max = np.full(n_obs, np.inf)
+    weights, entropy = kernel(distances, beta)
+
+    for _ in range(n_tries):
+        diff = entropy - np.log(perplexity)
+        active = np.abs(diff) >= tol
+        if not active.any():
+            break
+
+        # increase beta for too high entropy, decrease it otherwise
+        up = active & (diff > 0)
+        down = active & (diff <= 0)
+        beta_min[up] = beta[up]
+        beta[up] = np.where(np.isfinite(beta_max[up]), (beta[up] + beta_max[up]) / 2, beta[up] * 2)
+        beta_max[down] = beta[down]
+        beta[down] = np.where(np.isfinite(beta_min[down]), (beta[down] + beta_min[down]) / 2, beta[down] / 2)
+
+        weights[active], entropy[active] = kernel(distances[active], beta[active])
+
+    return weights, entropy
@@ -14,7 +14,10 @@ from kneed import KneeLocator
 import matplotlib.pyplot as plt
 import scrublet as scr
 import scipy.stats as stats
+import scipy
 from scipy.sparse import csr_matrix
+from pynndescent import NNDescent
+from skimage.filters import threshold_minimum
 
 from beartype import beartype
 import numpy.typing as npt
@@ -24,6 +27,8 @@ from beartype.typing import Optional, Tuple, Union, Any, Literal, Callable, Dict
 import sctoolbox.utils as utils
 import sctoolbox.plotting as pl
 from sctoolbox.plotting.general import _save_figure
+from sctoolbox.tools.marker_genes import score_gene_sets, get_chromosome_genes
+from sctoolbox.tools.dim_reduction import randomized_svd
 import sctoolbox.utils.decorator as deco
 from sctoolbox._settings import settings
 logger = settings.logger
@@ -41,10 +46,14 @@ _uns_report_path = ["sctoolbox", "report", "qc"]
 def calculate_qc_metrics(adata: sc.AnnData,
                          percent_top: Optional[list[int]] = None,
                          inplace: bool = False,
+                         chunk_size: Optional[int] = None,
                          **kwargs: Any) -> Optional[sc.AnnData]:
     """
     Calculate the qc metrics using `scanpy.pp.calculate_qc_metrics`.
 
+    For backed anndata objects or if 'chunk_size' is given, the metrics are calculated in one pass over blocks of rows of .X (or the layer given in kwargs)
+    without loading the full matrix. Only .obs and .var are written.
+
     Parameters
     ----------
     adata : sc.AnnData
@@ -53,14 +62,22 @@ def calculate_qc_metrics(adata: sc.AnnData,
         Which proportions of top genes to cover.
     inplace : bool, default False
         If the anndata object should be modified in place.
+    chunk_size : Optional[int], default None
+        Number of rows per block for the chunked calculation. If None, scanpy.pp.calculate_qc_metrics is used for in-memory data
+        and blocks of 10000 rows for backed data.
     **kwargs : Any
-        Additional parameters forwarded to scanpy.pp.calculate_qc_metrics.
+        Additional parameters forwarded to scanpy.pp.calculate_qc_metrics. The chunked calculation supports 'qc_vars', 'expr_type', 'var_type', 'log1p' and 'layer'.
 
     Returns
     -------
     Optional[sc.AnnData]
         Returns anndata object with added quality metrics to .obs and .var. Returns None if `inplace=True`.
 
+    Raises
+    ------
+    ValueError
+        If `inplace=False` for a backed anndata object.
+
     See Also
     --------
     scanpy.pp.calculate_qc_metrics
@@ -79,6 +96,11 @@ def calculate_qc_metrics(adata: sc.AnnData,
         print("Columns in .obs after 'calculate_qc_metrics':", adata.obs.columns.tolist())
     """
 
+    if adata.isbacked:
+        if not inplace:
+            raise ValueError("Copying a backed anndata object would load the full matrix. Please set inplace=True.")
+        chunk_size = 10000 if chunk_size is None else chunk_size
+
     # add metrics to copy of anndata
     if not inplace:
         adata = adata.copy()
@@ -88,7 +110,17 @@ def calculate_qc_metrics(adata: sc.AnnData,
     adata.obs.drop(columns=to_remove, inplace=True)
 
     # compute metrics
-    sc.pp.calculate_qc_metrics(adata=adata, percent_top=percent_top, inplace=True, **kwargs)
+    if chunk_size is None:
+        sc.pp.calculate_qc_metrics(adata=adata, percent_top=percent_top, inplace=True, **kwargs)
+    else:
+        layer = kwargs.pop("layer", None)
+        matrix = adata.X if layer is None else adata.layers[layer]
+        obs_metrics, var_metrics = _chunked_qc_metrics(matrix, adata.var, percent_top=percent_top, chunk_size=chunk_size, **kwargs)
+
+        for col in obs_metrics.columns:
+            adata.obs[col] = obs_metrics[col].values
+        for col in var_metrics.columns:
+            adata.var[col] = var_metrics[col].values
 
     # Rename metrics
     adata.obs.rename(columns={"n_genes_by_counts": "n_genes", "log1p_n_genes_by_counts": "log1p_n_genes",
@@ -99,6 +131,145 @@ def calculate_qc_metrics(adata: sc.AnnData,
         return adata
 
 
+@beartype
+def _top_segment_proportions(block: Any, ns: list[int]) -> npt.NDArray[np.float64]:
+    """
+    Get the proportion of counts in the top n features of each row of a block.
+
+    Parameters
+    ----------
+    block : Any
+        Dense array or scipy sparse matrix of shape (n_rows, n_features).
+    ns : list[int]
+        Numbers of top features.
+
+    Returns
+    -------
+    npt.NDArray[np.float64]
+        Array of shape (n_rows, len(ns)) with the proportions.
+    """
+
+    block = scipy.sparse.csr_matrix(block)
+    block.eliminate_zeros()
+    starts, ends = block.indptr[:-1], block.indptr[1:]
+
+    # Sort values descending within each row and get cumulative sums
+    rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+    order = np.lexsort((-block.data, rows))
+    cumsum = np.concatenate([[0], np.cumsum(block.data[order], dtype=np.float64)])
+
+    totals = cumsum[ends] - cumsum[starts]
+    top = np.column_stack([cumsum[np.minimum(starts + n, ends)] - cumsum[starts] for n in ns])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return top / totals[:, None]
+
+
+@beartype
+def _chunked_qc_metrics(matrix: Any,
+                        var: pd.DataFrame,
+                        percent_top: Optional[list[int]] = None,
+                        qc_vars: str | list[str] | tuple = (),
+                        expr_type: str = "counts",
+                        var_type: str = "genes",
+                        log1p: bool = True,
+                        chunk_size: int = 10000) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Calculate the metrics of scanpy.pp.calculate_qc_metrics in one pass over blocks of rows.
+
+    Parameters
+    ----------
+    matrix : Any
+        Cells x features matrix which supports slicing of rows, e.g. a backed .X.
+    var : pd.DataFrame
+        Table of features containing the boolean 'qc_vars' columns.
+    percent_top : Optional[list[int]], default None
+        Which proportions of top genes to cover.
+    qc_vars : str | list[str] | tuple, default ()
+        Boolean columns in var to calculate the proportion of counts for.
+    expr_type : str, default "counts"
+        Name of the kind of values in matrix.
+    var_type : str, default "genes"
+        Name of the kind of features.
+    log1p : bool, default True
+        Whether to add log1p transformed metrics.
+    chunk_size : int, default 10000
+        Number of rows per block.
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        Metrics per cell and per feature with the column names of scanpy.
+
+    Raises
+    ------
+    ValueError
+        If percent_top contains values outside of the number of features.
+    """
+
+    n_obs, n_vars = matrix.shape
+    qc_vars = [qc_vars] if isinstance(qc_vars, str) else list(qc_vars)
+    percent_top = sorted(percent_top) if percent_top else []
+    if percent_top and (percent_top[-1] > n_vars or percent_top[0] <= 0):
+        raise ValueError("Positions in 'percent_top' are outside of the range of features.")
+
+    qc_masks = np.column_stack([var[qc_var].to_numpy(dtype=bool) for qc_var in qc_vars]).astype(np.float64) if qc_vars else None
+
+    n_features = np.zeros(n_obs, dtype=np.int64)
+    totals = np.zeros(n_obs, dtype=np.float64)
+    top = np.zeros((n_obs, len(percent_top)), dtype=np.float64)
+    qc_totals = np.zeros((n_obs, len(qc_vars)), dtype=np.float64)
+    n_cells = np.zeros(n_vars, dtype=np.int64)
+    var_totals = np.zeros(n_vars, dtype=np.float64)
+
+    for start in range(0, n_obs, chunk_size):
+        end = min(start + chunk_size, n_obs)
+        block = matrix[start:end]
+        if isinstance(block, np.matrix):
+            block = block.getA()
+
+        nonzero = block != 0
+        n_features[start:end] = np.asarray(nonzero.sum(axis=1)).ravel()
+        n_cells += np.asarray(nonzero.sum(axis=0)).ravel()
+
+        totals[start:end] = np.asarray(block.sum(axis=1, dtype=np.float64)).ravel()
+        var_totals += np.asarray(block.sum(axis=0, dtype=np.float64)).ravel()
+
+        if qc_masks is not None:
+            qc_totals[start:end] = block @ qc_masks
+        if percent_top:
+            top[start:end] = _top_segment_proportions(block, percent_top)
+
+    # Assemble tables in the order of scanpy
+    obs_metrics = pd.DataFrame(index=np.arange(n_obs))
+    obs_metrics[f"n_{var_type}_by_{expr_type}"] = n_features
+    if log1p:
+        obs_metrics[f"log1p_n_{var_type}_by_{expr_type}"] = np.log1p(n_features)
+    obs_metrics[f"total_{expr_type}"] = totals
+    if log1p:
+        obs_metrics[f"log1p_total_{expr_type}"] = np.log1p(totals)
+    for i, n in enumerate(percent_top):
+        obs_metrics[f"pct_{expr_type}_in_top_{n}_{var_type}"] = top[:, i] * 100
+    for i, qc_var in enumerate(qc_vars):
+        obs_metrics[f"total_{expr_type}_{qc_var}"] = qc_totals[:, i]
+        if log1p:
+            obs_metrics[f"log1p_total_{expr_type}_{qc_var}"] = np.log1p(qc_totals[:, i])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            obs_metrics[f"pct_{expr_type}_{qc_var}"] = qc_totals[:, i] / totals * 100
+
+    var_metrics = pd.DataFrame(index=np.arange(n_vars))
+    var_metrics[f"n_cells_by_{expr_type}"] = n_cells
+    var_metrics[f"mean_{expr_type}"] = var_totals / n_obs
+    if log1p:
+        var_metrics[f"log1p_mean_{expr_type}"] = np.log1p(var_totals / n_obs)
+    var_metrics[f"pct_dropout_by_{expr_type}"] = (1 - n_cells / n_obs) * 100
+    var_metrics[f"total_{expr_type}"] = var_totals
+    if log1p:
+        var_metrics[f"log1p_total_{expr_type}"] = np.log1p(var_totals)
+
+    return obs_metrics, var_metrics
+
+
 @deco.log_anndata
 @beartype
 def predict_cell_cycle(adata: sc.AnnData,
@@ -220,16 +391,18 @@ def predict_cell_cycle(adata: sc.AnnData,
     else:
         raise ValueError("Please provide either a supported species or lists of genes!")
 
-    # Scale the data before scoring
-    sdata = sc.pp.scale(adata, copy=True)
+    # Score the cells by s phase and g2m phase in one pass (scaling is applied to the cell cycle genes only)
+    scores = score_gene_sets(adata, {"S_score": s_genes, "G2M_score": g2m_genes},
+                             ctrl_size=min(len(s_genes), len(g2m_genes)))
 
-    # Score the cells by s phase or g2m phase
-    sc.tl.score_genes_cell_cycle(sdata, s_genes=s_genes, g2m_genes=g2m_genes)
+    # assign phase with the highest score; G1 if both scores are negative
+    phase = np.where(scores["G2M_score"] > scores["S_score"], "G2M", "S")
+    phase[(scores < 0).all(axis=1).to_numpy()] = "G1"
 
     # add results to adata
-    adata.obs['S_score'] = sdata.obs['S_score']
-    adata.obs['G2M_score'] = sdata.obs['G2M_score']
-    adata.obs['phase'] = sdata.obs['phase']
+    adata.obs['S_score'] = scores['S_score']
+    adata.obs['G2M_score'] = scores['G2M_score']
+    adata.obs['phase'] = pd.Categorical(phase)
 
     # plot a bar plot showing counts (and proportions) of cells in each phase
     if plot:
@@ -250,6 +423,7 @@ def estimate_doublets(adata: sc.AnnData,
                       groupby: Optional[str] = None,
                       threads: int = 4,
                       fill_na: bool = True,
+                      fast: bool = False,
                       **kwargs: Any) -> Optional[sc.AnnData]:
     """
     Estimate doublet cells using scrublet.
@@ -278,6 +452,11 @@ def estimate_doublets(adata: sc.AnnData,
         If True, replaces NA values returned by scrublet with 0 and False. Scrublet returns NA if it cannot calculate
         a doublet score. Keep in mind that this does not mean that it is no doublet.
         By setting this parameter true it is assmuned that it is no doublet.
+    fast : bool, default False
+        If True, uses the in-package doublet scorer instead of scrublet, which simulates doublets by sparse row sums,
+        embeds cells with a randomized PCA and queries an approximate nearest neighbor index. Recommended for large datasets.
+        Supported kwargs are sim_doublet_ratio, expected_doublet_rate, stdev_doublet_rate, n_neighbors, n_prin_comps
+        and random_state.
     **kwargs : Any
         Additional arguments are passed to scanpy.external.pp.scrublet.
 
@@ -298,49 +477,41 @@ def estimate_doublets(adata: sc.AnnData,
     # Estimate doublets
     if groupby is not None:
 
-        all_groups = adata.obs[groupby].astype("category").cat.categories.tolist()
-        if threads > 1:
-            pool = mp.Pool(threads, maxtasksperchild=1)  # maxtasksperchild to avoid memory leaks
+        groups = adata.obs[groupby].astype("category")
+        all_groups = groups.cat.categories.tolist()
+        codes = groups.cat.codes.to_numpy()
+        group_rows = [np.flatnonzero(codes == i) for i in range(len(all_groups))]
 
-            # Run scrublet for each sub data
+        if threads > 1:
+            # Run scrublet for each group on a shared copy of X
             logger.info("Sending {0} batches to {1} threads".format(len(all_groups), threads))
-            jobs = []
-            for i, sub in enumerate([adata[adata.obs[groupby] == group] for group in all_groups]):
-
-                # Clean up adata before sending to thread
-                sub.uns = {}
-                sub.layers = None
-
-                job = pool.apply_async(_run_scrublet, (sub, use_native, threshold), {"verbose": False, **kwargs})
-                jobs.append(job)
-            pool.close()
-
-            utils.multiprocessing.monitor_jobs(jobs, "Scrublet per group")
-            results = [job.get() for job in jobs]
+            results = _scrublet_groups_parallel(adata.X, group_rows, threads, use_native, threshold,
+                                                {"verbose": False, "fast": fast, **kwargs})
 
         else:
             results = []
-            for i, sub in enumerate([adata[adata.obs[groupby] == group] for group in all_groups]):
+            for i, rows in enumerate(group_rows):
                 logger.info("Scrublet per group: {}/{}".format(i + 1, len(all_groups)))
-                res = _run_scrublet(sub, use_native=use_native, threshold=threshold, verbose=False, **kwargs)
-                results.append(res)
+                obs, uns = _run_scrublet(adata[rows], use_native=use_native, threshold=threshold, verbose=False, fast=fast, **kwargs)
+                results.append((obs["doublet_score"].to_numpy(), obs["predicted_doublet"].to_numpy(), uns["doublet_scores_sim"]))
 
-        # Collect results for each element in tuples
-        all_obs = [res[0] for res in results]
-        all_uns = [res[1] for res in results]
+        # Place the per group results in the original cell order
+        doublet_score = np.full(adata.n_obs, np.nan)
+        predicted_doublet = np.full(adata.n_obs, np.nan, dtype=object)
+        for rows, (scores, predicted, _) in zip(group_rows, results):
+            doublet_score[rows] = scores
+            predicted_doublet[rows] = predicted
 
-        # Merge all simulated scores
-        uns_dict = {"threshold": threshold, "doublet_scores_sim": np.array([])}
-        for uns in all_uns:
-            uns_dict["doublet_scores_sim"] = np.concatenate((uns_dict["doublet_scores_sim"], uns["doublet_scores_sim"]))
+        obs_table = pd.DataFrame({"doublet_score": doublet_score, "predicted_doublet": predicted_doublet},
+                                 index=adata.obs_names).infer_objects()
 
-        # Merge all obs tables
-        obs_table = pd.concat(all_obs)
-        obs_table = obs_table.loc[adata.obs_names.tolist(), :]  # Sort obs to match original order
+        # Merge all simulated scores
+        uns_dict = {"threshold": threshold,
+                    "doublet_scores_sim": np.concatenate([np.array([])] + [res[2] for res in results])}
 
     else:
         # Run scrublet on adata
-        obs_table, uns_dict = _run_scrublet(adata, threshold=threshold, **kwargs)
+        obs_table, uns_dict = _run_scrublet(adata, threshold=threshold, fast=fast, **kwargs)
 
     # Save scores to object
     # ImplicitModificationWarning
@@ -365,9 +536,98 @@ def estimate_doublets(adata: sc.AnnData,
         return adata
 
 
+def _scrublet_groups_parallel(X: np.ndarray | csr_matrix | scipy.sparse.spmatrix,
+                              group_rows: list[np.ndarray],
+                              threads: int,
+                              use_native: bool,
+                              threshold: Optional[float],
+                              kwargs: dict[str, Any]) -> list[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Run scrublet per group in worker processes reading X from shared memory.
+
+    Parameters
+    ----------
+    X : np.ndarray | csr_matrix | scipy.sparse.spmatrix
+        Expression matrix of all cells.
+    group_rows : list[np.ndarray]
+        Row indices of the cells in each group.
+    threads : int
+        Number of processes to use.
+    use_native : bool
+        If True, uses the native implementation of scrublet.
+    threshold : Optional[float]
+        Threshold for doublet detection.
+    kwargs : dict[str, Any]
+        Additional arguments passed to _run_scrublet.
+
+    Returns
+    -------
+    list[Tuple[np.ndarray, np.ndarray, np.ndarray]]
+        Per group tuple of doublet scores, predicted doublets and simulated doublet scores.
+    """
+
+    if scipy.sparse.issparse(X) and X.format not in ["csr", "csc"]:
+        X = X.tocsr()
+
+    handles, spec = utils.multiprocessing.share_matrix(X)
+    try:
+        pool = mp.Pool(min(threads, len(group_rows)))
+        jobs = [pool.apply_async(_scrublet_group_job, (spec, rows, use_native, threshold), kwargs) for rows in group_rows]
+        pool.close()
+
+        utils.multiprocessing.monitor_jobs(jobs, "Scrublet per group")
+        results = [job.get() for job in jobs]
+        pool.join()
+
+    finally:
+        utils.multiprocessing.release_shared(handles, unlink=True)
+
+    return results
+
+
+def _scrublet_group_job(spec: dict[str, Any],
+                        rows: np.ndarray,
+                        use_native: bool,
+                        threshold: Optional[float],
+                        **kwargs: Any) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Run scrublet on the rows of one group from the shared matrix (run within worker processes).
+
+    Parameters
+    ----------
+    spec : dict[str, Any]
+        Description of the shared expression matrix.
+    rows : np.ndarray
+        Row indices of the cells in the group.
+    use_native : bool
+        If True, uses the native implementation of scrublet.
+    threshold : Optional[float]
+        Threshold for doublet detection.
+    **kwargs : Any
+        Additional arguments passed to _run_scrublet.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Doublet scores, predicted doublets and simulated doublet scores of the group.
+    """
+
+    mat, handles = utils.multiprocessing.load_shared_matrix(spec)
+    try:
+        sub = sc.AnnData(X=mat[rows])  # copies only the rows of the group
+        del mat
+    finally:
+        utils.multiprocessing.release_shared(handles)
+
+    obs, uns = _run_scrublet(sub, use_native=use_native, threshold=threshold, **kwargs)
+
+    return obs["doublet_score"].to_numpy(), obs["predicted_doublet"].to_numpy(), np.asarray(uns["doublet_scores_sim"])
+
+
 def _run_scrublet(adata: sc.AnnData,
                   use_native: bool = False,
                   threshold: Optional[float] = None,
+                  fast: bool = False,
                   **kwargs: Any) -> Tuple[pd.DataFrame, dict[str, Union[np.ndarray, float, dict[str, float]]]]:
     """
     Thread-safe wrapper for running scrublet, which also takes care of catching any warnings.
@@ -380,8 +640,10 @@ def _run_scrublet(adata: sc.AnnData,
         If True, uses the native implementation of scrublet.
     threshold : float, default 0.25
         Threshold for doublet detection.
+    fast : bool, default False
+        If True, uses the in-package doublet scorer (see _score_doublets).
     **kwargs : Any
-        Additional arguments are passed to scanpy.external.pp.scrublet.
+        Additional arguments are passed to scanpy.external.pp.scrublet or _score_doublets.
 
     Returns
     -------
@@ -393,7 +655,14 @@ def _run_scrublet(adata: sc.AnnData,
         warnings.filterwarnings("ignore", category=UserWarning, message="Received a view of an AnnData*")
         warnings.filterwarnings("ignore", category=anndata.ImplicitModificationWarning, message="Trying to modify attribute `.obs`*")  # because adata is a view
 
-        if use_native:
+        if fast:
+            doublet_scores, predicted_doublets, uns = _score_doublets(adata.X, threshold=threshold, **kwargs)
+
+            adata.obs["doublet_score"] = doublet_scores
+            adata.obs["predicted_doublet"] = predicted_doublets
+            adata.uns["scrublet"] = uns
+
+        elif use_native:
             # Run scrublet with native implementation
             X = adata.X
             scrub = scr.Scrublet(X)
@@ -414,18 +683,171 @@ def _run_scrublet(adata: sc.AnnData,
     return (adata.obs, adata.uns["scrublet"])
 
 
+@beartype
+def _score_doublets(X: np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray,
+                    threshold: Optional[float] = None,
+                    sim_doublet_ratio: float = 2.0,
+                    expected_doublet_rate: float = 0.05,
+                    stdev_doublet_rate: float = 0.02,
+                    n_neighbors: Optional[int] = None,
+                    n_prin_comps: int = 30,
+                    random_state: int = 0,
+                    verbose: bool = True) -> Tuple[np.ndarray, np.ndarray, dict[str, Any]]:
+    """
+    Score doublets with the scrublet approach without densifying the count matrix.
+
+    Doublets are simulated by summing the sparse count rows of random cell pairs. Observed and simulated cells
+    are normalized on the highly variable genes, z-scored with the statistics of the observed cells and embedded
+    with a randomized PCA fitted on the observed cells. The doublet score is derived from the fraction of simulated
+    doublets among the nearest neighbors found with an approximate nearest neighbor index.
+
+    Parameters
+    ----------
+    X : np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray
+        Raw count matrix (cells x genes).
+    threshold : Optional[float], default None
+        Doublet score threshold for calling doublets. If None, the threshold is set automatically
+        at the minimum between the two modes of the simulated doublet scores.
+    sim_doublet_ratio : float, default 2.0
+        Number of doublets to simulate relative to the number of observed cells.
+    expected_doublet_rate : float, default 0.05
+        The estimated doublet rate for the experiment.
+    stdev_doublet_rate : float, default 0.02
+        Uncertainty in the expected doublet rate.
+    n_neighbors : Optional[int], default None
+        Number of neighbors. If None, this is set to round(0.5 * sqrt(n_obs)).
+    n_prin_comps : int, default 30
+        Number of principal components used to embed the cells.
+    random_state : int, default 0
+        Seed for doublet simulation, PCA and nearest neighbor search.
+    verbose : bool, default True
+        If True, log the automatically selected threshold.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, dict[str, Any]]
+        Doublet score and predicted doublet per cell (NaN for cells with less than 3 genes) and the
+        content for adata.uns["scrublet"] in the same layout as scanpy.pp.scrublet.
+    """
+
+    X = csr_matrix(X, dtype=np.float32)
+    n_cells = X.shape[0]
+
+    # Filter genes (>= 3 cells) and cells (>= 3 genes) as scrublet
+    gene_mask = np.diff(X.tocsc().indptr) >= 3
+    X = X[:, gene_mask]
+    cell_idx = np.flatnonzero(np.diff(X.indptr) >= 3)
+    X = X[cell_idx]
+    n_obs = X.shape[0]
+
+    # Select highly variable genes on the log-normalized counts
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    norm = X.multiply((np.median(totals) / np.where(totals > 0, totals, 1))[:, None]).tocsr()
+    norm.data = np.log1p(norm.data)
+    hvg = sc.pp.highly_variable_genes(sc.AnnData(norm), inplace=False)["highly_variable"].to_numpy()
+    del norm
+    counts = X[:, hvg]
+
+    # Simulate doublets by summing the counts of random pairs of cells
+    rng = np.random.default_rng(random_state)
+    n_sim = int(n_obs * sim_doublet_ratio)
+    parents = rng.integers(0, n_obs, size=(n_sim, 2))
+    sim = counts[parents[:, 0]] + counts[parents[:, 1]]
+
+    # Normalize both to 1e6 counts on the highly variable genes
+    def _normalize(mat):
+        totals = np.asarray(mat.sum(axis=1)).ravel()
+        return mat.multiply((1e6 / np.where(totals > 0, totals, 1))[:, None]).tocsr()
+
+    obs_norm, sim_norm = _normalize(counts), _normalize(sim)
+
+    # Randomized PCA on the z-scored observed cells (centering is kept implicit)
+    mean = np.asarray(obs_norm.mean(axis=0), dtype=np.float64).ravel()
+    std = np.sqrt(np.clip(np.asarray(obs_norm.multiply(obs_norm).mean(axis=0), dtype=np.float64).ravel() - mean ** 2, 0, None))
+    std[std == 0] = 1
+    n_comps = min(n_prin_comps, min(obs_norm.shape) - 1)
+    _, _, components = randomized_svd(obs_norm, n_comps, center=mean, scale=std, random_state=random_state)
+
+    loadings = components.T / std[:, None]
+    offset = mean @ loadings
+    manifold = np.vstack([obs_norm @ loadings - offset, sim_norm @ loadings - offset])
+
+    # Fraction of simulated doublets among the nearest neighbors
+    if n_neighbors is None:
+        n_neighbors = int(round(0.5 * np.sqrt(n_obs)))
+    k_adj = int(round(n_neighbors * (1 + n_sim / float(n_obs))))
+    k_adj = min(k_adj, manifold.shape[0] - 2)
+
+    # A sparse index graph is much cheaper to build than the full k_adj graph; the k_adj neighbors are found by search
+    index = NNDescent(manifold, n_neighbors=min(30, k_adj + 1), random_state=random_state)
+    neighbors = index.query(manifold, k=k_adj + 1)[0]
+    is_self = neighbors == np.arange(manifold.shape[0])[:, None]
+    neighbors = np.take_along_axis(neighbors, np.argsort(is_self, axis=1, kind="stable"), axis=1)[:, :k_adj]
+    n_sim_neigh = (neighbors >= n_obs).sum(axis=1).astype(np.float64)
+
+    # Bayesian doublet likelihood as in scrublet
+    rho = expected_doublet_rate
+    r = n_sim / float(n_obs)
+    n = float(neighbors.shape[1])
+    q = (n_sim_neigh + 1) / (n + 2)
+    ld = q * rho / r / (1 - rho - q * (1 - rho - rho / r))
+    se_q = np.sqrt(q * (1 - q) / (n + 3))
+    se_ld = (q * rho / r / (1 - rho - q * (1 - rho - rho / r)) ** 2
+             * np.sqrt((se_q / q * (1 - rho)) ** 2 + (stdev_doublet_rate / rho * (1 - q)) ** 2))
+    scores_obs, scores_sim = ld[:n_obs], ld[n_obs:]
+
+    uns = {"doublet_scores_sim": scores_sim,
+           "doublet_parents": parents,
+           "parameters": {"expected_doublet_rate": expected_doublet_rate,
+                          "sim_doublet_ratio": sim_doublet_ratio,
+                          "n_neighbors": n_neighbors,
+                          "random_state": random_state}}
+
+    # Call doublets
+    if threshold is None:
+        try:
+            threshold = float(threshold_minimum(scores_sim))
+            if verbose:
+                logger.info(f"Automatically set threshold at doublet score = {threshold:.2f}")
+        except Exception:
+            logger.warning("Failed to automatically identify doublet score threshold. Doublets are not predicted.")
+
+    doublet_score = np.full(n_cells, np.nan)
+    doublet_score[cell_idx] = scores_obs
+    predicted_doublet = np.full(n_cells, np.nan, dtype=object)
+    if threshold is not None:
+        uns["threshold"] = threshold
+        predicted_doublet[cell_idx] = scores_obs > threshold
+        uns["z_scores"] = (scores_obs - threshold) / se_ld[:n_obs]
+    else:
+        predicted_doublet[cell_idx] = False
+
+    if len(cell_idx) == n_cells:
+        predicted_doublet = predicted_doublet.astype(bool)
+
+    return doublet_score, predicted_doublet, uns
+
+
 @deco.log_anndata
 @beartype
 def predict_sex(adata: sc.AnnData,
                 groupby: str,
-                gene: str = "Xist",
+                gene: str | list[str] = "Xist",
                 gene_column: Optional[str] = None,
                 threshold: float = 0.3,
+                y_genes: Optional[str | list[str]] = None,
+                y_chromosome: str = "chrY",
+                y_threshold: float = 0.3,
                 plot: bool = True,
                 save: Optional[str] = None,
                 **kwargs: Any) -> None:
     """
-    Predict sex based on expression of Xist (or another gene).
+    Predict sex based on expression of Xist (or other female-specific genes) and optionally Y-chromosome genes.
+
+    The fraction of cells expressing any of the female genes (and any of the Y genes) is calculated per group.
+    Without Y genes, groups with a female fraction >= threshold are "Female" and all others "Male".
+    With Y genes, groups are "Female" if only the female fraction is above its threshold, "Male" if only the Y fraction is above its threshold,
+    "Mixed" if both and "Unknown" if none are above their thresholds.
 
     Parameters
     ----------
@@ -433,12 +855,18 @@ def predict_sex(adata: sc.AnnData,
         An anndata object to predict sex for.
     groupby : str
         Column in adata.obs to group by.
-    gene : str, default "Xist"
-        Name of a female-specific gene to use for estimating Male/Female split.
+    gene : str | list[str], default "Xist"
+        Name(s) of female-specific genes to use for estimating Male/Female split.
     gene_column : Optional[str], default None
         Name of the column in adata.var that contains the gene names. If not provided, adata.var.index is used.
     threshold : float, default 0.3
-        Threshold for the minimum fraction of cells expressing the gene for the group to be considered "Female".
+        Threshold for the minimum fraction of cells expressing the gene(s) for the group to be considered "Female".
+    y_genes : Optional[str | list[str]], default None
+        Names of Y-chromosome genes or the path to a gtf file from which all genes on 'y_chromosome' are used (see tools.marker_genes.get_chromosome_genes).
+    y_chromosome : str, default "chrY"
+        Name of the Y chromosome in the gtf given in 'y_genes'.
+    y_threshold : float, default 0.3
+        Threshold for the minimum fraction of cells expressing any of the Y genes for the group to be considered "Male".
     plot : bool, default True
         Whether to plot the distribution of gene expression per group.
     save : Optional[str], default None
@@ -446,63 +874,73 @@ def predict_sex(adata: sc.AnnData,
     **kwargs : Any
         Additional arguments are passed to scanpy.pl.violin.
 
-    Notes
-    -----
-    adata.X will be converted to numpy.ndarray if it is of type numpy.matrix.
-
     Returns
     -------
     None
     """
 
-    # Normalize data before estimating expression
-    logger.info("Normalizing adata")
-    adata_copy = adata.copy()  # ensure that adata is not changed during normalization
-    sc.pp.normalize_total(adata_copy, target_sum=None)
-    sc.pp.log1p(adata_copy)
+    genes = [gene] if isinstance(gene, str) else gene
+    if isinstance(y_genes, str):
+        y_genes = get_chromosome_genes(y_genes, y_chromosome)
 
-    # Get expression of gene per cell
-    if gene_column is None:
-        gene_names_lower = [s.lower() for s in adata_copy.var.index]
-    else:
-        gene_names_lower = [s.lower() for s in adata_copy.var[gene_column]]
-    gene_index = [i for i, gene_name in enumerate(gene_names_lower) if gene_name == gene.lower()]
+    # Find the columns of the sex marker genes
+    logger.info("Selecting sex marker genes")
+    gene_names = adata.var.index if gene_column is None else adata.var[gene_column]
+    gene_names_lower = pd.Index(gene_names.astype(str).str.lower())
+    gene_index = np.where(gene_names_lower.isin([g.lower() for g in genes]))[0]
     if len(gene_index) == 0:
         logger.info("Selected gene is not present in the data. Prediction is skipped.")
         return
 
-    # If adata.X is of type matrix convert to ndarray
-    if isinstance(adata_copy.X, np.matrix):
-        adata_copy.X = adata_copy.X.getA()
-
-    # Try to flatten for adata.X np.ndarray. If not flatten for scipy sparse matrix
-    try:
-        adata_copy.obs["gene_expr"] = adata_copy.X[:, gene_index].flatten()
-    except AttributeError:
-        adata_copy.obs["gene_expr"] = adata_copy.X[:, gene_index].todense().A1
-
-    # Estimate which samples are male/female
+    y_index = np.where(gene_names_lower.isin([g.lower() for g in y_genes]))[0] if y_genes is not None else np.array([], dtype=int)
+    if y_genes is not None and len(y_index) == 0:
+        logger.warning("None of the Y genes are present in the data. Prediction is based on the female genes only.")
+
+    # Cells expressing any of the female / Y genes
+    X = adata.X
+    if isinstance(X, np.matrix):
+        X = X.getA()
+    female_counts = X[:, gene_index]
+    expressed = [(female_counts > 0).sum(axis=1)]
+    if len(y_index) > 0:
+        expressed.append((X[:, y_index] > 0).sum(axis=1))
+    expressed = (np.column_stack([np.asarray(e).ravel() for e in expressed]) > 0).astype(np.float32)
+
+    # Expressed fractions per group from one indicator product
     logger.info("Estimating male/female per group")
-    assignment = {}
-    for group, table in adata_copy.obs.groupby(groupby, observed=False):
-        n_cells = len(table)
-        n_expr = sum(table["gene_expr"] > 0)
-        frac = n_expr / n_cells
-        if frac >= threshold:
-            assignment[group] = "Female"
-        else:
-            assignment[group] = "Male"
+    indicator, groups = utils.adata.get_group_indicator(adata, groupby)
+    n_cells = np.asarray(indicator.sum(axis=1)).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = (indicator @ expressed) / n_cells[:, None]
+    is_female = fractions[:, 0] >= threshold
+
+    if len(y_index) > 0:
+        is_male = fractions[:, 1] >= y_threshold
+        labels = np.select([is_female & is_male, is_female, is_male], ["Mixed", "Female", "Male"], default="Unknown")
+    else:
+        labels = np.where(is_female, "Female", "Male")
 
     # Add assignment to adata.obs
-    df = pd.DataFrame().from_dict(assignment, orient="index")
-    df.columns = ["predicted_sex"]
-    if "predicted_sex" in adata.obs.columns:
-        adata.obs.drop(columns=["predicted_sex"], inplace=True)
-    adata.obs = adata.obs.merge(df, left_on=groupby, right_index=True, how="left")
+    codes = adata.obs[groupby].astype("category").cat.codes.to_numpy()
+    predicted = labels.astype(object)[codes]
+    predicted[codes < 0] = np.nan
+    adata.obs["predicted_sex"] = predicted
+    assignment = dict(zip(groups, labels))
 
     # Plot overview if chosen
     if plot:
         logger.info("Plotting violins")
+
+        # Normalized expression of the female genes per cell
+        totals = np.asarray(X.sum(axis=1)).ravel().astype(float)
+        target = np.median(totals[totals > 0])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gene_expr = np.log1p(np.asarray(female_counts.sum(axis=1)).ravel() / totals * target)
+        gene_expr[totals == 0] = 0
+
+        adata_plot = sc.AnnData(obs=adata.obs[[groupby]].copy())
+        adata_plot.obs["gene_expr"] = gene_expr
+
         groups = adata.obs[groupby].unique()
         n_groups = len(groups)
         fig, axarr = plt.subplots(1, 2, sharey=True,
@@ -510,19 +948,19 @@ def predict_sex(adata: sc.AnnData,
                                   gridspec_kw={'width_ratios': [min(4, n_groups), n_groups]})
 
         # Plot histogram of all values
-        axarr[0].hist(adata_copy.obs["gene_expr"], bins=30, orientation="horizontal", density=True, color="grey")
+        axarr[0].hist(gene_expr, bins=30, orientation="horizontal", density=True, color="grey")
         axarr[0].invert_xaxis()
-        axarr[0].set_ylabel(f"Normalized {gene} expression")
+        axarr[0].set_ylabel(f"Normalized {', '.join(genes)} expression")
 
         # Plot violins per group + color for female cells
-        sc.pl.violin(adata_copy, keys="gene_expr", groupby=groupby, jitter=False, ax=axarr[1], show=False, order=groups, **kwargs)
+        sc.pl.violin(adata_plot, keys="gene_expr", groupby=groupby, jitter=False, ax=axarr[1], show=False, order=groups, **kwargs)
         axarr[1].set_xticks(axarr[1].get_xticks())  # https://stackoverflow.com/a/68794383/19870975
         axarr[1].set_xticklabels(groups, rotation=45, ha="right")
         axarr[1].set_ylabel("")
         xlim = axarr[1].get_xlim()
 
         for i, group in enumerate(groups):
-            if assignment[group] == "Female":
+            if assignment.get(group) == "Female":
                 color = "red"
                 alpha = 0.3
             else:
@@ -544,7 +982,8 @@ def gmm_threshold(data: npt.ArrayLike,
                   max_mixtures: int = 5,
                   min_n: Union[int, float] = 3,
                   max_n: Union[int, float] = 3,
-                  plot: bool = False) -> dict[str, Union[int, float]]:
+                  plot: bool = False,
+                  warm_start: bool = True) -> dict[str, Union[int, float]]:
     """
     Get automatic min/max thresholds for input data array.
 
@@ -566,6 +1005,9 @@ def gmm_threshold(data: npt.ArrayLike,
         Number of SDs from largest component mean to set as max threshold.
     plot : bool, default False
         If True, will plot the distribution of BIC and the fit of the gaussian mixtures to the data.
+    warm_start : bool, default True
+        If True, each model is initialized from the means of the previous model with one mixture less (plus one component where
+        the data is fitted worst) instead of a random k-means initialization. This reduces the number of EM iterations and makes the fits deterministic.
 
     Returns
     -------
@@ -587,7 +1029,10 @@ def gmm_threshold(data: npt.ArrayLike,
     n_list = list(range(1, max_mixtures + 1))  # 1->max mixtures per model
     models = [None] * len(n_list)
     for i, n in enumerate(n_list):
-        models[i] = GaussianMixture(n).fit(data)
+        if warm_start and i > 0:
+            models[i] = GaussianMixture(n, **_add_component_init(models[i - 1], data)).fit(data)
+        else:
+            models[i] = GaussianMixture(n).fit(data)
 
     # Evaluate quality of models
     # AIC = [m.aic(data) for m in models]
@@ -653,6 +1098,55 @@ def gmm_threshold(data: npt.ArrayLike,
     return thresholds
 
 
+def _add_component_init(model: GaussianMixture, data: np.ndarray, n_iter: int = 10) -> dict[str, np.ndarray]:
+    """
+    Get initial parameters for a gaussian mixture with one more component from a fitted model.
+
+    The means of the fitted components plus a new mean where the data density exceeds the density of the fitted model
+    the most are refined by a few one-dimensional k-means iterations, which give the initial weights and variances.
+
+    Parameters
+    ----------
+    model : GaussianMixture
+        Fitted one-dimensional gaussian mixture model.
+    data : np.ndarray
+        Data the model was fitted on with shape (n, 1).
+    n_iter : int, default 10
+        Number of k-means iterations.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Dictionary with weights_init, means_init and precisions_init for GaussianMixture.
+    """
+
+    values = np.sort(data.ravel())
+
+    # New component where the data is fitted worst
+    counts, edges = np.histogram(values, bins=100)
+    centers = (edges[:-1] + edges[1:]) / 2
+    expected = np.exp(model.score_samples(centers.reshape(-1, 1))) * len(values) * (edges[1] - edges[0])
+    means = np.sort(np.append(model.means_.ravel(), centers[np.argmax(counts - expected)]))
+
+    # 1D k-means on sorted values: clusters are contiguous ranges split at the midpoints between means
+    cumsum = np.concatenate([[0], np.cumsum(values)])
+    for _ in range(n_iter):
+        bounds = np.concatenate([[0], np.searchsorted(values, (means[:-1] + means[1:]) / 2), [len(values)]])
+        sizes = np.diff(bounds)
+        if np.any(sizes == 0):
+            break
+        means = np.diff(cumsum[bounds]) / sizes
+
+    bounds = np.concatenate([[0], np.searchsorted(values, (means[:-1] + means[1:]) / 2), [len(values)]])
+    sizes = np.maximum(np.diff(bounds), 1)
+    variances = np.array([values[a:b].var() if b - a > 1 else 0 for a, b in zip(bounds[:-1], bounds[1:])])
+    variances = np.maximum(variances, 1e-6 * max(values.var(), 1e-12))
+
+    return {"weights_init": sizes / sizes.sum(),
+            "means_init": means.reshape(-1, 1),
+            "precisions_init": (1 / variances).reshape(-1, 1, 1)}
+
+
 @beartype
 def mad_threshold(data: npt.ArrayLike,
                   min_n: Union[int, float] = 3,
@@ -708,7 +1202,9 @@ def automatic_thresholds(adata: sc.AnnData,
                          groupby: Optional[str] = None,
                          columns: Optional[list[str]] = None,
                          FUN: Callable = gmm_threshold,
-                         FUN_kwargs: dict = {}) -> dict[str, dict[str, Union[Union[int, float], dict[str, Union[int, float]]]]]:
+                         FUN_kwargs: dict = {},
+                         subsample: Optional[int] = None,
+                         threads: int = 1) -> dict[str, dict[str, Union[Union[int, float], dict[str, Union[int, float]]]]]:
     """
     Get automatic thresholds for multiple data columns in adata.obs or adata.var.
 
@@ -727,6 +1223,12 @@ def automatic_thresholds(adata: sc.AnnData,
         Available functions: sctoolbox.tools.qc_filter.gmm_threshold, sctoolbox.tools.qc_filter.mad_threshold.
     FUN_kwargs : dict
         Dict of additional kwargs forwarded to the filter function.
+    subsample : Optional[int], default None
+        Maximum number of values per column (and group) given to the filter function. Larger data is reduced to evenly spaced
+        quantiles, which keeps the shape of the distribution, e.g. 100000 to speed up the fits of large datasets.
+        If None, all values are used.
+    threads : int, default 1
+        Number of processes to find the thresholds of the (column, group) pairs in parallel. FUN must be picklable if threads > 1.
 
     Returns
     -------
@@ -755,27 +1257,77 @@ def automatic_thresholds(adata: sc.AnnData,
         if groupby not in table.columns:
             raise ValueError(f"Invalid groupby value. '{groupby}' is not a column in adata.{which}.")
 
-    # Get threshold per data column (and groupby if chosen)
-    thresholds = {}
+    # Collect data per data column (and groupby if chosen)
+    tasks = []
     for col in columns:
+        if groupby is None:
+            tasks.append((col, None, table[col].values))
+        else:
+            for group, subtable in table.groupby(groupby):
+                tasks.append((col, group, subtable[col].values))
+
+    # Get threshold per data column (and groupby if chosen)
+    if threads > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(threads, len(tasks)))
+        jobs = [pool.apply_async(_threshold_job, (data, FUN, FUN_kwargs, subsample)) for _, _, data in tasks]
+        pool.close()
+
+        utils.multiprocessing.monitor_jobs(jobs, description="Finding thresholds")
+        results = [job.get() for job in jobs]
+        pool.join()
+    else:
+        results = [_threshold_job(data, FUN, FUN_kwargs, subsample) for _, _, data in tasks]
 
+    thresholds = {}
+    elapsed = {col: 0 for col in columns}
+    for (col, group, _), (d, t) in zip(tasks, results):
         if groupby is None:
-            data = table[col].values
-            data[np.isnan(data)] = 0
-            d = FUN(data, **FUN_kwargs)
             thresholds[col] = d
-
         else:
-            thresholds[col] = {}  # initialize to fill in per group
-            for group, subtable in table.groupby(groupby):
-                data = subtable[col].values
-                data[np.isnan(data)] = 0
-                d = FUN(data, **FUN_kwargs)
-                thresholds[col][group] = d
+            thresholds.setdefault(col, {})[group] = d
+        elapsed[col] += t
+
+    for col, t in elapsed.items():
+        logger.info(f"Found thresholds for '{col}' in {t:.2f}s")
 
     return thresholds
 
 
+def _threshold_job(data: np.ndarray,
+                   FUN: Callable,
+                   FUN_kwargs: dict,
+                   subsample: Optional[int] = None) -> Tuple[dict, float]:
+    """
+    Find the thresholds of one data column (and group) on a quantile subsample of the values.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Values to find thresholds for. NaN values are set to 0.
+    FUN : Callable
+        A filter function returning a dict with thresholds: {"min": 0, "max": 1}.
+    FUN_kwargs : dict
+        Dict of additional kwargs forwarded to the filter function.
+    subsample : Optional[int], default None
+        Maximum number of values given to the filter function. Larger data is reduced to evenly spaced quantiles.
+
+    Returns
+    -------
+    Tuple[dict, float]
+        Thresholds and the time in seconds spent.
+    """
+
+    start = time.time()
+
+    data = np.where(np.isnan(data), 0, data)
+    if subsample is not None and len(data) > subsample:
+        data = np.sort(data)[np.linspace(0, len(data) - 1, subsample).round().astype(int)]
+
+    thresholds = FUN(data, **FUN_kwargs)
+
+    return thresholds, time.time() - start
+
+
 @beartype
 def thresholds_as_table(threshold_dict: dict[str, dict[str, Union[int, float] | dict[str, Union[int, float]]]]) -> pd.DataFrame:
     """
@@ -1090,10 +1642,15 @@ def apply_qc_thresholds(adata: sc.AnnData,
                         thresholds: Dict[str, Union[Dict[Literal["min", "max"], Union[int, float]], Dict[str, Dict[Literal["min", "max"], Union[int, float]]]]],
                         which: Literal["obs", "var"] = "obs",
                         inplace: bool = True,
-                        overwrite: bool = False) -> Optional[sc.AnnData]:
+                        overwrite: bool = False,
+                        groupby: Optional[str] = None) -> Optional[sc.AnnData]:
     """
     Apply QC thresholds to anndata object.
 
+    A bitmask of the metrics each element failed (bit i is set if the i-th metric of thresholds failed) is stored
+    for the elements before filtering in adata.uns['sctoolbox']['report']['qc'][<which>]['threshold_failed'], as the column
+    'bitmask' of a table indexed by the obs/var names, together with the list of metrics.
+
     Parameters
     ----------
     adata : sc.AnnData
@@ -1106,6 +1663,9 @@ def apply_qc_thresholds(adata: sc.AnnData,
         Change adata inplace or return a changed copy.
     overwrite : bool, default False
         Set to overwrite previously applied filters.
+    groupby : Optional[str], default None
+        Column in adata.<which> containing the groups of grouped thresholds. If None, the thresholds of all groups are applied
+        to all elements.
 
     Returns
     -------
@@ -1126,43 +1686,96 @@ def apply_qc_thresholds(adata: sc.AnnData,
     if len(thresholds) == 0:
         raise ValueError(f"The thresholds given do not match the columns given in adata.{which}. Please adjust the 'which' parameter if needed.")
 
-    # create a boolean filter per metric
-    inclusion_bools = []  # a list of lists that represents the filters of all metrics
-    for metric, _dict in thresholds.items():
-        # global filtering
-        if "min" in _dict or "max" in _dict:
-            # create one filter list per threshold then combine
-            # allows setting only a single bound
-            tmp_bool = []
-            for bound, val in _dict.items():
-                tmp_bool.append(
-                    list(table[metric] >= val if bound == "min" else table[metric] <= val)
-                )
+    # one bit per failed metric
+    metrics = list(thresholds.keys())
+    failed = get_threshold_bitmask(table, thresholds, groupby=groupby)
 
-        else:
-            # group based filtering
-            tmp_bool = []
-            for _, grp_dict in _dict.items():
-                for bound, val in grp_dict.items():
-                    tmp_bool.append(
-                        list(table[metric] >= val if bound == "min" else table[metric] <= val)
-                    )
+    # apply the filter
+    filtered = _filter_object(adata=adata,
+                              filter=failed == 0,
+                              which=which,
+                              invert=False,
+                              inplace=inplace,
+                              name="threshold",
+                              value=thresholds,
+                              overwrite=overwrite)
 
-        # create an union of the collected boolean threshold lists
-        inclusion_bools.append([all(row) for row in zip(*tmp_bool)])
+    utils.adata.add_uns_info(adata=adata if inplace else filtered,
+                             key=_uns_report_path[1:] + [which, "threshold_failed"],
+                             value={"metrics": metrics, "bitmask": pd.DataFrame({"bitmask": failed}, index=table.index.copy())})
 
-    # create an union from the boolean filters of all metrics
-    include = [all(row) for row in zip(*inclusion_bools)]
+    return filtered
 
-    # apply the filter
-    return _filter_object(adata=adata,
-                          filter=include,
-                          which=which,
-                          invert=False,
-                          inplace=inplace,
-                          name="threshold",
-                          value=thresholds,
-                          overwrite=overwrite)
+
+@beartype
+def get_threshold_bitmask(table: pd.DataFrame,
+                          thresholds: dict[str, dict],
+                          groupby: Optional[str] = None,
+                          nan_fails: bool = True) -> npt.NDArray[np.uint32]:
+    """
+    Get a bitmask of the thresholds each row of a table fails.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        Table containing the metrics (adata.obs or adata.var).
+    thresholds : dict[str, dict]
+        Dictionary of global {metric: {"min": val, "max": val}} or grouped {metric: {group: {"min": val, "max": val}}} thresholds.
+        Bounds which are missing or None are not applied.
+    groupby : Optional[str], default None
+        Column in table containing the groups of grouped thresholds. If None, the thresholds of all groups are applied to all rows.
+    nan_fails : bool, default True
+        Whether NaN values fail the thresholds (as in apply_qc_thresholds, which removes them). If False, NaN values never fail
+        (as in the upset plots).
+
+    Returns
+    -------
+    npt.NDArray[np.uint32]
+        Bitmask per row; bit i is set if the row is outside of the bounds of the i-th metric in thresholds.
+
+    Raises
+    ------
+    ValueError
+        If more than 32 metrics are given or groupby is not a column of the table.
+    """
+
+    if len(thresholds) > 32:
+        raise ValueError("A maximum of 32 metrics can be used as thresholds.")
+
+    codes, categories = None, None
+    if groupby is not None:
+        if groupby not in table.columns:
+            raise ValueError(f"Invalid groupby value. '{groupby}' is not a column in the table.")
+        groups = table[groupby].astype("category")
+        codes = groups.cat.codes.to_numpy()  # -1 for NaN is mapped to the last (unbounded) entry
+        categories = groups.cat.categories.astype(str)
+
+    def bound(d, key, default):
+        value = d.get(key)
+        return default if value is None else value
+
+    failed = np.zeros(len(table), dtype=np.uint32)
+    for bit, (metric, _dict) in enumerate(thresholds.items()):
+
+        if "min" in _dict or "max" in _dict:  # global thresholds
+            lower, upper = bound(_dict, "min", -np.inf), bound(_dict, "max", np.inf)
+
+        elif codes is None:  # grouped thresholds applied to all rows
+            lower = max([bound(d, "min", -np.inf) for d in _dict.values()], default=-np.inf)
+            upper = min([bound(d, "max", np.inf) for d in _dict.values()], default=np.inf)
+
+        else:  # grouped thresholds broadcast by the group codes
+            group_dicts = {str(group): d for group, d in _dict.items()}
+            lower = np.array([bound(group_dicts.get(c, {}), "min", -np.inf) for c in categories] + [-np.inf])[codes]
+            upper = np.array([bound(group_dicts.get(c, {}), "max", np.inf) for c in categories] + [np.inf])[codes]
+
+        values = table[metric].to_numpy(dtype=float)
+        inside = (values >= lower) & (values <= upper)
+        if not nan_fails:
+            inside |= np.isnan(values)
+        failed |= (~inside).astype(np.uint32) << np.uint32(bit)
+
+    return failed
 
 
 ###############################################################################
@@ -1171,7 +1784,7 @@ def apply_qc_thresholds(adata: sc.AnnData,
 
 @beartype
 def _filter_object(adata: sc.AnnData,
-                   filter: str | list[str] | list[bool],
+                   filter: str | list[str] | list[bool] | npt.NDArray[np.bool_],
                    which: Literal["obs", "var"] = "obs",
                    invert: bool = False,
                    inplace: bool = True,
@@ -1188,11 +1801,11 @@ def _filter_object(adata: sc.AnnData,
     ----------
     adata : sc.AnnData
         The anndata object to filter.
-    filter : str | list[str] | list[bool]
+    filter : str | list[str] | list[bool] | npt.NDArray[np.bool_]
         The filter that will be applied to the anndata. Either
             - a name corresponding to a .var or .obs column (the column has to contain boolean values),
             - a list of indices to keep or
-            - a list of boolean values.
+            - a list or array of boolean values.
         Anything that evaluates to True will be kept.
     which : Literal["obs", "var"], default "obs"
         Filter observations (cells) or variables (genes, peaks, etc.).
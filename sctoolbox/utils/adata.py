@@ -51,6 +51,46 @@ def get_adata_subsets(adata: sc.AnnData, groupby: str) -> dict[str, sc.AnnData]:
     return adata_subsets
 
 
+@beartype
+def get_group_indicator(adata: sc.AnnData,
+                        groupby: str) -> tuple[scipy.sparse.csr_matrix, pd.Index]:
+    """
+    Get a sparse indicator matrix assigning each cell to its group in 'groupby'.
+
+    Multiplying the indicator with a cells x features matrix yields the sums per group in one sparse product.
+
+    Parameters
+    ----------
+    adata : sc.AnnData
+        Anndata object containing the groups.
+    groupby : str
+        Column name in adata.obs containing the groups.
+
+    Returns
+    -------
+    tuple[scipy.sparse.csr_matrix, pd.Index]
+        Indicator matrix of shape (n_groups, n_cells) and the group names in the order of the rows.
+        Cells without a group (NaN) are not assigned to any row.
+
+    Raises
+    ------
+    ValueError
+        If groupby is not found in `adata.obs.columns`.
+    """
+
+    if groupby not in adata.obs.columns:
+        raise ValueError(f"Column '{groupby}' not found in adata.obs")
+
+    groups = adata.obs[groupby].astype("category")
+    codes = groups.cat.codes.to_numpy()
+    cells = np.flatnonzero(codes >= 0)
+
+    indicator = scipy.sparse.csr_matrix((np.ones(len(cells), dtype=np.float32), (codes[cells], cells)),
+                                        shape=(len(groups.cat.categories), adata.n_obs))
+
+    return indicator, groups.cat.categories
+
+
 @deco.log_anndata
 @beartype
 def add_expr_to_obs(adata: sc.AnnData, gene: str) -> None:
@@ -5,7 +5,8 @@ import pandas as pd
 import re
 import requests
 import apybiomart
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csc_matrix, csr_matrix
+from multiprocessing.pool import ThreadPool
 import gzip
 import argparse
 import os
@@ -17,6 +18,7 @@ from beartype import beartype
 
 import sctoolbox.utils as utils
 import sctoolbox.utils.decorator as deco
+from sctoolbox._settings import settings
 
 
 @deco.log_anndata
@@ -26,10 +28,15 @@ def pseudobulk_table(adata: sc.AnnData,
                      how: Literal['mean', 'sum'] = "mean",
                      layer: Optional[str] = None,
                      percentile_range: Tuple[int, int] = (0, 100),
-                     chunk_size: int = 1000) -> pd.DataFrame:
+                     chunk_size: int = 1000,
+                     threads: Optional[int] = None) -> pd.DataFrame:
     """
     Get a pseudobulk table of values per cluster.
 
+    Sums and means of all cells are computed with one sparse product of a group indicator matrix and the expression matrix.
+    Trimmed values (percentile_range other than (0, 100)) are computed per feature from the nonzero values only,
+    with the implicit zeros of sparse matrices taken into account without densifying the matrix.
+
     Parameters
     ----------
     adata : sc.AnnData
@@ -45,6 +52,8 @@ def pseudobulk_table(adata: sc.AnnData,
         Is used to limit the effect of individual cell outliers, e.g. by setting (0, 95) to exclude high values in the calculation.
     chunk_size : int, default 1000
         If percentile_range is not default, chunk_size controls the number of features to process at once. This is used to avoid memory issues.
+    threads : Optional[int], default None
+        Number of threads used to process the feature chunks if percentile_range is not default. If None, sctoolbox.settings.threads is used.
 
     Returns
     -------
@@ -52,56 +61,173 @@ def pseudobulk_table(adata: sc.AnnData,
         DataFrame with aggregated counts (adata.X). With groups as columns and genes as rows.
     """
 
-    groupby_categories = adata.obs[groupby].astype('category').cat.categories
+    if threads is None:
+        threads = settings.threads
+
+    indicator, groupby_categories = utils.adata.get_group_indicator(adata, groupby)
+    n_cells = np.diff(indicator.indptr)  # number of cells per group
 
     if layer is not None:
         mat = adata.layers[layer]
     else:
         mat = adata.X
 
-    # Fetch the mean/ sum counts across each category in cluster_by
-    res = pd.DataFrame(index=adata.var_names, columns=groupby_categories)
-    for column_i, clust in enumerate(groupby_categories):
+    if percentile_range == (0, 100):  # uses all cells
+        sums = _group_sums(indicator, mat)
 
-        cluster_values = mat[adata.obs[groupby].isin([clust]), :]
+        if how == "mean":
+            with np.errstate(divide="ignore", invalid="ignore"):  # empty categories result in NaN
+                vals = sums / n_cells[:, None]
+        elif how == "sum":
+            vals = sums
 
-        if percentile_range == (0, 100):  # uses all cells
-            if how == "mean":
-                vals = cluster_values.mean(0)
-                res[clust] = vals.A1 if issparse(cluster_values) else vals
-            elif how == "sum":
-                vals = cluster_values.sum(0)
-                res[clust] = vals.A1 if issparse(cluster_values) else vals
-        else:
+    else:
+        # Position of the lower/upper limits within the sorted values of each group; identical to np.percentile(..., method="lower")
+        limit_idx = np.array([np.percentile(np.arange(n), percentile_range, method="lower") if n > 0 else [0, 0] for n in n_cells], dtype=np.int64)
 
-            n_features = cluster_values.shape[1]
+        codes = np.full(adata.n_obs, -1, dtype=np.int64)
+        codes[indicator.indices] = np.repeat(np.arange(len(groupby_categories)), np.diff(indicator.indptr))
 
-            # Calculate mean individually per gene/feature
-            for i in range(0, n_features, chunk_size):
+        mat = mat.tocsc() if issparse(mat) else mat
+        n_features = mat.shape[1]
+        chunks = [(i, min(i + chunk_size, n_features)) for i in range(0, n_features, chunk_size)]
 
-                chunk_values = cluster_values[:, i:i + chunk_size]
-                chunk_values = chunk_values.A if issparse(chunk_values) else chunk_values
-                chunk_values = chunk_values.astype(float)
+        def get_chunk(start, end):
+            chunk = mat[:, start:end]
+            return chunk if issparse(chunk) else csc_matrix(chunk)
 
-                # Calculate the lower and upper limits for each feature
-                limits = np.percentile(chunk_values, percentile_range, axis=0, method="lower")
-                lower_limits = limits[0]
-                upper_limits = limits[1]
+        def trimmed(bounds):  # the chunk is sliced within the thread, so only the chunks in progress are in memory
+            return _trimmed_chunk(get_chunk(*bounds), codes, n_cells, limit_idx, how)
 
-                # Set values outside the limits to nan and calculate mean/sum
-                bool_filter = (chunk_values < lower_limits) | (chunk_values > upper_limits)
-                chunk_values[bool_filter] = np.nan
+        if threads > 1 and len(chunks) > 1:
+            with ThreadPool(min(threads, len(chunks))) as pool:
+                results = list(pool.imap(trimmed, chunks))
+        else:
+            results = [trimmed(bounds) for bounds in chunks]
 
-                if how == "mean":
-                    vals = np.nanmean(chunk_values, axis=0)
-                elif how == "sum":
-                    vals = np.nansum(chunk_values, axis=0)
+        vals = np.hstack(results) if len(results) > 0 else np.zeros((len(groupby_categories), 0))
 
-                res.iloc[i:i + chunk_size, column_i] = vals
+    res = pd.DataFrame(vals.T, index=adata.var_names, columns=groupby_categories)
 
     return res
 
 
+def _group_sums(indicator: csr_matrix, mat: Any, block_size: int = 10000) -> np.ndarray:
+    """
+    Sum the rows of mat per group in float64.
+
+    The products run over blocks of rows (columns for CSC matrices), so only one block is converted to float64 at a time.
+
+    Parameters
+    ----------
+    indicator : csr_matrix
+        Group x cells indicator matrix.
+    mat : Any
+        Cells x features matrix (numpy array or scipy sparse matrix).
+    block_size : int, default 10000
+        Number of rows (or columns for CSC matrices) per block.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n_groups, n_features) with the sums per group.
+    """
+
+    indicator = indicator.astype(np.float64)
+    sums = np.zeros((indicator.shape[0], mat.shape[1]))
+
+    if issparse(mat) and mat.format == "csc":
+        for start in range(0, mat.shape[1], block_size):
+            part = indicator @ mat[:, start:start + block_size]
+            sums[:, start:start + block_size] = part.toarray() if issparse(part) else part
+    else:
+        mat = mat.tocsr() if issparse(mat) and mat.format != "csr" else mat
+        indicator = indicator.tocsc()  # cheap column blocks
+        for start in range(0, mat.shape[0], block_size):
+            part = indicator[:, start:start + block_size] @ mat[start:start + block_size]
+            sums += part.toarray() if issparse(part) else np.asarray(part)
+
+    return sums
+
+
+def _trimmed_chunk(chunk: csc_matrix,
+                   codes: np.ndarray,
+                   n_cells: np.ndarray,
+                   limit_idx: np.ndarray,
+                   how: Literal['mean', 'sum']) -> np.ndarray:
+    """
+    Calculate the trimmed mean/sum per group for a chunk of features from the nonzero values only.
+
+    Parameters
+    ----------
+    chunk : csc_matrix
+        Cells x features matrix.
+    codes : np.ndarray
+        Group index per cell; -1 for cells without group.
+    n_cells : np.ndarray
+        Number of cells per group.
+    limit_idx : np.ndarray
+        Array of shape (n_groups, 2) with the positions of the lower and upper limit within the sorted values of a group.
+    how : Literal['mean', 'sum']
+        How to aggregate the values within the limits.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n_groups, n_features) with the aggregated values.
+    """
+
+    n_groups = len(n_cells)
+    n_features = chunk.shape[1]
+
+    chunk = chunk.copy()
+    chunk.eliminate_zeros()  # explicit zeros are handled together with the implicit ones
+    values = chunk.data.astype(float)
+    feature = np.repeat(np.arange(n_features), np.diff(chunk.indptr))
+    group = codes[chunk.indices]
+
+    keep = group >= 0
+    values, feature, group = values[keep], feature[keep], group[keep]
+
+    # Sort values within each feature/group segment (sorting a combined integer key is faster than np.lexsort)
+    segment = feature * n_groups + group
+    rank = np.empty(len(values), dtype=np.int64)
+    rank[np.argsort(values)] = np.arange(len(values))
+    order = np.argsort(segment * len(values) + rank)
+    values, segment = values[order], segment[order]
+
+    n_segments = n_features * n_groups
+    n_nonzero = np.bincount(segment, minlength=n_segments)
+    n_negative = np.bincount(segment, weights=values < 0, minlength=n_segments).astype(np.int64)
+    starts = np.cumsum(n_nonzero) - n_nonzero
+    n_zero = np.tile(n_cells, n_features) - n_nonzero
+
+    # The sorted values of a segment are: negative values, implicit zeros, positive values
+    limits = np.zeros((n_segments, 2))
+    for j in range(2):
+        k = np.tile(limit_idx[:, j], n_features)
+        is_neg = k < n_negative
+        is_pos = k >= n_negative + n_zero
+        pos = np.where(is_neg, starts + k, starts + k - n_zero)
+        pos = np.clip(pos, 0, max(len(values) - 1, 0))
+        limits[:, j] = np.where(is_neg | is_pos, values[pos] if len(values) > 0 else 0, 0)
+
+    # Aggregate values within the limits; zeros are kept if they lie within the limits
+    lower, upper = limits[segment, 0], limits[segment, 1]
+    within = (values >= lower) & (values <= upper)
+    sums = np.bincount(segment, weights=np.where(within, values, 0), minlength=n_segments)
+
+    if how == "sum":
+        vals = sums
+    elif how == "mean":
+        counts = np.bincount(segment, weights=within, minlength=n_segments)
+        counts += np.where((limits[:, 0] <= 0) & (limits[:, 1] >= 0), n_zero, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):  # empty groups result in NaN
+            vals = sums / counts
+
+    return vals.reshape(n_features, n_groups).T
+
+
 #####################################################################
 #                        Format adata indexes                       #
 #####################################################################
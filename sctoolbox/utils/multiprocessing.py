@@ -1,6 +1,9 @@
 """Functions related to multiprocessing."""
 
 import time
+import numpy as np
+import scipy
+from multiprocessing.shared_memory import SharedMemory
 import sctoolbox.utils as utils
 
 # type hint imports
@@ -69,3 +72,103 @@ def monitor_jobs(jobs: dict[Tuple[int, int | str], Any] | list[Any], description
     pbar.n = n_ready  # update progress bar to 100%
     pbar.refresh()
     pbar.close()
+
+
+@beartype
+def share_matrix(mat: np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray) -> Tuple[list[SharedMemory], dict[str, Any]]:
+    """
+    Copy a dense or sparse (csr/csc) matrix into shared memory.
+
+    The returned description is small and can be passed to worker processes instead of the matrix itself.
+    The matrix is rebuilt without copying in the workers by `load_shared_matrix`.
+
+    Parameters
+    ----------
+    mat : np.ndarray | scipy.sparse.spmatrix | scipy.sparse.sparray
+        Matrix to share.
+
+    Returns
+    -------
+    Tuple[list[SharedMemory], dict[str, Any]]
+        The shared memory blocks and a picklable description of the matrix.
+        The blocks must be released with `release_shared` after all workers are done.
+
+    Raises
+    ------
+    ValueError
+        If the sparse format is not csr or csc.
+    """
+
+    if scipy.sparse.issparse(mat):
+        if mat.format not in ["csr", "csc"]:
+            raise ValueError(f"Sparse format '{mat.format}' is not supported. Please use csr or csc.")
+        arrays = {"data": mat.data, "indices": mat.indices, "indptr": mat.indptr}
+        spec = {"format": mat.format, "shape": mat.shape, "arrays": {}}
+    else:
+        arrays = {"data": np.asarray(mat)}
+        spec = {"format": "dense", "shape": mat.shape, "arrays": {}}
+
+    handles = []
+    for name, array in arrays.items():
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[:] = array
+        handles.append(shm)
+        spec["arrays"][name] = (shm.name, array.dtype.str, array.shape)
+
+    return handles, spec
+
+
+@beartype
+def load_shared_matrix(spec: dict[str, Any]) -> Tuple[np.ndarray | scipy.sparse.spmatrix, list[SharedMemory]]:
+    """
+    Attach to a matrix shared by `share_matrix` without copying it.
+
+    Parameters
+    ----------
+    spec : dict[str, Any]
+        Description of the shared matrix as returned by `share_matrix`.
+
+    Returns
+    -------
+    Tuple[np.ndarray | scipy.sparse.spmatrix, list[SharedMemory]]
+        The matrix backed by shared memory and the attached blocks.
+        The blocks must be closed with `release_shared` once the matrix (and any view of it) is no longer used.
+    """
+
+    handles = []
+    arrays = {}
+    for name, (shm_name, dtype, shape) in spec["arrays"].items():
+        shm = SharedMemory(name=shm_name)
+        handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    if spec["format"] == "dense":
+        mat = arrays["data"]
+    else:
+        matrix_class = scipy.sparse.csr_matrix if spec["format"] == "csr" else scipy.sparse.csc_matrix
+        mat = matrix_class((arrays["data"], arrays["indices"], arrays["indptr"]), shape=spec["shape"], copy=False)
+
+    return mat, handles
+
+
+@beartype
+def release_shared(handles: list[SharedMemory], unlink: bool = False) -> None:
+    """
+    Close (and optionally unlink) shared memory blocks.
+
+    Parameters
+    ----------
+    handles : list[SharedMemory]
+        Shared memory blocks as returned by `share_matrix` or `load_shared_matrix`.
+    unlink : bool, default False
+        Whether to free the memory. Should only be done by the process that created the blocks.
+    """
+
+    for shm in handles:
+        try:
+            shm.close()
+        except BufferError:  # memory is still referenced by an array; it is released once the array is garbage collected
+            pass
+        if unlink:
+            shm.unlink()
@@ -217,6 +217,20 @@ def test_quality_violin(adata, groupby, columns, which, title, color_list):
     assert isinstance(slider, dict)
 
 
+@pytest.mark.parametrize("summary", ["smoothed", "histogram"])
+def test_quality_violin_summary(adata, summary):
+    """Test quality_violin with violins drawn from precomputed summaries."""
+    figure, slider = pl.quality_violin(adata, columns=['qc_float', 'LISI_score_pca'], groupby="condition", summary=summary)
+    assert type(figure).__name__ == "Figure"
+    assert isinstance(slider, dict)
+
+    # Summary is based on exact quantiles and counts of the group values
+    values = adata.obs.loc[adata.obs["condition"] == "C1", "LISI_score_pca"]
+    group_summary = pl._violin_summary(values, method=summary)
+    assert np.allclose(group_summary["quantiles"], np.quantile(values, [0, 0.25, 0.5, 0.75, 1]))
+    assert pl._count_retained(group_summary["values"], -0.5, 0.5) == ((values >= -0.5) & (values <= 0.5)).sum()
+
+
 def test_quality_violin_fail(adata):
     """Test quality_violin failure."""
     with pytest.raises(BeartypeCallHintParamViolation):
@@ -279,6 +293,18 @@ def test_upset_select_cells(adata, thresholds, expected):
     assert expected == (sample_selection == global_selection).all().all()
 
 
+def test_upset_select_cells_nan(adata):
+    """Test that NaN values are not selected as outside of the thresholds."""
+    adata = adata.copy()
+    adata.obs.loc[adata.obs.index[:5], "qcvar1"] = np.nan
+    thresholds = {'qcvar1': {'min': 0.1, 'max': 0.9},
+                  'qcvar2': {'min': 0.2, 'max': 0.8}}
+
+    selection = pl._upset_select_cells(adata, thresholds)
+
+    assert not selection["qcvar1"].iloc[:5].any()
+
+
 @pytest.mark.parametrize("thresholds, groupby", [({'qcvar1': {'min': 0.1, 'max': 0.9},
                                                    'qcvar2': {'min': 0.2, 'max': 0.8}}, None),
                                                  ({'qcvar1': {'C1': {'min': 0.1, 'max': 0.9},
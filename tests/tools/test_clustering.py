@@ -1,5 +1,6 @@
 """Test clustering functions."""
 
+import os
 import numpy as np
 import sctoolbox.tools.clustering as tl
 import pytest
@@ -31,6 +32,12 @@ def unequal_adata():
     return adata
 
 
+@pytest.fixture
+def neighbors_adata():
+    """Load an adata with computed neighbors."""
+    return sc.read_h5ad(os.path.join(os.path.dirname(__file__), '..', 'data', 'adata.h5ad'))
+
+
 @pytest.fixture
 def clust_adata():
     """Return a clustered adata."""
@@ -99,6 +106,22 @@ def test_recluster(clust_adata):
     assert len(set(clust_adata.obs["louvain"])) < len(set(clust_adata.obs["split_louvain"]))
 
 
+@pytest.mark.parametrize("threads", [1, 2])
+def test_sweep_clustering(neighbors_adata, threads):
+    """Test that the sweep equals sc.tl.leiden and reports stability."""
+
+    stats = tl.sweep_clustering(neighbors_adata, resolutions=[0.5, 1], seeds=[0, 1], threads=threads)
+
+    labels = neighbors_adata.obsm["leiden_sweep"]
+    assert list(labels.columns) == list(stats.index)
+    assert list(stats["n_clusters"]) == [len(np.unique(labels[c])) for c in labels.columns]
+    assert stats["ari_previous"].isna().sum() == 2  # first resolution of each seed
+    assert "ari_seeds" in stats.columns
+
+    sc.tl.leiden(neighbors_adata, resolution=0.5, flavor="igraph", n_iterations=2, random_state=1, key_added="expected")
+    assert (neighbors_adata.obs["expected"].astype(int).values == labels["leiden_0.5_seed1"].values).all()
+
+
 def test_gini():
     """Test gini function."""
 
@@ -111,6 +134,13 @@ def test_gini():
     assert tl.gini(test_array_unequal) == 0.99
 
 
+def test_gini_columns():
+    """Test that gini of a 2D array equals gini per column."""
+
+    x = np.random.default_rng(0).random((20, 5))
+    assert np.allclose(tl.gini(x), [tl.gini(x[:, i]) for i in range(x.shape[1])])
+
+
 def test_calc_ragi(equal_adata, unequal_adata):
     """Test calc_ragi function."""
 
@@ -5,6 +5,7 @@ import sctoolbox.tools.dim_reduction as std
 
 import scanpy as sc
 import numpy as np
+import scipy
 import os
 
 
@@ -50,6 +51,18 @@ def test_lsi(adata):
     assert np.sum(adata.varm['LSI'][adata.var['highly_variable']]) != 0
 
 
+def test_lsi_randomized(adata):
+    """Test that the randomized solver matches the leading singular values of arpack."""
+    adata_rand = adata.copy()
+
+    std.lsi(adata, n_comps=10, use_highly_variable=True)
+    std.lsi(adata_rand, n_comps=10, use_highly_variable=True, solver="randomized", chunk_size=100)
+
+    assert adata_rand.obsm["X_lsi"].shape == adata.obsm["X_lsi"].shape
+    assert np.sum(adata_rand.varm['LSI'][~adata_rand.var['highly_variable']]) == 0
+    assert np.isclose(adata_rand.uns["lsi"]["variance"][0], adata.uns["lsi"]["variance"][0], rtol=1e-3)
+
+
 # --------------------------------- define_PC ---------------------------------
 
 
@@ -115,3 +128,75 @@ def test_subset_PCA(adata_pca):
     assert cstm_res_adata is None
     assert adata_copy.obsm["X_pca"].shape[1] == len(select)
     assert adata_copy.obsm["X_pca"].shape[1] != adata_pca.obsm["X_pca"].shape[1]
+
+
+@pytest.mark.parametrize("centered", [True, False])
+def test_randomized_svd(centered):
+    """Test that the randomized SVD matches the exact SVD of a low rank matrix with implicit centering."""
+
+    rng = np.random.default_rng(0)
+    mat = rng.random((100, 5)) @ rng.random((5, 40)) + rng.random((100, 40)) * 0.01
+    center = mat.mean(axis=0) if centered else None
+    scale = mat.std(axis=0) if centered else None
+
+    u, s, vt = std.randomized_svd(scipy.sparse.csr_matrix(mat), n_comps=5, center=center, scale=scale)
+
+    dense = (mat - mat.mean(axis=0)) / mat.std(axis=0) if centered else mat
+    _, s_exact, _ = np.linalg.svd(dense, full_matrices=False)
+
+    assert np.allclose(s, s_exact[:5])
+    assert np.allclose((u * s) @ vt, dense, atol=0.1)
+
+
+def test_randomized_svd_chunked():
+    """Test that the SVD over blocks of rows of a column subset matches the in-memory SVD."""
+
+    rng = np.random.default_rng(0)
+    mat = scipy.sparse.csr_matrix(rng.random((100, 40)))
+    columns = np.arange(0, 40, 2)
+
+    expected = std.randomized_svd(mat[:, columns], n_comps=5)
+    chunked = std.randomized_svd(mat, n_comps=5, columns=columns, chunk_size=30)
+
+    for e, c in zip(expected, chunked):
+        assert np.allclose(e, c)
+
+
+@pytest.fixture
+def adata_lowrank():
+    """Create an anndata object with a decaying spectrum."""
+    rng = np.random.default_rng(0)
+    mat = (rng.normal(size=(300, 5)) * np.linspace(10, 2, 5)) @ rng.normal(size=(5, 60)) + rng.normal(size=(300, 60)) * 0.1
+    adata = sc.AnnData(scipy.sparse.csr_matrix(np.clip(mat, 0, None).astype(np.float32)))
+    adata.var["highly_variable"] = np.arange(60) % 3 != 0
+    return adata
+
+
+def test_compute_PCA_chunked(adata_lowrank, tmp_path):
+    """Test that the out-of-core PCA matches scanpy and gives the same result for backed objects."""
+    expected = std.compute_PCA(adata_lowrank, n_comps=5, svd_solver="arpack")
+    chunked = std.compute_PCA(adata_lowrank, n_comps=5, chunk_size=70)
+
+    assert np.allclose(chunked.uns["pca"]["variance_ratio"], expected.uns["pca"]["variance_ratio"], rtol=1e-4)
+    assert np.allclose(np.abs(chunked.obsm["X_pca"]), np.abs(expected.obsm["X_pca"]), atol=1e-2)
+    assert np.all(chunked.varm["PCs"][~adata_lowrank.var["highly_variable"]] == 0)
+
+    adata_lowrank.write_h5ad(tmp_path / "backed.h5ad")
+    backed = sc.read_h5ad(tmp_path / "backed.h5ad", backed="r")
+    std.compute_PCA(backed, n_comps=5, inplace=True, chunk_size=70)
+
+    assert np.allclose(backed.obsm["X_pca"], chunked.obsm["X_pca"], atol=1e-4)
+
+
+def test_project_PCA(adata_lowrank):
+    """Test that projecting the reference cells reproduces the reference embedding."""
+    reference = std.compute_PCA(adata_lowrank, n_comps=5, chunk_size=70)
+    query = adata_lowrank[:50, ::-1].copy()  # features in a different order
+
+    projected = std.project_PCA(query, reference, chunk_size=20)
+
+    assert np.allclose(projected.obsm["X_pca"], reference.obsm["X_pca"][:50], atol=1e-4)
+    assert np.allclose(projected.varm["PCs"], reference.varm["PCs"][::-1])
+
+    with pytest.raises(ValueError):
+        std.project_PCA(query[:, :10].copy(), reference)
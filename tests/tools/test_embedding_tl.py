@@ -2,6 +2,8 @@
 
 import pytest
 import scanpy as sc
+import numpy as np
+import scipy
 
 import sctoolbox.tools.embedding as ste
 
@@ -46,6 +48,27 @@ def test_correlation_matrix_success(adata, which, basis, n_components, ignore, m
         assert len(cor) == len(adata.var.select_dtypes(include='number').columns) - ignore_len
 
 
+@pytest.mark.parametrize("method", ["pearsonr", "spearmanr"])
+def test_correlation_matrix_scipy(method):
+    """Test that the vectorized correlation with missing values matches scipy.stats."""
+    rng = np.random.default_rng(0)
+    adata = sc.AnnData(np.zeros((100, 2)))
+    adata.obsm["X_pca"] = rng.normal(size=(100, 5))
+    adata.obs["related"] = adata.obsm["X_pca"][:, 0] + rng.normal(size=100)
+    adata.obs["missing"] = rng.integers(0, 5, size=100).astype(float)
+    adata.obs.iloc[:20, 1] = np.nan
+
+    cor, pval = ste.correlation_matrix(adata, method=method)
+
+    for column in ["related", "missing"]:
+        values = adata.obs[column].to_numpy()
+        valid = ~np.isnan(values)
+        for i in range(5):
+            res = getattr(scipy.stats, method)(adata.obsm["X_pca"][valid, i], values[valid])
+            assert np.isclose(cor.loc[column, f"PC{i + 1}"], res.statistic)
+            assert np.isclose(pval.loc[column, f"PC{i + 1}"], res.pvalue)
+
+
 def test_correlation_matrix_failure(adata):
     """Test invalid value for 'basis' parameter."""
     # invalid basis
@@ -74,6 +97,27 @@ def test_wrap_umap(adata):
         assert "X_umap" in adata.obsm
 
 
+def test_wrap_umap_threads(adata):
+    """Test that UMAPs from shared memory are equal in serial and parallel mode."""
+
+    adatas = [adata.copy() for _ in range(2)]
+    runtimes = ste.wrap_umap(adatas, threads=2, min_dist=0.3, maxiter=20)
+    serial = adata.copy()
+    ste.wrap_umap([serial], threads=1, min_dist=0.3, maxiter=20)
+
+    assert len(runtimes) == 2
+    assert np.allclose(adatas[0].obsm["X_umap"], serial.obsm["X_umap"])
+    assert np.allclose(adatas[1].obsm["X_umap"], serial.obsm["X_umap"])
+
+
+@pytest.mark.parametrize("kwargs", [{"method": "rapids"}, {"invalid": 1}])
+def test_wrap_umap_unsupported(adata, kwargs):
+    """Test that unsupported sc.tl.umap arguments raise an error instead of being ignored."""
+
+    with pytest.raises((ValueError, TypeError)):
+        ste.wrap_umap([adata.copy()], threads=1, **kwargs)
+
+
 def test_correlation_matrix_warning(adata):
     """Test invalid value for 'ignore' parameter."""
     # invalid basis
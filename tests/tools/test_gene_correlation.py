@@ -4,6 +4,7 @@ import numpy as np
 import pandas as pd
 import os
 import scanpy as sc
+import scipy.stats
 
 from sctoolbox.utils.adata import get_adata_subsets
 from sctoolbox.tools.gene_correlation import correlate_conditions, correlate_ref_vs_all, compare_two_conditons
@@ -50,6 +51,22 @@ def test_correlate_ref_vs_all(adata, gene, save):
                                      'reject_0?']
 
 
+@pytest.mark.parametrize("sparse", [True, False])
+def test_correlate_ref_vs_all_scipy(adata, sparse):
+    """Test that the blockwise correlation matches scipy.stats.spearmanr."""
+    if not sparse:
+        adata.X = adata.X.toarray()
+    adata.X[:, 1] = -adata.X[:, 1]  # negative values are ranked before the zeros
+
+    results = correlate_ref_vs_all(adata, "Xkr4", chunk_size=30)
+
+    mat = adata.to_df()
+    expected = np.array([scipy.stats.spearmanr(mat["Xkr4"], mat[gene]) for gene in mat.columns])
+
+    assert np.allclose(results["correlation"], expected[:, 0], equal_nan=True)
+    assert np.allclose(results["p-value"], expected[:, 1], equal_nan=True)
+
+
 @pytest.mark.parametrize("gene", ["Invalid Gene"])
 def test_correlate_ref_vs_all_invalid(adata, gene):
     """Test if error is thrown if given gene is not in dataset."""
@@ -113,6 +130,22 @@ def test_correlate_conditions(adata):
                                         'comparison p-value']
 
 
+@pytest.mark.parametrize("threads", [1, 2])
+def test_correlate_conditions_panel(adata, threads):
+    """Test that a panel of reference genes matches the correlation within each condition."""
+    genes = ["Xkr4", adata.var.index[5]]
+
+    comparison = correlate_conditions(adata, genes, "condition", "C1", "C2", chunk_size=30, threads=threads)
+
+    assert list(comparison.index.get_level_values("reference").unique()) == genes
+
+    for gene in genes:
+        for condition, suffix in [("C1", "A"), ("C2", "B")]:
+            subset = adata[adata.obs["condition"] == condition].copy()
+            expected = correlate_ref_vs_all(subset, gene)
+            assert np.allclose(comparison.loc[gene, f"correlation_{suffix}"], expected["correlation"], equal_nan=True)
+
+
 def test_invalid_condition_correlate_conditions(adata):
     """Test if error is raised when condition is invalid."""
     with pytest.raises(Exception):
@@ -119,6 +119,28 @@ def test_get_rank_genes_tables(adata):
 
     os.remove("rank_genes.xlsx")
 
+    # Check fractions against a direct calculation
+    table = tables["C1"].set_index("names")
+    in_group = adata[adata.obs["condition"] == "C1", table.index].X > 0
+    out_group = adata[adata.obs["condition"] != "C1", table.index].X > 0
+    assert list(table.columns[-3:]) == ["C2_fraction", "C3_fraction", "out_group_fraction"]
+    assert np.allclose(table["C1_fraction"], np.asarray(in_group.mean(axis=0)).ravel())
+    assert np.allclose(table["out_group_fraction"], np.asarray(out_group.mean(axis=0)).ravel())
+
+
+def test_get_rank_genes_tables_empty_group(adata):
+    """Test that groups without cells get fractions of 0."""
+
+    adata = adata.copy()
+    sc.tl.rank_genes_groups(adata, groupby="condition")
+    adata.obs["condition"] = adata.obs["condition"].astype(str).replace("C3", "C1")
+
+    tables = mg.get_rank_genes_tables(adata, out_group_fractions=True)
+
+    assert (tables["C3"]["C3_fraction"] == 0).all()
+    assert (tables["C1"]["C3_fraction"] == 0).all()
+    assert not tables["C3"].isna().any().any()
+
 
 @pytest.mark.parametrize("kwargs", [{"var_columns": ["invalid", "columns"]}])  # save_excel must be str
 def test_get_rank_genes_tables_errors(adata, kwargs):
@@ -171,6 +193,24 @@ def test_run_deseq2(adata, condition_col, error, contrast):
         assert isinstance(df, pd.DataFrame)
 
 
+@pytest.mark.parametrize("threads", [1, 2])
+def test_run_deseq2_groupby(adata, threads):
+    """Test that deseq2 is run per group and matches a run on the subset."""
+
+    adata.obs["celltype"] = np.random.choice(["A", "B"], size=adata.shape[0])
+
+    df = mg.run_deseq2(adata, sample_col="samples", condition_col="condition", layer="raw", groupby="celltype", threads=threads)
+
+    assert set(df["celltype"]) == {"A", "B"}
+    assert set(adata.uns["sctoolbox"]["deseq_result"].keys()) == {"A", "B"}
+
+    subset = adata[adata.obs["celltype"] == "A"].copy()
+    expected = mg.run_deseq2(subset, sample_col="samples", condition_col="condition", layer="raw", threads=1)
+    result = adata.uns["sctoolbox"]["deseq_result"]["A"]
+
+    pd.testing.assert_frame_equal(expected, result[expected.columns], check_exact=False)
+
+
 @pytest.mark.parametrize(
     "score_name, gene_set, inplace",
     [
@@ -194,6 +234,44 @@ def test_score_genes(adata_score, score_name, gene_set, inplace):
         assert score_name in out.obs.columns
 
 
+@pytest.mark.parametrize("as_gmt", [True, False])
+def test_score_genes_multiple(adata_score, tmp_path, as_gmt):
+    """Test scoring of multiple gene sets against a calculation on the scaled matrix."""
+
+    genes = adata_score.var.index.to_list()
+    gene_sets = {"set1": genes[:20], "set2": genes[40:60]}
+
+    if as_gmt:
+        gmt = tmp_path / "sets.gmt"
+        gmt.write_text("".join(f"{name}\tdescription\t" + "\t".join(g) + "\n" for name, g in gene_sets.items()))
+        mg.score_genes(adata_score, str(gmt), ctrl_size=1000)  # all genes of a bin are used as control
+    else:
+        mg.score_genes(adata_score, gene_sets, ctrl_size=1000)
+
+    # Expected score with control genes from the same expression bins
+    means = pd.Series(np.asarray(adata_score.X.mean(axis=0, dtype=np.float64)).ravel())
+    cut = (means.rank(method="min") // int(np.round(len(means) / 24))).values
+    scaled = sc.pp.scale(adata_score, copy=True).X
+
+    for name, genes in gene_sets.items():
+        idx = adata_score.var.index.get_indexer(genes)
+        ctrl = np.setdiff1d(np.where(np.isin(cut, cut[idx]))[0], idx)
+        expected = scaled[:, idx].mean(axis=1) - scaled[:, ctrl].mean(axis=1)
+
+        assert np.allclose(adata_score.obs[name], expected, atol=1e-5)
+
+
+def test_score_genes_kwargs(adata_score, gene_set):
+    """Test that additional arguments are passed to scanpy.tl.score_genes."""
+
+    mg.score_genes(adata_score, gene_set, score_name="test", use_raw=False)
+
+    scaled = sc.pp.scale(adata_score, copy=True)
+    sc.tl.score_genes(scaled, gene_list=gene_set, score_name="expected", use_raw=False, random_state=0)
+
+    assert np.allclose(adata_score.obs["test"], scaled.obs["expected"])
+
+
 @pytest.mark.parametrize("groupby", ["samples"])
 def test_run_rank_genes(adata, groupby):
     """Test ranking genes function."""
@@ -219,3 +297,12 @@ def test_pairwise_rank_genes(adata):
     output = mg.pairwise_rank_genes(adata=adata, groupby="samples")
 
     assert isinstance(output, pd.DataFrame)
+
+
+def test_pairwise_rank_genes_threads(adata):
+    """Test that pairwise_rank_genes gives the same result in serial and parallel mode."""
+
+    serial = mg.pairwise_rank_genes(adata=adata, groupby="condition", threads=1)
+    parallel = mg.pairwise_rank_genes(adata=adata, groupby="condition", threads=2)
+
+    pd.testing.assert_frame_equal(serial, parallel)
@@ -4,6 +4,7 @@ import pytest
 import os
 import scanpy as sc
 import numpy as np
+import scipy
 import anndata as ad
 import sctoolbox.tools as tools
 import sctoolbox.utils as utils
@@ -101,10 +102,30 @@ def test_tfidf(tfidf_x):
     assert str("%.3f" % tfidf_x.layers["test"][3, 0]) == "4.770"
 
 
+@pytest.mark.parametrize("fmt", ["csr", "csc", "backed"])
+def test_tfidf_chunked(tfidf_x, tmp_path, fmt):
+    """Test that the in-place transform of sparse and backed matrices matches the dense result."""
+    expected = tools.norm_correct.tfidf(tfidf_x, inplace=False).X
+
+    if fmt == "backed":
+        tfidf_x.X = scipy.sparse.csr_matrix(tfidf_x.X)
+        tfidf_x.write_h5ad(tmp_path / "tfidf.h5ad")
+        adata = sc.read_h5ad(tmp_path / "tfidf.h5ad", backed="r+")
+        tools.norm_correct.tfidf(adata, inplace=True, chunk_size=3)
+        adata.file.close()
+        result = sc.read_h5ad(tmp_path / "tfidf.h5ad").X
+    else:
+        tfidf_x.X = scipy.sparse.csr_matrix(tfidf_x.X).asformat(fmt)
+        tools.norm_correct.tfidf(tfidf_x, inplace=True, chunk_size=3)
+        result = tfidf_x.X
+
+    assert np.allclose(result.toarray(), expected)
+
+
 def test_wrap_corrections(adata):
     """Test if wrapper returns a dict, and that the keys contains the given methods."""
 
-    methods = ["mnn", "scanorama"]  # two fastest methods
+    methods = ["combat", "scanorama"]  # two fastest methods without optional packages
     adata_dict = tools.norm_correct.wrap_corrections(adata, batch_key="batch", methods=methods)
 
     assert isinstance(adata_dict, dict)
@@ -113,9 +134,29 @@ def test_wrap_corrections(adata):
     assert len(set(methods) - keys) == 0
 
 
+def test_wrap_corrections_parallel(adata):
+    """Test that the parallel mode matches the serial corrections and reports resources."""
+
+    methods = ["scanorama", "combat"]
+    # the serial run starts thread pools in this process before the workers are created (forked workers deadlocked)
+    serial = tools.norm_correct.wrap_corrections(adata, batch_key="batch", methods=methods)
+    parallel, stats = tools.norm_correct.wrap_corrections(adata, batch_key="batch", methods=methods, threads=2, return_stats=True)
+
+    assert list(stats.index) == methods
+    assert list(stats.columns) == ["runtime", "peak_rss"]
+    assert parallel["scanorama"].X is adata.X  # unchanged matrix is shared instead of copied
+
+    for method in methods:
+        assert list(parallel[method].obs.columns) == list(serial[method].obs.columns)
+        assert set(parallel[method].layers.keys()) == set(serial[method].layers.keys())
+        assert np.allclose(parallel[method].obsm["X_pca"], serial[method].obsm["X_pca"], atol=1e-5)
+
+
 @pytest.mark.parametrize("method", ["bbknn", "mnn", "harmony", "scanorama", "combat"])
 def test_batch_correction(adata, method):
     """Test if batch correction returns an anndata."""
+    if method == "mnn":
+        pytest.importorskip("mnnpy")
 
     adata_corrected = tools.norm_correct.batch_correction(adata, batch_key="batch", method=method)
     assert isinstance(adata_corrected, sc.AnnData)
@@ -124,6 +165,79 @@ def test_batch_correction(adata, method):
     assert adata is not adata_corrected
 
 
+def test_batch_correction_order(adata):
+    """Test that scanorama keeps the cell order and matches a run on the sorted object."""
+
+    scanorama = tools.norm_correct.batch_correction(adata, batch_key="batch", method="scanorama")
+
+    sorted_adata = adata[adata.obs["batch"].argsort()].copy()
+    sc.external.pp.scanorama_integrate(sorted_adata, key="batch")
+    expected = sorted_adata[adata.obs_names].obsm["X_scanorama"]
+
+    assert list(scanorama.obs_names) == list(adata.obs_names)
+    assert np.allclose(scanorama.obsm["X_pca"], expected)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_batch_correction_mnn(adata, monkeypatch, sparse):
+    """Test that the mnn corrected genes are written to .X in the original cell order and used for the PCA."""
+
+    adata = adata.copy()
+    adata.X = adata.X.toarray()
+    adata.X[adata.obs["batch"] == "b"] += 2  # batch shift
+    adata.var["highly_variable"] = np.arange(adata.n_vars) % 4 != 0
+    uncorrected = adata.X.copy()
+    if sparse:
+        adata.X = scipy.sparse.csr_matrix(adata.X)
+
+    def mnn_correct(*datas, **kwargs):
+        """Remove the batch shift by centering each batch (mnnpy is optional)."""
+        return [data - data.mean(axis=0) for data in datas], [], []
+
+    monkeypatch.setattr(sc.external.pp, "mnn_correct", mnn_correct)
+    corrected = tools.norm_correct.batch_correction(adata, batch_key="batch", method="mnn")
+
+    if sparse:
+        assert scipy.sparse.isspmatrix_csr(corrected.X)
+        corrected.X = corrected.X.toarray()
+    assert np.array_equal(adata.X.toarray() if sparse else adata.X, uncorrected)  # input is not modified
+    adata.X = uncorrected
+
+    hvg = adata.var["highly_variable"].values
+    expected = adata.X[:, hvg].copy()
+    for batch in ["a", "b"]:
+        rows = (adata.obs["batch"] == batch).values
+        expected[rows] -= expected[rows].mean(axis=0)
+
+    assert list(corrected.obs_names) == list(adata.obs_names)
+    assert corrected.X.dtype == np.float32
+    assert np.allclose(corrected.X[:, hvg], expected, atol=1e-5)
+    assert np.array_equal(corrected.X[:, ~hvg], adata.X[:, ~hvg])
+
+    # Same embedding as scaling the corrected matrix followed by a PCA
+    baseline = sc.AnnData(expected)
+    sc.pp.scale(baseline)
+    sc.tl.pca(baseline)
+    assert np.allclose(np.abs(corrected.obsm["X_pca"][:, :5]), np.abs(baseline.obsm["X_pca"][:, :5]), atol=1e-2)
+
+
+def test_batch_correction_mnnpy(adata):
+    """Test that mnnpy reduces a batch shift of the corrected genes."""
+    pytest.importorskip("mnnpy")
+
+    adata = adata.copy()
+    adata.X = adata.X.toarray()
+    adata.X[adata.obs["batch"] == "b"] += 2  # batch shift
+
+    corrected = tools.norm_correct.batch_correction(adata, batch_key="batch", method="mnn", highly_variable=False)
+
+    rows = (adata.obs["batch"] == "b").values
+    shift_before = np.abs(adata.X[rows].mean(axis=0) - adata.X[~rows].mean(axis=0)).mean()
+    shift_after = np.abs(corrected.X[rows].mean(axis=0) - corrected.X[~rows].mean(axis=0)).mean()
+    assert list(corrected.obs_names) == list(adata.obs_names)
+    assert shift_after < shift_before
+
+
 def test_evaluate_batch_effect(adata):
     """Test if AnnData containing LISI column in .obs is returned."""
     ad = tools.norm_correct.evaluate_batch_effect(adata, 'batch')
@@ -133,6 +247,40 @@ def test_evaluate_batch_effect(adata):
     assert "LISI_score" in ad.obs
 
 
+def test_evaluate_batch_effect_lisi(adata):
+    """Test that LISI of several batch keys matches harmonypy, also when reusing the neighbor graph."""
+    lisi = pytest.importorskip("harmonypy.lisi")
+    adata = adata.copy()  # the fixture is shared by the session
+    rng = np.random.default_rng(0)
+    adata.obs["celltype"] = rng.choice(["A", "B", "C"], size=adata.n_obs)
+    adata.obsm["X_pca"] = rng.normal(size=(adata.n_obs, 10))  # without duplicated cells, whose neighbor order is arbitrary
+    coords = adata.obsm["X_pca"][:, :5]
+    expected = lisi.compute_lisi(coords, adata.obs, ["batch", "celltype"], perplexity=10)
+
+    result = tools.norm_correct.evaluate_batch_effect(adata, ["batch", "celltype"], obsm_key="X_pca", perplexity=10)
+    assert np.allclose(result.obs[["LISI_score_batch", "LISI_score_celltype"]], expected)
+
+    sc.pp.neighbors(adata, n_neighbors=31, use_rep="X_pca", n_pcs=5)
+    result = tools.norm_correct.evaluate_batch_effect(adata, "batch", obsm_key="X_pca", perplexity=10)
+    assert np.allclose(result.obs["LISI_score"], expected[:, 0])
+
+    # graphs with fewer than 3 * perplexity neighbors are not reused
+    sc.pp.neighbors(adata, n_neighbors=15, use_rep="X_pca", n_pcs=5)
+    result = tools.norm_correct.evaluate_batch_effect(adata, "batch", obsm_key="X_pca", perplexity=10)
+    assert np.allclose(result.obs["LISI_score"], expected[:, 0])
+
+
+def test_lisi_single_neighbor():
+    """Test that cells with all weight on one neighbor get a LISI of -1 as in harmonypy."""
+    # each cell has one close and one unreachable neighbor, so the perplexity cannot be reached
+    rows = np.repeat(np.arange(4), 2)
+    cols = np.array([1, 2, 0, 3, 3, 0, 2, 1])
+    distances = scipy.sparse.csr_matrix((np.tile([1.0, 1e30], 4), (rows, cols)), shape=(4, 4))
+    codes = np.zeros((4, 1), dtype=np.int32)
+
+    assert np.array_equal(tools.norm_correct._lisi(distances, codes, perplexity=2 / 3), np.full((4, 1), -1.0))
+
+
 @pytest.mark.parametrize("key", ["a", "b"])
 def test_evaluate_batch_effect_keyerror(adata, key):
     """Test evaluate_batch_effect failure."""
@@ -143,9 +291,10 @@ def test_evaluate_batch_effect_keyerror(adata, key):
         tools.norm_correct.evaluate_batch_effect(adata, batch_key=key)
 
 
-def test_wrap_batch_evaluation(adata_batch_dict):
+@pytest.mark.parametrize("threads", [1, 2])
+def test_wrap_batch_evaluation(adata_batch_dict, threads):
     """Test if DataFrame containing LISI column in .obs is returned."""
-    adata_dict = tools.norm_correct.wrap_batch_evaluation(adata_batch_dict, 'batch', inplace=False)
+    adata_dict = tools.norm_correct.wrap_batch_evaluation(adata_batch_dict, 'batch', threads=threads, inplace=False)
     adata_dict_type = type(adata_dict).__name__
     adata_type = type(adata_dict['adata']).__name__
 
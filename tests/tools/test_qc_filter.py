@@ -5,6 +5,7 @@ import sctoolbox.tools.qc_filter as qc
 import sctoolbox.utils.adata as utils
 import scanpy as sc
 import numpy as np
+import pandas as pd
 import os
 import tempfile
 import matplotlib.pyplot as plt
@@ -120,15 +121,49 @@ def norm_dist():
 # --------------------------- TESTS --------------------------------- #
 
 
+@pytest.mark.parametrize("backed", [False, True])
+def test_calculate_qc_metrics_chunked(adata, tmp_path, backed):
+    """Test that chunked qc metrics equal the metrics of scanpy."""
+
+    expected = qc.calculate_qc_metrics(adata, percent_top=[5, 10], qc_vars=["is_bool"])
+
+    if backed:
+        adata.write_h5ad(tmp_path / "backed.h5ad")
+        adata = sc.read_h5ad(tmp_path / "backed.h5ad", backed="r")
+        qc.calculate_qc_metrics(adata, percent_top=[5, 10], qc_vars=["is_bool"], inplace=True, chunk_size=50)
+        result = adata
+    else:
+        result = qc.calculate_qc_metrics(adata, percent_top=[5, 10], qc_vars=["is_bool"], chunk_size=50)
+
+    for table, expected_table in [(result.obs, expected.obs), (result.var, expected.var)]:
+        assert list(table.columns) == list(expected_table.columns)
+        for col in expected_table.columns:
+            if expected_table[col].dtype.kind in "fi":
+                assert np.allclose(table[col], expected_table[col], equal_nan=True, rtol=1e-5)
+
+
 # TODO: test with more threads ("sample", 4) (excluded as it runs forever)
-@pytest.mark.parametrize("groupby,threads", [(None, 1), ("sample", 1)])
-def test_estimate_doublets(adata, groupby, threads):
+@pytest.mark.parametrize("groupby,threads,fast", [(None, 1, False), ("sample", 1, False), (None, 1, True), ("sample", 2, True)])
+def test_estimate_doublets(adata, groupby, threads, fast):
     """Test whether 'doublet_score' was added to adata.obs."""
 
     adata = adata.copy()  # copy adata to avoid inplace changes
-    qc.estimate_doublets(adata, groupby=groupby, plot=False, threads=threads, n_prin_comps=10)  # turn plot off to avoid block during testing
+    qc.estimate_doublets(adata, groupby=groupby, plot=False, threads=threads, fast=fast, n_prin_comps=10)  # turn plot off to avoid block during testing
 
     assert "doublet_score" in adata.obs.columns
+    assert "predicted_doublet" in adata.obs.columns
+    assert len(adata.uns["scrublet"]["doublet_scores_sim"]) > 0
+
+
+def test_estimate_doublets_threads(adata):
+    """Test that doublet estimation per group gives the same result in serial and parallel mode."""
+
+    serial = qc.estimate_doublets(adata, groupby="sample", plot=False, threads=1, inplace=False, n_prin_comps=10)
+    parallel = qc.estimate_doublets(adata, groupby="sample", plot=False, threads=2, inplace=False, n_prin_comps=10)
+
+    pd.testing.assert_frame_equal(serial.obs[["doublet_score", "predicted_doublet"]],
+                                  parallel.obs[["doublet_score", "predicted_doublet"]])
+    assert np.allclose(serial.uns["scrublet"]["doublet_scores_sim"], parallel.uns["scrublet"]["doublet_scores_sim"])
 
 
 def test_gmm_threshold(norm_dist):
@@ -162,6 +197,33 @@ def test_automatic_thresholds(adata, which, columns, groupby, fun):
         assert len(thresholds) == len(getattr(adata, which).select_dtypes("number").columns)
 
 
+@pytest.mark.parametrize("groupby", [None, "group"])
+def test_automatic_thresholds_threads(adata, groupby):
+    """Test that thresholds are equal in serial and parallel mode."""
+
+    columns = ["qc_variable1", "qc_variable2"]
+    serial = qc.automatic_thresholds(adata, columns=columns, groupby=groupby, threads=1)
+    parallel = qc.automatic_thresholds(adata, columns=columns, groupby=groupby, threads=2)
+
+    assert serial == parallel
+
+
+@pytest.mark.parametrize("FUN", [qc.gmm_threshold, qc.mad_threshold])
+@pytest.mark.parametrize("groupby", [None, "group"])
+def test_automatic_thresholds_subsample(FUN, groupby):
+    """Test that thresholds of a subsample are close to the thresholds of all values."""
+
+    rng = np.random.default_rng(1)
+    obs = pd.DataFrame({"qc_variable": np.append(rng.normal(size=16000), rng.normal(size=4000, loc=1, scale=2)),
+                        "group": rng.choice(["grp1", "grp2"], size=20000)})
+    adata = sc.AnnData(obs=obs.set_index(obs.index.astype(str)))
+
+    full = qc.thresholds_as_table(qc.automatic_thresholds(adata, columns=["qc_variable"], groupby=groupby, FUN=FUN, subsample=None))
+    subsampled = qc.thresholds_as_table(qc.automatic_thresholds(adata, columns=["qc_variable"], groupby=groupby, FUN=FUN, subsample=2000))
+
+    assert np.allclose(subsampled.select_dtypes("number"), full.select_dtypes("number"), atol=0.1)
+
+
 def test_automatic_thresholds_failure(adata):
     """Test automatic_thresholds failure."""
 
@@ -186,6 +248,36 @@ def test_apply_qc_thresholds(adata):
     assert adata_filter.shape[0] < adata.shape[0]
 
 
+def test_apply_qc_thresholds_grouped(adata):
+    """Check that grouped thresholds are applied per group and failed metrics are reported."""
+
+    thresholds = {"qc_variable1": {group: {"min": -1 + i, "max": 1 + i} for i, group in enumerate(["grp1", "grp2", "grp3"])},
+                  "qc_variable2": {"min": -2, "max": 2}}
+    adata_filter = qc.apply_qc_thresholds(adata, thresholds, inplace=False, groupby="group")
+
+    offset = adata.obs["group"].map({"grp1": 0, "grp2": 1, "grp3": 2}).astype(float)
+    fail1 = ((adata.obs["qc_variable1"] < -1 + offset) | (adata.obs["qc_variable1"] > 1 + offset)).to_numpy()
+    fail2 = ((adata.obs["qc_variable2"] < -2) | (adata.obs["qc_variable2"] > 2)).to_numpy()
+
+    assert list(adata_filter.obs_names) == list(adata.obs_names[~(fail1 | fail2)])
+
+    report = adata_filter.uns["sctoolbox"]["report"]["qc"]["obs"]["threshold_failed"]
+    assert report["metrics"] == ["qc_variable1", "qc_variable2"]
+    assert list(report["bitmask"].index) == list(adata.obs_names)
+    assert np.array_equal(report["bitmask"]["bitmask"], fail1.astype(np.uint32) | (fail2.astype(np.uint32) << 1))
+
+
+@pytest.mark.parametrize("nan_fails", [True, False])
+def test_get_threshold_bitmask(nan_fails):
+    """Test the bitmask of failed thresholds with NaN values."""
+    table = pd.DataFrame({"a": [0, 5, np.nan, 2], "b": [10, 1, 1, np.nan]})
+    thresholds = {"a": {"min": 1, "max": 4}, "b": {"max": 5}}
+
+    bitmask = qc.get_threshold_bitmask(table, thresholds, nan_fails=nan_fails)
+
+    assert bitmask.tolist() == ([3, 1, 1, 2] if nan_fails else [3, 1, 0, 0])
+
+
 def test_validate_threshold_dict(adata, threshold_dict):
     """Test whether threshold dict is successfully validated."""
     ret = qc.validate_threshold_dict(adata.obs, threshold_dict)
@@ -388,6 +480,23 @@ def test_predict_sex(caplog, adata, threshold):
     assert 'predicted_sex' in adata.obs.columns
 
 
+def test_predict_sex_panel(adata):
+    """Test predict_sex with a panel of female and Y genes against fractions per group."""
+    adata = adata.copy()
+    female, male = list(adata.var["gene"][:2]), list(adata.var["gene"][2:5])
+
+    qc.predict_sex(adata, gene=female, gene_column="gene", groupby="sample", threshold=0.05,
+                   y_genes=male, y_threshold=0.05, plot=False)
+
+    X = adata.X.toarray()
+    expressed = pd.DataFrame({"female": (X[:, :2] > 0).any(axis=1), "male": (X[:, 2:5] > 0).any(axis=1)})
+    fractions = expressed.groupby(adata.obs["sample"].values).mean()
+    expected = np.select([(fractions["female"] >= 0.05) & (fractions["male"] >= 0.05), fractions["female"] >= 0.05, fractions["male"] >= 0.05],
+                         ["Mixed", "Female", "Male"], default="Unknown")
+
+    assert (adata.obs["predicted_sex"].values == pd.Series(expected, index=fractions.index)[adata.obs["sample"]].values).all()
+
+
 def test_predict_sex_diff_types(caplog, adata):
     """Test predict_sex for different adata.X types."""
 
@@ -3,6 +3,7 @@
 import pytest
 import scanpy as sc
 import numpy as np
+import scipy
 import os
 import sctoolbox.utils as utils
 import re
@@ -69,6 +70,43 @@ def test_pseudobulk_table(adata_mock):
     assert pseudobulk.shape[1] == 3  # number of groups
 
 
+@pytest.mark.parametrize("how", ["mean", "sum"])
+@pytest.mark.parametrize("percentile_range", [(0, 100), (0, 95), (10, 80)])
+@pytest.mark.parametrize("sparse", [True, False])
+def test_pseudobulk_table_values(adata_mock, how, percentile_range, sparse):
+    """Test that pseudobulk values match a dense calculation per group."""
+
+    adata = adata_mock.copy()
+    adata.X = adata.X * (np.random.rand(*adata.shape) > 0.5)  # introduce zeros
+    if sparse:
+        adata.X = scipy.sparse.csr_matrix(adata.X)
+
+    pseudobulk = utils.bioutils.pseudobulk_table(adata, "group", how=how, percentile_range=percentile_range,
+                                                 chunk_size=30, threads=2)
+
+    dense = adata.X.toarray() if sparse else adata.X
+    for group in ["C1", "C2", "C3"]:
+        values = dense[adata.obs["group"] == group].astype(float)
+        limits = np.percentile(values, percentile_range, axis=0, method="lower")
+        values[(values < limits[0]) | (values > limits[1])] = np.nan
+        expected = np.nanmean(values, axis=0) if how == "mean" else np.nansum(values, axis=0)
+
+        assert np.allclose(pseudobulk[group].values, expected)
+
+
+@pytest.mark.parametrize("fmt", ["dense", "csr", "csc"])
+def test_pseudobulk_table_float64(fmt):
+    """Test that sums of float32 values are accumulated in float64."""
+
+    X = np.array([[1e8], [1], [-1e8]], dtype=np.float32)
+    adata = sc.AnnData(X=X if fmt == "dense" else scipy.sparse.csr_matrix(X).asformat(fmt))
+    adata.obs["group"] = "A"
+
+    pseudobulk = utils.bioutils.pseudobulk_table(adata, "group", how="sum")
+
+    assert pseudobulk.loc[adata.var_names[0], "A"] == 1
+
+
 def test_barcode_index(adata):
     """Test barcode index."""
 
@@ -0,0 +1,35 @@
+"""Test multiprocessing functions."""
+
+import pytest
+import numpy as np
+import scipy
+import sctoolbox.utils.multiprocessing as mp_utils
+
+
+@pytest.mark.parametrize("fmt", ["dense", "csr", "csc"])
+def test_share_matrix(fmt):
+    """Test that a shared matrix is loaded with identical values."""
+
+    mat = np.random.randint(0, 3, (20, 10)).astype(np.float32)
+    if fmt != "dense":
+        mat = scipy.sparse.random(20, 10, density=0.3, format=fmt, dtype=np.float32)
+
+    handles, spec = mp_utils.share_matrix(mat)
+    shared, shared_handles = mp_utils.load_shared_matrix(spec)
+
+    if fmt == "dense":
+        assert np.array_equal(shared, mat)
+    else:
+        assert shared.format == fmt
+        assert np.array_equal(shared.toarray(), mat.toarray())
+
+    del shared
+    mp_utils.release_shared(shared_handles)
+    mp_utils.release_shared(handles, unlink=True)
+
+
+def test_share_matrix_invalid_format():
+    """Test that unsupported sparse formats raise an error."""
+
+    with pytest.raises(ValueError):
+        mp_utils.share_matrix(scipy.sparse.random(5, 5, format="coo"))